@@ -21,6 +21,10 @@ if [ "$1" = 'celery' ]; then
     exec bin/wait-for-it.sh postgres:5432 -- celery -A mlb worker -l info -B
 fi
 
+if [ "$1" = 'dmx' ]; then
+    exec python3 manage.py run_dmx
+fi
+
 if [ "$1" = 'shell' ]; then
     exec /bin/bash
 fi
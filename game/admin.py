@@ -1,7 +1,8 @@
+from django.conf import settings
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin
 from .models import User, Game, Team, Show
-from .tasks import render_souvenir, send_souvenir_sms
+from .tasks import render_souvenirs_batch
 
 
 class GameAdmin(admin.ModelAdmin):
@@ -10,10 +11,14 @@ class GameAdmin(admin.ModelAdmin):
     list_display = ['pk', 'user', 'show', 'state']
 
     def regenerate_souvenirs(self, request, queryset):
-        for game in queryset:
-            s = render_souvenir.s(game.pk)
-            s.link(send_souvenir_sms.s())
-            s.delay()
+        game_ids = list(queryset.values_list('pk', flat=True))
+        size = settings.SOUVENIR_BATCH_SIZE
+        tasks = []
+        for i in range(0, len(game_ids), size):
+            tasks.append(render_souvenirs_batch.delay(game_ids[i:i + size]))
+        message = 'Regenerating {} souvenirs in {} batches: {}'
+        self.message_user(request, message.format(len(game_ids), len(tasks),
+                                                  ', '.join(str(task.id) for task in tasks)))
     regenerate_souvenirs.short_description = 'Regenerate and send souvenirs'
 
 
@@ -0,0 +1,106 @@
+import json
+import time
+import logging
+
+from django.conf import settings
+from redis import RedisError
+
+from .util import get_redis
+
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = 'events:games'
+LOG_KEY = 'events:games:log'
+ID_KEY = 'events:games:id'
+
+
+def transition_event(game, source, target):
+    """Describe a game's state change for clients following the queue."""
+    event = {'type': 'transition', 'game': game.pk, 'user': game.user_id,
+             'source': source, 'state': target}
+    if target == 'completed':
+        event.update(score=game.score, distance=game.distance, homeruns=game.homeruns)
+    return event
+
+
+# Numbers, keeps and publishes events in one step, so concurrent publishers
+# can't publish ids out of order or leave gaps in the log while they run.
+PUBLISH_SCRIPT = """
+local count = #ARGV - 2
+local id = redis.call('INCRBY', KEYS[1], count) - count
+for i = 3, #ARGV do
+    id = id + 1
+    local payload = '{"id": ' .. id .. ', ' .. string.sub(ARGV[i], 2)
+    redis.call('ZADD', KEYS[2], id, payload)
+    redis.call('PUBLISH', ARGV[1], payload)
+end
+redis.call('ZREMRANGEBYRANK', KEYS[2], 0, -tonumber(ARGV[2]) - 1)
+"""
+
+
+def publish(events):
+    """Number `events`, keep them for replay and publish them.
+
+    Events are best effort. Clients that miss some, for example while
+    redis is unavailable, can reload the queue from the API.
+    """
+    if not events:
+        return
+    try:
+        client = get_redis()
+        script = client.register_script(PUBLISH_SCRIPT)
+        script(keys=[ID_KEY, LOG_KEY],
+               args=[CHANNEL, settings.EVENTS_REPLAY_SIZE] + [json.dumps(event) for event in events])
+    except RedisError:
+        logger.exception('Failed to publish game events')
+
+
+def since(last_id):
+    """Return the kept events after `last_id`, oldest first."""
+    return [json.loads(payload.decode())
+            for payload in get_redis().zrangebyscore(LOG_KEY, '({}'.format(last_id), '+inf')]
+
+
+def _format(event):
+    return 'id: {}\nevent: {}\ndata: {}\n\n'.format(event['id'], event['type'], json.dumps(event))
+
+
+def stream(last_id=None, duration=None):
+    """Return a generator of server-sent events, lasting `duration` seconds.
+
+    Events after `last_id` are replayed first. The stream then ends so the
+    worker is freed, and the client reconnects with the last id it saw.
+    Subscribing happens straight away, so events published during the
+    replay aren't missed, and a RedisError is raised if redis is down.
+    """
+    pubsub = get_redis().pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(CHANNEL)
+    return _stream(pubsub, last_id, duration or settings.EVENTS_STREAM_SECONDS)
+
+
+def _stream(pubsub, last_id, duration):
+    try:
+        yield 'retry: {}\n\n'.format(settings.EVENTS_RETRY_MS)
+        if last_id is not None:
+            missed = since(last_id)
+            if missed and missed[0]['id'] > last_id + 1:
+                # Some events were dropped from the log, so the client must reload.
+                yield 'event: reset\ndata: {}\n\n'
+            for event in missed:
+                last_id = event['id']
+                yield _format(event)
+        end = time.time() + duration
+        heartbeat = time.time() + settings.EVENTS_HEARTBEAT_SECONDS
+        while time.time() < end:
+            message = pubsub.get_message(timeout=1)
+            if message is not None:
+                event = json.loads(message['data'].decode())
+                if last_id is None or event['id'] > last_id:
+                    last_id = event['id']
+                    yield _format(event)
+            elif time.time() >= heartbeat:
+                yield ': keepalive\n\n'
+                heartbeat = time.time() + settings.EVENTS_HEARTBEAT_SECONDS
+    finally:
+        pubsub.close()
@@ -0,0 +1,112 @@
+import time
+import logging
+import datetime
+
+from django.db import models
+from django.db.models import Count, Sum
+from django.db.models.functions import Trunc
+from django.utils import timezone
+from redis import RedisError
+
+from .util import get_redis
+
+
+logger = logging.getLogger(__name__)
+
+VERSION_KEY = 'leaderboard:version'
+UPDATED_KEY = 'leaderboard:updated'
+
+
+def key(kind, scope):
+    return 'leaderboard:{}:{}'.format(kind, scope)
+
+
+def scopes(show_id, day):
+    return ['all', 'show:{}'.format(show_id), 'day:{}'.format(day.isoformat())]
+
+
+# Adds a score to a leaderboard and counts the games behind it, removing the
+# member once it has no games left rather than when its score reaches 0, so
+# players who scored nothing stay on the board.
+INCREMENT_SCRIPT = """
+redis.call('ZINCRBY', KEYS[1], ARGV[2], ARGV[1])
+if redis.call('HINCRBY', KEYS[2], ARGV[1], ARGV[3]) <= 0 then
+    redis.call('ZREM', KEYS[1], ARGV[1])
+    redis.call('HDEL', KEYS[2], ARGV[1])
+end
+"""
+
+
+def _increment(pipe, scores, players=True):
+    script = pipe.register_script(INCREMENT_SCRIPT)
+    for score in scores:
+        for scope in scopes(score.show_id, score.day):
+            members = []
+            if players:
+                members.append(('players', score.user_id))
+            if score.team_id is not None:
+                members.append(('teams', score.team_id))
+            for kind, member in members:
+                board = key(kind, scope)
+                script(keys=[board, '{}:games'.format(board)], args=[member, score.score, score.games])
+    pipe.incr(VERSION_KEY)
+    pipe.set(UPDATED_KEY, time.time())
+
+
+def record(scores, players=True):
+    """Add `scores` to the player and team leaderboards.
+
+    Leaderboards are best effort. If redis is unavailable they can be
+    recomputed from the games with `rebuild`.
+    """
+    try:
+        pipe = get_redis().pipeline()
+        _increment(pipe, scores, players)
+        pipe.execute()
+    except RedisError:
+        logger.exception('Failed to update leaderboards')
+
+
+def rebuild():
+    from .models import Game, Score
+    query = Game.objects.filter(state='completed')\
+            .annotate(day=Trunc('date_created', 'day', output_field=models.DateField()))\
+            .values('user_id', 'user__team_id', 'show_id', 'day')\
+            .annotate(games=Count('pk'), score=Sum('score'),
+                      distance=Sum('distance'), homeruns=Sum('homeruns'))
+    scores = []
+    for row in query:
+        row['team_id'] = row.pop('user__team_id')
+        scores.append(Score(**row))
+    redis = get_redis()
+    pipe = redis.pipeline()
+    # Keep the version, which _increment bumps, so that etags from before the
+    # rebuild can't match again.
+    for name in redis.scan_iter('leaderboard:*'):
+        if name.decode() != VERSION_KEY:
+            pipe.delete(name)
+    _increment(pipe, scores)
+    pipe.execute()
+
+
+def top(kind, scope, limit):
+    """Return the top `limit` (id, score) pairs for a leaderboard."""
+    members = get_redis().zrevrange(key(kind, scope), 0, limit - 1, withscores=True)
+    return [(int(member), int(score)) for member, score in members]
+
+
+def version():
+    try:
+        return int(get_redis().get(VERSION_KEY) or 0)
+    except RedisError:
+        return None
+
+
+def last_updated():
+    try:
+        updated = get_redis().get(UPDATED_KEY)
+    except RedisError:
+        return None
+    if updated is None:
+        return None
+    return datetime.datetime.fromtimestamp(float(updated), timezone.utc)
@@ -0,0 +1,273 @@
+import json
+import time
+import socket
+import select
+import logging
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+
+UNIVERSE_SIZE = 512
+
+
+class FakeDMXConnection:
+    """Record rendered frames instead of writing to a serial port, for tests."""
+
+    def __init__(self, path):
+        self.path = path
+        self.channels = [0] * UNIVERSE_SIZE
+        self.frames = []
+
+    def setChannel(self, channel, value, autorender=False):
+        self.channels[channel - 1] = value
+
+    def render(self):
+        self.frames.append(list(self.channels))
+
+    def close(self):
+        pass
+
+
+class Scene:
+    """A lighting cue made of steps, played from whatever is showing.
+
+    Each step fades some channels to new values over `fade` seconds, then
+    holds for `hold` seconds. Channels a step doesn't mention keep their
+    values. Looping scenes repeat their steps, which makes chases. Channels
+    in `snap` select cues rather than set a level, so they switch at the
+    start of a step instead of fading through the cues in between.
+    """
+
+    def __init__(self, steps, loop=False, snap=()):
+        self.masks = np.zeros((len(steps), UNIVERSE_SIZE), dtype=bool)
+        self.values = np.zeros((len(steps), UNIVERSE_SIZE))
+        for i, step in enumerate(steps):
+            for channel, value in step['channels'].items():
+                self.masks[i, int(channel)] = True
+                self.values[i, int(channel)] = max(0, min(255, value))
+        self.fades = np.array([step.get('fade', 0) for step in steps], dtype=float)
+        durations = self.fades + np.array([step.get('hold', 0) for step in steps], dtype=float)
+        self.ends = np.cumsum(durations)
+        self.starts = self.ends - durations
+        self.duration = self.ends[-1]
+        self.loop = loop and self.duration > 0
+        self.touched = self.masks.any(axis=0)
+        self.snap = np.zeros(UNIVERSE_SIZE, dtype=bool)
+        for channel in snap:
+            self.snap[int(channel)] = True
+
+    @classmethod
+    def from_settings(cls, scene, snap=()):
+        return cls(scene['steps'], loop=scene.get('loop', False), snap=snap)
+
+    def keyframes(self, start):
+        """Return the universe before each step and after the last."""
+        frames = [start]
+        for mask, values in zip(self.masks, self.values):
+            frames.append(np.where(mask, values, frames[-1]))
+        return np.array(frames)
+
+
+class Playback:
+    """A scene playing from `start`, a universe, since `started`."""
+
+    def __init__(self, scene, start, started):
+        self.scene = scene
+        self.started = started
+        self.keyframes = scene.keyframes(start)
+        # Later passes of a chase start from where the first pass ended.
+        self.loop_keyframes = scene.keyframes(self.keyframes[-1])
+
+    def frame(self, now):
+        """Return the universe at `now`, and whether the scene has finished."""
+        scene = self.scene
+        elapsed = max(0.0, now - self.started)
+        keyframes = self.keyframes
+        if elapsed >= scene.duration:
+            if not scene.loop:
+                return keyframes[-1], True
+            elapsed %= scene.duration
+            keyframes = self.loop_keyframes
+        step = min(int(np.searchsorted(scene.ends, elapsed, side='right')), len(scene.ends) - 1)
+        fade = scene.fades[step]
+        progress = 1.0 if fade <= 0 else min(1.0, (elapsed - scene.starts[step]) / fade)
+        origin, target = keyframes[step], keyframes[step + 1]
+        return np.where(scene.snap, target, origin + (target - origin) * progress), False
+
+
+class DMXController:
+    """Own the DMX port and render the universe at a fixed frame rate.
+
+    Cues start scenes, and channels can also be set directly until a scene
+    takes them over. Each frame computes the universe at that moment and
+    renders the channels that changed, so the port is written to at most
+    `fps` times a second by a single caller however many cues arrive. The
+    universe is also re-rendered every `refresh` seconds, and the port is
+    reopened after a failed write.
+    """
+
+    def __init__(self, path=None, fps=None, refresh=None, connection_class=None, scenes=None,
+                 cue_channels=None):
+        self.path = path or settings.DMX_PATH
+        self.fps = fps or settings.DMX_FPS
+        self.refresh = refresh or settings.DMX_REFRESH_SECONDS
+        self.connection_class = connection_class or import_string(settings.DMX_CONNECTION)
+        scenes = scenes or settings.DMX_SCENES
+        cue_channels = settings.DMX_CUE_CHANNELS if cue_channels is None else cue_channels
+        self.scenes = {event: Scene.from_settings(scene, snap=cue_channels) for event, scene in scenes.items()}
+        self.connection = None
+        self.base = np.zeros(UNIVERSE_SIZE)
+        self.playback = None
+        self.override_mask = np.zeros(UNIVERSE_SIZE, dtype=bool)
+        self.override_values = np.zeros(UNIVERSE_SIZE)
+        self.rendered = None
+        self.last_render = 0
+        self.last_event = None
+        self.frames = 0
+        self.errors = 0
+
+    def set(self, channel, value):
+        """Set a channel, numbered from 0, to a value from 0 to 255."""
+        self.override_mask[channel] = True
+        self.override_values[channel] = max(0, min(255, int(value)))
+
+    def cue(self, event, now=None):
+        if event not in self.scenes:
+            logger.warning('Unknown lighting event %s', event)
+            return
+        now = now or time.time()
+        scene = self.scenes[event]
+        start = self.universe(now)
+        self.override_mask &= ~scene.touched
+        self.playback = Playback(scene, start, now)
+        self.last_event = event
+
+    def apply(self, message):
+        if 'event' in message:
+            self.cue(message['event'])
+        for channel, value in message.get('channels', {}).items():
+            self.set(int(channel), value)
+
+    def universe(self, now):
+        """Return the universe at `now`, as floats."""
+        if self.playback is not None:
+            frame, finished = self.playback.frame(now)
+            if finished:
+                self.base = frame
+                self.playback = None
+        else:
+            frame = self.base
+        return np.where(self.override_mask, self.override_values, frame)
+
+    def compute(self, now):
+        """Return the DMX frame at `now`."""
+        return np.rint(np.clip(self.universe(now), 0, 255)).astype(np.uint8)
+
+    def status(self):
+        frame = self.compute(time.time())
+        return {'connected': self.connection is not None,
+                'last_event': self.last_event,
+                'playing': self.playback is not None,
+                'frames': self.frames,
+                'errors': self.errors,
+                'channels': {str(channel): int(frame[channel]) for channel in np.flatnonzero(frame)}}
+
+    def render_frame(self, now=None):
+        now = now or time.time()
+        frame = self.compute(now)
+        if self.rendered is not None and np.array_equal(frame, self.rendered) \
+                and now - self.last_render < self.refresh:
+            return False
+        if self.connection is None and not self.connect():
+            return False
+        if self.rendered is None:
+            changed = range(UNIVERSE_SIZE)
+        else:
+            changed = np.flatnonzero(frame != self.rendered)
+        try:
+            for channel in changed:
+                self.connection.setChannel(int(channel) + 1, int(frame[channel]))
+            self.connection.render()
+        except Exception:
+            logger.exception('Failed to render DMX frame')
+            self.errors += 1
+            self.close()
+            return False
+        self.rendered = frame
+        self.last_render = now
+        self.frames += 1
+        return True
+
+    def connect(self):
+        try:
+            self.connection = self.connection_class(self.path)
+        # pysimpledmx exits when it can't open the port.
+        except (Exception, SystemExit):
+            logger.exception('Failed to open DMX port %s', self.path)
+            self.errors += 1
+            return False
+        self.rendered = None
+        return True
+
+    def close(self):
+        if self.connection is not None:
+            try:
+                self.connection.close()
+            except Exception:
+                logger.exception('Failed to close DMX connection')
+        self.connection = None
+
+    def handle(self, sock, data, address):
+        try:
+            message = json.loads(data.decode())
+        except ValueError:
+            logger.warning('Ignoring malformed lighting message')
+            return
+        if message.get('status'):
+            sock.sendto(json.dumps(self.status()).encode(), address)
+        else:
+            self.apply(message)
+
+    def serve(self, sock):
+        """Read cues from `sock` and render frames, until interrupted."""
+        interval = 1 / self.fps
+        next_frame = time.time()
+        while True:
+            timeout = max(0, next_frame - time.time())
+            readable, _, _ = select.select([sock], [], [], timeout)
+            if readable:
+                data, address = sock.recvfrom(65536)
+                self.handle(sock, data, address)
+            if time.time() >= next_frame:
+                self.render_frame()
+                next_frame = max(next_frame + interval, time.time())
+
+
+def _address():
+    return settings.DMX_CONTROLLER_HOST, settings.DMX_CONTROLLER_PORT
+
+
+def send(message):
+    """Send a message to the DMX controller without waiting for it."""
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.sendto(json.dumps(message).encode(), _address())
+
+
+def send_cue(event):
+    send({'event': event})
+
+
+def get_status(timeout=0.5):
+    """Ask the DMX controller for its state, or return None if it doesn't answer."""
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.settimeout(timeout)
+        try:
+            sock.sendto(json.dumps({'status': True}).encode(), _address())
+            data, address = sock.recvfrom(65536)
+        except OSError:
+            return None
+    return json.loads(data.decode())
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from game.models import TeamDailyScore
+
+
+class Command(BaseCommand):
+    help = "Check team daily score totals against completed games."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fix', action='store_true',
+                            help='Rebuild the totals if they are inconsistent.')
+
+    def handle(self, *args, **options):
+        problems = list(TeamDailyScore.objects.inconsistencies())
+        for team_id, day, stored, expected in problems:
+            self.stdout.write('team {} on {}: stored {}, expected {}'.format(team_id, day, stored, expected))
+        if not problems:
+            self.stdout.write('Team daily scores are consistent.')
+        elif options['fix']:
+            TeamDailyScore.objects.rebuild()
+            self.stdout.write('Rebuilt team daily scores.')
+        else:
+            raise CommandError('{} inconsistent team daily scores.'.format(len(problems)))
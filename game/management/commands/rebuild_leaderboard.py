@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from game import leaderboard
+
+
+class Command(BaseCommand):
+    help = "Rebuild the player and team leaderboards from completed games."
+
+    def handle(self, *args, **options):
+        leaderboard.rebuild()
+        self.stdout.write('Rebuilt leaderboards.')
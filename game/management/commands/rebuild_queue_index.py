@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from game import queue_index
+
+
+class Command(BaseCommand):
+    help = "Rebuild the queue index from queued and active games."
+
+    def handle(self, *args, **options):
+        queue_index.rebuild()
+        self.stdout.write('Rebuilt queue index.')
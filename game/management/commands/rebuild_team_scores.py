@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from game.models import TeamDailyScore
+
+
+class Command(BaseCommand):
+    help = "Rebuild every team's daily score totals from completed games."
+
+    def handle(self, *args, **options):
+        TeamDailyScore.objects.rebuild()
+        count = TeamDailyScore.objects.count()
+        self.stdout.write('Rebuilt {} team daily scores.'.format(count))
@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from game.models import Team
+
+
+class Command(BaseCommand):
+    help = "Recount every team's members, used to balance new players across teams."
+
+    def handle(self, *args, **options):
+        Team.objects.recount()
+        for name, count in Team.objects.order_by('name').values_list('name', 'member_count'):
+            self.stdout.write('{}: {}'.format(name, count))
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from game import replication
+
+
+class Command(BaseCommand):
+    help = "Copy every write waiting in the outbox to the nuc database."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=None)
+        parser.add_argument('--reset-sequences', action='store_true',
+                            help="Move the nuc's id sequences past the ids created locally.")
+
+    def handle(self, *args, **options):
+        if not replication.enabled():
+            raise CommandError('DATABASE_WRITE_MODE is not local.')
+        count = replication.replicate_all(options['batch_size'])
+        self.stdout.write('Replicated {} outbox entries.'.format(count))
+        if options['reset_sequences']:
+            replication.reset_sequences()
+            self.stdout.write('Reset sequences.')
@@ -0,0 +1,28 @@
+import socket
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from game.lighting import DMXController
+
+
+class Command(BaseCommand):
+    help = "Run the DMX controller, which owns the DMX port and renders lighting cues."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--bind', default=settings.DMX_CONTROLLER_HOST,
+                            help='Address to listen for cues on, DMX_CONTROLLER_HOST by default.')
+
+    def handle(self, *args, **options):
+        controller = DMXController()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind((options['bind'], settings.DMX_CONTROLLER_PORT))
+        self.stdout.write('Listening for lighting cues on {}:{}'.format(options['bind'],
+                                                                       settings.DMX_CONTROLLER_PORT))
+        try:
+            controller.serve(sock)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            controller.close()
+            sock.close()
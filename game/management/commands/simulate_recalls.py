@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.module_loading import import_string
+
+from game.models import Game
+from game.simulation import RecallSimulation, historical_games
+
+
+class Command(BaseCommand):
+    help = "Replay queued games against recall policies and compare how busy the bay is."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--show', type=int, action='append', dest='shows',
+                            help='Replay the games of a show. Can be repeated.')
+        parser.add_argument('--policy', action='append', dest='policies',
+                            help='Dotted path of a recall policy. Can be repeated.')
+        parser.add_argument('--lanes', type=int, default=None)
+
+    def handle(self, *args, **options):
+        policies = options['policies'] or ['game.recall.FixedRecallPolicy',
+                                           'game.recall.AdaptiveRecallPolicy']
+        queryset = Game.objects.all()
+        if options['shows']:
+            queryset = queryset.filter(show_id__in=options['shows'])
+        games = historical_games(queryset)
+        if not games:
+            raise CommandError('No queued games to replay.')
+        self.stdout.write('Replaying {} games.'.format(len(games)))
+        for path in policies:
+            policy = import_string(path)()
+            result = RecallSimulation(games, policy, lanes=options['lanes']).run()
+            self.stdout.write(
+                '{}: played {}, no-shows {}, utilization {:.0%}, bay idle with players waiting {:.0f}s, '
+                'mean queue wait {:.0f}s, mean wait at the bay {:.0f}s'.format(
+                    path, result.played, result.no_shows, result.utilization, result.starved_seconds,
+                    result.mean_queue_wait, result.mean_bay_wait))
@@ -0,0 +1,23 @@
+import logging
+
+from redis import RedisError
+
+from .util import get_redis
+
+
+logger = logging.getLogger(__name__)
+
+COUNTERS_KEY = 'mlb:counters'
+
+
+def incr(name, amount=1):
+    """Increment a named counter. Counters are best effort."""
+    try:
+        get_redis().hincrby(COUNTERS_KEY, name, amount)
+    except RedisError:
+        logger.warning('Failed to increment counter %s', name, exc_info=True)
+
+
+def counters():
+    return {name.decode(): int(value)
+            for name, value in get_redis().hgetall(COUNTERS_KEY).items()}
@@ -1,3 +1,10 @@
+import time
+
+from django.conf import settings
+
+from . import router
+
+
 METHOD_OVERRIDE_HEADER = 'HTTP_X_HTTP_METHOD_OVERRIDE'
 
 
@@ -10,3 +17,43 @@ class MethodOverrideMiddleware:
         if request.method == 'POST' and request.META.get(METHOD_OVERRIDE_HEADER):
             request.method = request.META[METHOD_OVERRIDE_HEADER]
         return self.get_response(request)
+
+
+READ_PIN_COOKIE = 'read_pin'
+READ_PIN_HEADER = 'HTTP_X_READ_PIN'
+
+
+class ReadPinningMiddleware:
+    """Read from the database written to for a while after a client writes.
+
+    A request that writes is answered with a `read_pin` cookie and an
+    `X-Read-Pin` header holding the time until which the client's reads
+    should follow its writes. Clients that don't keep cookies can send the
+    header back instead. READ_PIN_SECONDS of 0 turns pinning off.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def pinned(self, request):
+        value = request.COOKIES.get(READ_PIN_COOKIE) or request.META.get(READ_PIN_HEADER)
+        try:
+            return float(value) > time.time()
+        except (TypeError, ValueError):
+            return False
+
+    def __call__(self, request):
+        if not settings.READ_PIN_SECONDS:
+            # Clear anything left on this thread while pinning was on.
+            router.end_request()
+            return self.get_response(request)
+        router.start_request(pinned=self.pinned(request))
+        try:
+            response = self.get_response(request)
+        finally:
+            wrote = router.end_request()
+        if wrote:
+            until = '{:.0f}'.format(time.time() + settings.READ_PIN_SECONDS)
+            response.set_cookie(READ_PIN_COOKIE, until, max_age=settings.READ_PIN_SECONDS)
+            response['X-Read-Pin'] = until
+        return response
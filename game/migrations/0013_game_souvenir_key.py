@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0012_auto_20180618_1325'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='game',
+            name='souvenir_key',
+            field=models.CharField(blank=True, db_index=True, default='', max_length=64),
+        ),
+    ]
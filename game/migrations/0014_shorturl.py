@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0013_game_souvenir_key'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ShortURL',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('long_url', models.URLField(max_length=1024, unique=True)),
+                ('short_url', models.URLField(blank=True, default='')),
+                ('date_created', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import Count, Sum
+from django.db.models.functions import Trunc
+import django.db.models.deletion
+
+
+def backfill_team_scores(apps, schema_editor):
+    Game = apps.get_model('game', 'Game')
+    TeamDailyScore = apps.get_model('game', 'TeamDailyScore')
+    query = Game.objects.filter(state='completed', user__team__isnull=False)\
+            .annotate(day=Trunc('date_created', 'day', output_field=models.DateField()))\
+            .values('user__team', 'day')\
+            .annotate(games=Count('pk'), score=Sum('score'),
+                      distance=Sum('distance'), homeruns=Sum('homeruns'))
+    TeamDailyScore.objects.bulk_create(
+        TeamDailyScore(team_id=row['user__team'], day=row['day'], games=row['games'],
+                       score=row['score'], distance=row['distance'], homeruns=row['homeruns'])
+        for row in query)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0014_shorturl'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TeamDailyScore',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('games', models.IntegerField(default=0)),
+                ('score', models.IntegerField(default=0)),
+                ('distance', models.IntegerField(default=0)),
+                ('homeruns', models.IntegerField(default=0)),
+                ('team', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_scores', to='game.Team')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='teamdailyscore',
+            unique_together=set([('team', 'day')]),
+        ),
+        migrations.RunPython(backfill_team_scores, migrations.RunPython.noop),
+    ]
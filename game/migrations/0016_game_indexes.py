@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+# Partial indexes for the recall loop. Django can't declare these on the
+# model, and they are postgres only.
+PARTIAL_INDEXES = [
+    ('game_queued_idx', 'date_created', "state = 'queued'"),
+    ('game_recalled_idx', 'date_updated', "state = 'recalled'"),
+]
+
+
+def create_partial_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for name, column, condition in PARTIAL_INDEXES:
+        schema_editor.execute('CREATE INDEX {} ON game_game ({}) WHERE {}'.format(name, column, condition))
+
+
+def drop_partial_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for name, column, condition in PARTIAL_INDEXES:
+        schema_editor.execute('DROP INDEX IF EXISTS {}'.format(name))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0015_teamdailyscore'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='game',
+            index=models.Index(fields=['state', 'date_created'], name='game_state_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='game',
+            index=models.Index(fields=['date_created'], name='game_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='game',
+            index=models.Index(fields=['date_updated'], name='game_updated_idx'),
+        ),
+        migrations.RunPython(create_partial_indexes, drop_partial_indexes),
+    ]
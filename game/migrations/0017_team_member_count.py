@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def backfill_member_counts(apps, schema_editor):
+    Team = apps.get_model('game', 'Team')
+    for team in Team.objects.annotate(members_count=Count('members')):
+        Team.objects.filter(pk=team.pk).update(member_count=team.members_count)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0016_game_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='team',
+            name='member_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_member_counts, migrations.RunPython.noop),
+    ]
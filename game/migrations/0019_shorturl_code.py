@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0018_outboxentry'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='shorturl',
+            name='code',
+            field=models.CharField(blank=True, max_length=32, null=True, unique=True),
+        ),
+    ]
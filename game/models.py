@@ -1,16 +1,84 @@
 import datetime
+from collections import namedtuple, defaultdict, OrderedDict
 
-from django.db import models
-from django.db.models import Count
+from django.db import models, router, transaction, IntegrityError
+from django.db.models import Case, Count, F, Sum, Value, When
 from django.db.models.functions import Trunc
 from django.conf import settings
-from django.contrib.auth.models import AbstractUser
+from django.contrib.auth.models import AbstractUser, UserManager as BaseUserManager
 from django.utils import timezone
 
-from django_fsm import FSMField, transition
+from django_fsm import FSMField, transition, can_proceed, ConcurrentTransition
 from phonenumber_field.modelfields import PhoneNumberField
 
-from .tasks import send_sms, render_souvenir, send_souvenir_sms
+from . import events, leaderboard, queue_index, replication
+from .util import advisory_lock
+from .recall import FixedRecallPolicy, get_recall_policy, measure_stats
+from .tasks import (send_sms, send_sms_batch, render_souvenir, render_souvenirs_batch,
+                    send_souvenir_sms, game_state_transition_hook, game_state_transition_hooks,
+                    schedule_recall)
+
+
+# Marks a value that hasn't been loaded from the database.
+UNKNOWN = object()
+
+
+class Score(namedtuple('Score', 'user_id team_id show_id day games score distance homeruns')):
+    """A contribution to team and player totals from completed games."""
+
+    def __neg__(self):
+        return self._replace(games=-self.games, score=-self.score,
+                             distance=-self.distance, homeruns=-self.homeruns)
+
+    @property
+    def totals(self):
+        return {'games': self.games, 'score': self.score,
+                'distance': self.distance, 'homeruns': self.homeruns}
+
+
+def apply_scores(scores, players=True, using=None):
+    """Add `scores` to team daily totals and, after commit, the leaderboards."""
+    db = using or router.db_for_write(TeamDailyScore)
+    for score in scores:
+        if score.team_id is not None:
+            TeamDailyScore.objects.using(db).add(score.team_id, score.day, **score.totals)
+    transaction.on_commit(lambda: leaderboard.record(scores, players=players), using=db)
+
+
+class ReplicatedQuerySet(models.QuerySet):
+    """Add rows written by bulk updates and inserts to the replication outbox.
+
+    Rows written by saves and deletes are added by signal receivers.
+    """
+
+    def update(self, **kwargs):
+        if not replication.enabled():
+            return super().update(**kwargs)
+        db = self._db or router.db_for_write(self.model, **self._hints)
+        with transaction.atomic(using=db):
+            pks = list(self.using(db).values_list('pk', flat=True))
+            rows = super().update(**kwargs)
+            replication.record(self.model, pks, using=db)
+        return rows
+    update.alters_data = True
+
+    def bulk_create(self, objs, batch_size=None):
+        objs = super().bulk_create(objs, batch_size)
+        if replication.enabled():
+            db = self._db or router.db_for_write(self.model, **self._hints)
+            replication.record(self.model, [obj.pk for obj in objs if obj.pk is not None], using=db)
+        return objs
+
+
+class UserManager(BaseUserManager.from_queryset(ReplicatedQuerySet)):
+    pass
+
+
+class OutboxEntry(models.Model):
+    """A row written locally that is waiting to be copied to the replica."""
+    model = models.CharField(max_length=100)
+    object_pk = models.CharField(max_length=64)
+    date_created = models.DateTimeField(auto_now_add=True)
 
 
 class Show(models.Model):
@@ -20,23 +88,123 @@ class Show(models.Model):
     recall_message = models.CharField(max_length=160)
     souvenir_message = models.CharField(max_length=130)
 
+    objects = ReplicatedQuerySet.as_manager()
+
+
+class TeamQuerySet(ReplicatedQuerySet):
+
+    def smallest(self):
+        """Return the team with the fewest members, locking every team.
+
+        The locks are held until the transaction commits, so concurrent
+        callers take turns and each sees the members the others added.
+        """
+        return min(self.select_for_update().order_by('pk'),
+                   key=lambda team: team.member_count, default=None)
+
+    def move_member(self, old_team_id, new_team_id):
+        if old_team_id is not None:
+            self.filter(pk=old_team_id).update(member_count=F('member_count') - 1)
+        if new_team_id is not None:
+            self.filter(pk=new_team_id).update(member_count=F('member_count') + 1)
+
+    def recount(self):
+        """Recount every team's members from its users."""
+        db = self._db or router.db_for_write(self.model)
+        counts = dict(User.objects.using(db).filter(team__isnull=False)
+                                  .values_list('team').annotate(Count('pk')))
+        queryset = self.using(db)
+        with transaction.atomic(using=db):
+            for team in queryset.select_for_update():
+                queryset.filter(pk=team.pk).update(member_count=counts.get(team.pk, 0))
+
 
 class Team(models.Model):
     name = models.CharField(max_length=128, unique=True)
+    member_count = models.IntegerField(default=0)
+
+    objects = TeamQuerySet.as_manager()
 
     def __str__(self):
         return self.name
 
     @property
     def scores(self):
-        query = Game.objects.filter(user__team=self, state='completed')\
+        rows = sorted(self.daily_scores.all(), key=lambda row: row.day)
+        return [{'day': row.day, 'score': row.score, 'distance': row.distance,
+                 'homeruns': row.homeruns}
+                for row in rows if row.games]
+
+
+class TeamDailyScoreQuerySet(ReplicatedQuerySet):
+
+    def add(self, team_id, day, games=1, score=0, distance=0, homeruns=0):
+        """Add to a team's totals for a day, creating the row if needed."""
+        totals = {'games': games, 'score': score, 'distance': distance, 'homeruns': homeruns}
+        increments = {name: F(name) + value for name, value in totals.items()}
+        if self.filter(team_id=team_id, day=day).update(**increments):
+            return
+        try:
+            with transaction.atomic(using=self._db or router.db_for_write(self.model)):
+                self.create(team_id=team_id, day=day, **totals)
+        except IntegrityError:
+            self.filter(team_id=team_id, day=day).update(**increments)
+
+    def expected(self):
+        """Compute every team's daily totals from completed games."""
+        query = Game.objects.filter(state='completed', user__team__isnull=False)\
                 .annotate(day=Trunc('date_created', 'day', output_field=models.DateField()))\
-                .values('day')\
-                .annotate(score=models.Sum('score'))\
-                .annotate(distance=models.Sum('distance'))\
-                .annotate(homeruns=models.Sum('homeruns'))\
-                .order_by('day')
-        return list(query)
+                .values('user__team', 'day')\
+                .annotate(games=Count('pk'), score=Sum('score'),
+                          distance=Sum('distance'), homeruns=Sum('homeruns'))
+        return {(row['user__team'], row['day']): row for row in query}
+
+    def rebuild(self):
+        db = self._db or router.db_for_write(self.model)
+        with transaction.atomic(using=db):
+            self.using(db).delete()
+            rows = [TeamDailyScore(team_id=team_id, day=day, games=row['games'],
+                                   score=row['score'], distance=row['distance'],
+                                   homeruns=row['homeruns'])
+                    for (team_id, day), row in self.expected().items()]
+            self.using(db).bulk_create(rows)
+
+    def inconsistencies(self):
+        """Yield (team_id, day, stored, expected) where the totals differ."""
+        fields = ('games', 'score', 'distance', 'homeruns')
+        expected = {key: tuple(row[f] for f in fields) for key, row in self.expected().items()}
+        stored = {(row.team_id, row.day): tuple(getattr(row, f) for f in fields)
+                  for row in self.all() if row.games}
+        for key in sorted(set(expected) | set(stored), key=str):
+            if expected.get(key) != stored.get(key):
+                yield key + (stored.get(key), expected.get(key))
+
+
+class TeamDailyScore(models.Model):
+    """A team's totals over its completed games for one day.
+
+    Rows are kept up to date as games are saved and players change team.
+    """
+    team = models.ForeignKey(Team, related_name='daily_scores', on_delete=models.CASCADE)
+    day = models.DateField()
+    games = models.IntegerField(default=0)
+    score = models.IntegerField(default=0)
+    distance = models.IntegerField(default=0)
+    homeruns = models.IntegerField(default=0)
+
+    objects = TeamDailyScoreQuerySet.as_manager()
+
+    class Meta:
+        unique_together = ('team', 'day')
+
+
+class ShortURL(models.Model):
+    long_url = models.URLField(max_length=1024, unique=True)
+    short_url = models.URLField(blank=True, default='')
+    code = models.CharField(max_length=32, unique=True, null=True, blank=True)
+    date_created = models.DateTimeField(auto_now_add=True)
+
+    objects = ReplicatedQuerySet.as_manager()
 
 
 class User(AbstractUser):
@@ -51,16 +219,93 @@ class User(AbstractUser):
                                   null=True, blank=True)
     signed_waiver = models.BooleanField(default=False)
 
+    objects = UserManager()
+
+    _loaded_team_id = UNKNOWN
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        if 'team_id' in field_names:
+            instance._loaded_team_id = instance.team_id
+        return instance
+
+    def save(self, *args, **kwargs):
+        db = kwargs.get('using') or router.db_for_write(User, instance=self)
+        with transaction.atomic(using=db):
+            adding = self._state.adding
+            previous_team_id = self._loaded_team_id
+            if not adding and previous_team_id is UNKNOWN:
+                previous_team_id = User.objects.using(db).filter(pk=self.pk)\
+                                               .values_list('team_id', flat=True).first()
+            if adding:
+                previous_team_id = None
+            super().save(*args, **kwargs)
+            update_fields = kwargs.get('update_fields')
+            if update_fields is not None and 'team' not in update_fields:
+                return
+            if previous_team_id != self.team_id:
+                Team.objects.using(db).move_member(previous_team_id, self.team_id)
+                if not adding:
+                    self._move_team_scores(previous_team_id, self.team_id, db)
+            self._loaded_team_id = self.team_id
+
+    def _move_team_scores(self, old_team_id, new_team_id, using):
+        completed = self.games.using(using).filter(state='completed')
+        # Players are first given a team when they confirm, usually before
+        # they have played, so skip the aggregate when there's nothing to move.
+        if old_team_id is None and not completed.exists():
+            return
+        query = completed.annotate(day=Trunc('date_created', 'day', output_field=models.DateField()))\
+                         .values('show_id', 'day')\
+                         .annotate(games=Count('pk'), score=Sum('score'),
+                                   distance=Sum('distance'), homeruns=Sum('homeruns'))
+        scores = []
+        for row in query:
+            if old_team_id is not None:
+                scores.append(-Score(user_id=self.pk, team_id=old_team_id, **row))
+            if new_team_id is not None:
+                scores.append(Score(user_id=self.pk, team_id=new_team_id, **row))
+        if scores:
+            apply_scores(scores, players=False, using=using)
+
     def send_welcome_sms(self):
         message = self.active_game.show.welcome_message
         send_sms.delay(self.mobile_number.as_e164, message)
 
-    def send_recall_sms(self):
+    def send_recall_sms(self, batch=None):
         message = self.active_game.show.recall_message
-        send_sms.delay(self.mobile_number.as_e164, message)
+        if batch is None:
+            send_sms.delay(self.mobile_number.as_e164, message)
+        else:
+            batch.append((self.mobile_number.as_e164, message))
+
+
+class TransitionBatch:
+    """Side effects of transitions applied together, sent once they commit."""
+
+    def __init__(self):
+        self.sms = []
+        self.souvenirs = []
+        self.hooks = defaultdict(list)
+        self.events = []
+        self.queue = []
+        self.recall = False
 
+    def send(self):
+        if self.sms:
+            send_sms_batch.delay(self.sms)
+        for i in range(0, len(self.souvenirs), settings.SOUVENIR_BATCH_SIZE):
+            render_souvenirs_batch.delay(self.souvenirs[i:i + settings.SOUVENIR_BATCH_SIZE])
+        for target, game_ids in self.hooks.items():
+            game_state_transition_hooks.delay(game_ids, target)
+        events.publish(self.events)
+        queue_index.record(self.queue)
+        if self.recall:
+            schedule_recall()
 
-class GameQuerySet(models.QuerySet):
+
+class GameQuerySet(ReplicatedQuerySet):
 
     def active_recalls(self, recall_expire=None, now=None):
         now = now or timezone.now()
@@ -69,14 +314,116 @@ class GameQuerySet(models.QuerySet):
         query = self.filter(state='recalled', date_updated__gt=expire_time)
         return query
 
+    def recall_window(self, max_recalls=None):
+        """Return how many more games to recall, from the recall policy.
+
+        `max_recalls` fixes the window size instead.
+        """
+        policy = get_recall_policy() if max_recalls is None else FixedRecallPolicy(max_recalls)
+        stats = measure_stats(self) if policy.needs_stats else None
+        return max(policy.window_size(stats) - self.active_recalls().count(), 0)
+
     def next_recalls(self, max_recalls=None):
-        max_recalls = max_recalls or settings.RECALL_WINDOW_SIZE
-        size = max(max_recalls - self.active_recalls().count(), 0)
+        size = self.recall_window(max_recalls)
         query = self.order_by('date_created')\
                     .filter(state='queued')\
                     .exclude(user__mobile_number='')
         return query[:size]
 
+    def recall_next(self, max_recalls=None):
+        """Recall the next queued games, sending their sms as one batch.
+
+        Schedulers take turns under an advisory lock, so the window is
+        counted and filled by one of them at a time, and the queued rows are
+        claimed with SKIP LOCKED. Games are recalled with a single update and
+        the sms and hooks are only sent once the transaction commits.
+        """
+        db = router.db_for_write(self.model)
+        queryset = self.using(db)
+        with transaction.atomic(using=db):
+            advisory_lock('recall', using=db)
+            size = queryset.recall_window(max_recalls)
+            if not size:
+                return []
+            with_mobile = User.objects.using(db).exclude(mobile_number='').values('pk')
+            ids = list(queryset.filter(state='queued', user_id__in=with_mobile)
+                               .order_by('date_created')
+                               .select_for_update(skip_locked=True)
+                               .values_list('pk', flat=True)[:size])
+            if not ids:
+                return []
+            now = timezone.now()
+            recalled = queryset.filter(pk__in=ids)
+            recalled.update(state='recalled', date_updated=now)
+            recalled.filter(date_recalled=None).update(date_recalled=now)
+            games = list(recalled.select_related('user__active_game__show').order_by('date_created'))
+            messages = []
+            recalls = []
+            changes = []
+            for game in games:
+                game.user.send_recall_sms(batch=messages)
+                recalls.append(events.transition_event(game, 'queued', 'recalled'))
+                changes.append(queue_index.change(game, 'recalled'))
+            transaction.on_commit(lambda: self._send_recalls(ids, messages, recalls, changes), using=db)
+        return games
+
+    def bulk_perform(self, target, kwargs_by_id):
+        """Move many games to `target` with one update.
+
+        `kwargs_by_id` maps game ids to the arguments of the transition. The
+        games are locked until the transaction commits, and their side
+        effects are collected in a TransitionBatch. Returns a dict of each
+        id to either its transitioned game or an error message.
+        """
+        name = Game.TRANSITIONS[target]
+        db = router.db_for_write(self.model)
+        queryset = self.using(db)
+        results = OrderedDict((pk, 'Not found') for pk in kwargs_by_id)
+        batch = TransitionBatch()
+        with transaction.atomic(using=db):
+            ids = list(queryset.filter(pk__in=kwargs_by_id).select_for_update().values_list('pk', flat=True))
+            games = queryset.filter(pk__in=ids)\
+                            .select_related('user__team', 'user__active_game__show', 'show')\
+                            .order_by('pk')
+            fields = ['date_{}'.format(target)] + list(Game.TRANSITION_FIELDS.get(name, ()))
+            performed = []
+            scores = []
+            for game in games:
+                method = getattr(game, name)
+                if not can_proceed(method):
+                    results[game.pk] = 'Illegal state change {} -> {}'.format(game.state, target)
+                    continue
+                previous = game._previous_scored_values(using=db)
+                game._transition_batch = batch
+                try:
+                    method(**kwargs_by_id[game.pk])
+                finally:
+                    game._transition_batch = None
+                scores.extend(game.score_changes(previous, ['state'] + fields))
+                performed.append(game)
+                results[game.pk] = game
+            if performed:
+                now = timezone.now()
+                values = {'state': target, 'date_updated': now}
+                for field in fields:
+                    whens = [When(pk=game.pk, then=Value(getattr(game, field))) for game in performed]
+                    values[field] = Case(*whens, output_field=Game._meta.get_field(field))
+                queryset.filter(pk__in=[game.pk for game in performed]).update(**values)
+                for game in performed:
+                    game.date_updated = now
+                if scores:
+                    apply_scores(scores, using=db)
+                transaction.on_commit(batch.send, using=db)
+        return results
+
+    def _send_recalls(self, ids, messages, recalls, changes):
+        if messages:
+            send_sms_batch.delay(messages)
+        for pk in ids:
+            game_state_transition_hook.delay(pk, 'recalled')
+        events.publish(recalls)
+        queue_index.record(changes)
+
 
 class Game(models.Model):
     user = models.ForeignKey(User, related_name='games')
@@ -94,9 +441,120 @@ class Game(models.Model):
     score = models.IntegerField(default=0)
     state = FSMField(default='new')
     souvenir_image = models.ImageField(upload_to='souvenirs/', null=True, blank=True)
+    souvenir_key = models.CharField(max_length=64, blank=True, default='', db_index=True)
 
     objects = GameQuerySet.as_manager()
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['state', 'date_created'], name='game_state_created_idx'),
+            models.Index(fields=['date_created'], name='game_created_idx'),
+            models.Index(fields=['date_updated'], name='game_updated_idx'),
+        ]
+
+    SCORED_FIELDS = ('state', 'score', 'distance', 'homeruns', 'date_created', 'user_id', 'show_id')
+
+    _scored_values = None
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        if all(field in instance.__dict__ for field in cls.SCORED_FIELDS):
+            instance._scored_values = {f: getattr(instance, f) for f in cls.SCORED_FIELDS}
+        return instance
+
+    # Transition names by target state.
+    TRANSITIONS = OrderedDict([('queued', 'queue'), ('recalled', 'recall'), ('confirmed', 'confirm'),
+                               ('playing', 'play'), ('completed', 'complete'), ('cancelled', 'cancel')])
+
+    # Fields a transition sets besides the state and its timestamp.
+    TRANSITION_FIELDS = {'complete': ('score', 'distance', 'homeruns')}
+
+    # Collects side effects while a transition runs as part of a bulk update.
+    _transition_batch = None
+
+    def _previous_scored_values(self, using=None):
+        if self._scored_values is None and not self._state.adding:
+            query = Game.objects.using(using) if using else Game.objects
+            return query.filter(pk=self.pk).values(*self.SCORED_FIELDS).first()
+        return self._scored_values
+
+    def save(self, *args, **kwargs):
+        db = kwargs.get('using') or router.db_for_write(Game, instance=self)
+        with transaction.atomic(using=db):
+            previous = self._previous_scored_values(db)
+            super().save(*args, **kwargs)
+            self.record_scores(previous, kwargs.get('update_fields'), using=db)
+
+    def perform(self, name, **kwargs):
+        """Run the transition `name` and save it in a single update.
+
+        The update only applies while the row is still in the state the
+        transition started from, so when transitions race only one of them
+        is saved and the others raise ConcurrentTransition. Side effects of
+        transitions wait for the transaction to commit.
+        """
+        source = self.state
+        db = router.db_for_write(Game, instance=self)
+        with transaction.atomic(using=db):
+            previous = self._previous_scored_values(using=db)
+            getattr(self, name)(**kwargs)
+            self.date_updated = timezone.now()
+            fields = ['state', 'date_updated', 'date_{}'.format(self.state)]
+            fields.extend(self.TRANSITION_FIELDS.get(name, ()))
+            values = {field: getattr(self, field) for field in fields if hasattr(self, field)}
+            updated = Game.objects.using(db).filter(pk=self.pk, state=source).update(**values)
+            if not updated:
+                self.state = source
+                raise ConcurrentTransition('Game {} is no longer {}'.format(self.pk, source))
+            self.record_scores(previous, list(values), using=db)
+
+    def record_scores(self, previous, update_fields=None, using=None):
+        """Update score totals for the change from `previous` values to this game."""
+        scores = self.score_changes(previous, update_fields)
+        if scores:
+            apply_scores(scores, using=using)
+
+    def remove_scores(self, using=None):
+        """Take a deleted game's last saved values out of the score totals."""
+        values = self._scored_values or {f: getattr(self, f) for f in self.SCORED_FIELDS}
+        score = self._score(values)
+        if score is not None:
+            apply_scores([-score], using=using)
+
+    def score_changes(self, previous, update_fields=None):
+        """Return the Scores to apply for the change from `previous` values."""
+        current = {}
+        for field in self.SCORED_FIELDS:
+            name = field[:-3] if field.endswith('_id') else field
+            if previous is None or update_fields is None or name in update_fields:
+                current[field] = getattr(self, field)
+            else:
+                current[field] = previous[field]
+        old = self._score(previous)
+        new = self._score(current)
+        self._scored_values = current
+        if old == new:
+            return []
+        scores = []
+        if old is not None:
+            scores.append(-old)
+        if new is not None:
+            scores.append(new)
+        return scores
+
+    def _score(self, values):
+        if values is None or values['state'] != 'completed':
+            return None
+        if values['user_id'] == self.user_id:
+            team_id = self.user.team_id
+        else:
+            team_id = User.objects.filter(pk=values['user_id']).values_list('team_id', flat=True).first()
+        day = timezone.localtime(values['date_created']).date()
+        return Score(user_id=values['user_id'], team_id=team_id, show_id=values['show_id'],
+                     day=day, games=1, score=values['score'], distance=values['distance'],
+                     homeruns=values['homeruns'])
+
     @transition(field=state, source=['recalled', 'new'], target='queued')
     def queue(self):
         pass
@@ -104,14 +562,19 @@ class Game(models.Model):
     @transition(field=state, source=['new', 'queued', 'recalled'], target='confirmed')
     def confirm(self):
         if not self.user.team:
-            query = Team.objects.annotate(member_count=Count('members')).order_by('member_count')
-            self.user.team = query[0]
-            self.user.save()
+            db = router.db_for_write(Team)
+            with transaction.atomic(using=db):
+                self.user.team = Team.objects.using(db).smallest()
+                self.user.save(using=db)
 
     @transition(field=state, source='queued', target='recalled')
     def recall(self):
-        if self.user.mobile_number:
-            self.user.send_recall_sms()
+        if not self.user.mobile_number:
+            return
+        if self._transition_batch is None:
+            transaction.on_commit(self.user.send_recall_sms, using=router.db_for_write(Game, instance=self))
+        else:
+            self.user.send_recall_sms(batch=self._transition_batch.sms)
 
     @transition(field=state, source='confirmed', target='playing')
     def play(self):
@@ -122,10 +585,14 @@ class Game(models.Model):
         self.score = score
         self.distance = distance
         self.homeruns = homeruns
-        if self.user.mobile_number:
+        if not self.user.mobile_number:
+            return
+        if self._transition_batch is None:
             s = render_souvenir.s(self.pk)
             s.link(send_souvenir_sms.s())
-            s.delay()
+            transaction.on_commit(s.delay, using=router.db_for_write(Game, instance=self))
+        else:
+            self._transition_batch.souvenirs.append(self.pk)
 
     @transition(field=state, source='*', target='cancelled')
     def cancel(self):
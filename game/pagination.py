@@ -0,0 +1,124 @@
+import json
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db.models import F, Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import Cursor, CursorPagination
+
+
+class OrderedCursorPagination(CursorPagination):
+    """Cursor pagination over the view's ordering.
+
+    Pages are ordered by the first ordering field and then the primary key,
+    and each cursor holds both values of the row it continues from, so
+    pages are stable when many rows share a score or timestamp. Rows where
+    the field is null come last. Ordering fields may span relations, e.g.
+    `active_game__date_updated`.
+    """
+
+    page_size_query_param = 'page_size'
+
+    def get_page_size(self, request):
+        page_size = settings.API_PAGE_SIZE
+        if self.page_size_query_param in request.query_params:
+            try:
+                page_size = int(request.query_params[self.page_size_query_param])
+            except ValueError:
+                pass
+            else:
+                page_size = min(max(page_size, 1), settings.API_MAX_PAGE_SIZE)
+        return page_size
+
+    def get_ordering(self, request, queryset, view):
+        ordering = tuple(super().get_ordering(request, queryset, view))
+        field = ordering[0]
+        if field.lstrip('-') in ('pk', 'id'):
+            return (field,)
+        return (field, '-pk' if field.startswith('-') else 'pk')
+
+    def _order_by(self, reverse):
+        # Nulls come last, so a reversed page starts with them.
+        nulls = {'nulls_first': True} if reverse else {'nulls_last': True}
+        expressions = []
+        for field in self.ordering:
+            expression = F(field.lstrip('-'))
+            if field.startswith('-') != reverse:
+                expressions.append(expression.desc(**nulls))
+            else:
+                expressions.append(expression.asc(**nulls))
+        return expressions
+
+    def _after(self, position, reverse):
+        """Filter for the rows that come after `position`, or before it if `reverse`."""
+        value, pk = json.loads(position)
+        if len(self.ordering) == 1:
+            field = self.ordering[0]
+            lookup = 'lt' if field.startswith('-') != reverse else 'gt'
+            return Q(**{'pk__' + lookup: pk})
+        field, pk_field = self.ordering
+        name = field.lstrip('-')
+        lookup = 'lt' if field.startswith('-') != reverse else 'gt'
+        pk_lookup = 'lt' if pk_field.startswith('-') != reverse else 'gt'
+        if value is None:
+            after = Q(**{name + '__isnull': True, 'pk__' + pk_lookup: pk})
+            # Nulls come last, so going back from one passes every other row.
+            return after | Q(**{name + '__isnull': False}) if reverse else after
+        after = Q(**{name + '__' + lookup: value}) | Q(**{name: value, 'pk__' + pk_lookup: pk})
+        return after if reverse else after | Q(**{name + '__isnull': True})
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.page_size = self.get_page_size(request)
+        self.base_url = request.build_absolute_uri()
+        self.ordering = self.get_ordering(request, queryset, view)
+        self.cursor = self.decode_cursor(request)
+        if self.cursor is None:
+            reverse, current_position = False, None
+        else:
+            reverse, current_position = self.cursor.reverse, self.cursor.position
+        queryset = queryset.order_by(*self._order_by(reverse))
+        if current_position is not None:
+            try:
+                queryset = queryset.filter(self._after(current_position, reverse))
+            except (TypeError, ValueError, ValidationError):
+                raise NotFound(self.invalid_cursor_message)
+        results = list(queryset[:self.page_size + 1])
+        self.page = results[:self.page_size]
+        if len(results) > len(self.page):
+            following_position = self._get_position_from_instance(self.page[-1], self.ordering)
+        else:
+            following_position = None
+        if reverse:
+            self.page = list(reversed(self.page))
+            self.has_next = current_position is not None
+            self.has_previous = following_position is not None
+            self.next_position = current_position
+            self.previous_position = following_position
+        else:
+            self.has_next = following_position is not None
+            self.has_previous = current_position is not None
+            self.next_position = following_position
+            self.previous_position = current_position
+        if (self.has_previous or self.has_next) and self.template is not None:
+            self.display_page_controls = True
+        return self.page
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        position = self._get_position_from_instance(self.page[-1], self.ordering)
+        return self.encode_cursor(Cursor(offset=0, reverse=False, position=position))
+
+    def get_previous_link(self):
+        if not self.has_previous:
+            return None
+        position = self._get_position_from_instance(self.page[0], self.ordering)
+        return self.encode_cursor(Cursor(offset=0, reverse=True, position=position))
+
+    def _get_position_from_instance(self, instance, ordering):
+        value = instance
+        for attr in ordering[0].lstrip('-').split('__'):
+            value = getattr(value, attr, None)
+        if value is not None and not isinstance(value, (int, float)):
+            value = str(value)
+        return json.dumps([value, instance.pk])
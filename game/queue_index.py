@@ -0,0 +1,118 @@
+import logging
+from collections import namedtuple
+
+from django.conf import settings
+from redis import RedisError
+
+from .util import get_redis
+
+
+logger = logging.getLogger(__name__)
+
+QUEUED_KEY = 'queue:queued'
+ACTIVE_KEY = 'queue:active'
+DURATIONS_KEY = 'queue:durations'
+
+# Games at the cage, ahead of everyone still queued.
+ACTIVE_STATES = ('confirmed', 'playing')
+
+Change = namedtuple('Change', ['game_id', 'state', 'created', 'duration'])
+
+
+def change(game, target):
+    """Describe how a game's transition to `target` changes the queue."""
+    duration = None
+    if target == 'completed' and game.date_playing and game.date_completed:
+        duration = (game.date_completed - game.date_playing).total_seconds()
+    return Change(game.pk, target, game.date_created.timestamp(), duration)
+
+
+def _apply(pipe, changes):
+    for c in changes:
+        pipe.zrem(QUEUED_KEY, c.game_id)
+        pipe.zrem(ACTIVE_KEY, c.game_id)
+        if c.state == 'queued':
+            pipe.zadd(QUEUED_KEY, c.created, c.game_id)
+        elif c.state in ACTIVE_STATES:
+            pipe.zadd(ACTIVE_KEY, c.created, c.game_id)
+        if c.duration is not None:
+            pipe.lpush(DURATIONS_KEY, c.duration)
+    pipe.ltrim(DURATIONS_KEY, 0, settings.QUEUE_DURATION_SAMPLES - 1)
+
+
+def record(changes):
+    """Apply `changes` to the queue index.
+
+    The index is best effort. If redis is unavailable it can be recomputed
+    from the games with `rebuild`.
+    """
+    if not changes:
+        return
+    try:
+        pipe = get_redis().pipeline()
+        _apply(pipe, changes)
+        pipe.execute()
+    except RedisError:
+        logger.exception('Failed to update the queue index')
+
+
+def rebuild():
+    from .models import Game
+    games = Game.objects.filter(state__in=('queued',) + ACTIVE_STATES)\
+                        .values_list('pk', 'state', 'date_created')
+    changes = [Change(pk, state, created.timestamp(), None) for pk, state, created in games]
+    played = Game.objects.filter(state='completed', date_playing__isnull=False,
+                                 date_completed__isnull=False)\
+                         .order_by('-date_completed')\
+                         .values_list('date_playing', 'date_completed')[:settings.QUEUE_DURATION_SAMPLES]
+    pipe = get_redis().pipeline()
+    pipe.delete(QUEUED_KEY, ACTIVE_KEY, DURATIONS_KEY)
+    for playing, completed in played:
+        pipe.rpush(DURATIONS_KEY, (completed - playing).total_seconds())
+    _apply(pipe, changes)
+    pipe.execute()
+
+
+def average_play_seconds(durations):
+    if not durations:
+        return settings.QUEUE_DEFAULT_PLAY_SECONDS
+    return sum(float(d) for d in durations) / len(durations)
+
+
+def estimated_wait(ahead, average):
+    return ahead * average / settings.QUEUE_LANES
+
+
+def _stats(pipe):
+    pipe.zcard(QUEUED_KEY)
+    pipe.zcard(ACTIVE_KEY)
+    pipe.lrange(DURATIONS_KEY, 0, -1)
+
+
+def position(game_id):
+    """Return where a queued game is in the queue, or None if it isn't queued.
+
+    Games at the cage and queued games created earlier are ahead of it, and
+    each is expected to take the average of the recent play durations.
+    """
+    pipe = get_redis().pipeline()
+    pipe.zrank(QUEUED_KEY, game_id)
+    _stats(pipe)
+    rank, queued, active, durations = pipe.execute()
+    if rank is None:
+        return None
+    average = average_play_seconds(durations)
+    ahead = rank + active
+    return {'position': rank + 1, 'ahead': ahead,
+            'estimated_wait': estimated_wait(ahead, average)}
+
+
+def summary():
+    """Return the size of the queue and the wait for a game queued now."""
+    pipe = get_redis().pipeline()
+    _stats(pipe)
+    queued, active, durations = pipe.execute()
+    average = average_play_seconds(durations)
+    return {'queued': queued, 'active': active,
+            'average_play_seconds': average,
+            'estimated_wait': estimated_wait(queued + active, average)}
@@ -0,0 +1,108 @@
+import math
+import datetime
+from collections import namedtuple
+
+from django.conf import settings
+from django.db.models import Count
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+
+RecallStats = namedtuple('RecallStats', ['playing', 'confirmed', 'recalled', 'overdue', 'play_seconds',
+                                         'confirm_seconds', 'no_show_rate'])
+
+# Recalled players who haven't confirmed after this many times the usual
+# delay are probably not coming.
+OVERDUE_FACTOR = 2
+
+
+def _mean(values, default):
+    values = list(values)
+    return sum(values) / len(values) if values else default
+
+
+def measure_stats(queryset, now=None):
+    """Return RecallStats for the games in `queryset`, measured over the last
+    RECALL_STATS_MINUTES.
+
+    Durations fall back to QUEUE_DEFAULT_PLAY_SECONDS and
+    RECALL_DEFAULT_CONFIRM_SECONDS until there are games to measure.
+    """
+    now = now or timezone.now()
+    expire = datetime.timedelta(minutes=settings.RECALL_WINDOW_MINUTES)
+    since = now - datetime.timedelta(minutes=settings.RECALL_STATS_MINUTES)
+    counts = dict(queryset.filter(state__in=('playing', 'confirmed'))
+                          .order_by().values_list('state').annotate(Count('pk')))
+    active = queryset.active_recalls(now=now)
+    # Every transition sets date_updated, so it bounds the recent games by index.
+    recent = queryset.filter(date_updated__gt=since)
+    played = recent.filter(date_completed__gt=since, date_playing__isnull=False)\
+                   .order_by('-date_completed')\
+                   .values_list('date_playing', 'date_completed')[:settings.RECALL_STATS_SAMPLES]
+    confirmed = recent.filter(date_confirmed__gt=since, date_recalled__isnull=False)\
+                      .order_by('-date_confirmed')\
+                      .values_list('date_recalled', 'date_confirmed')[:settings.RECALL_STATS_SAMPLES]
+    # Only recalls whose window has closed can have been no-shows.
+    resolved = queryset.filter(date_updated__gt=since - expire,
+                               date_recalled__gt=since - expire, date_recalled__lte=now - expire)\
+                       .order_by('-date_recalled')\
+                       .values_list('date_recalled', 'date_confirmed')[:settings.RECALL_STATS_SAMPLES]
+    no_shows = [confirmed_at is None or confirmed_at - recalled_at > expire
+                for recalled_at, confirmed_at in resolved]
+    confirm_seconds = _mean(((end - start).total_seconds() for start, end in confirmed if end >= start),
+                            settings.RECALL_DEFAULT_CONFIRM_SECONDS)
+    overdue_time = now - datetime.timedelta(seconds=confirm_seconds * OVERDUE_FACTOR)
+    return RecallStats(
+        playing=counts.get('playing', 0),
+        confirmed=counts.get('confirmed', 0),
+        recalled=active.count(),
+        overdue=active.filter(date_updated__lt=overdue_time).count(),
+        play_seconds=_mean(((end - start).total_seconds() for start, end in played),
+                           settings.QUEUE_DEFAULT_PLAY_SECONDS),
+        confirm_seconds=confirm_seconds,
+        no_show_rate=_mean(no_shows, 0.0))
+
+
+class FixedRecallPolicy:
+    """Keep RECALL_WINDOW_SIZE players recalled at a time."""
+
+    needs_stats = False
+
+    def __init__(self, size=None):
+        self.size = size
+
+    def window_size(self, stats):
+        return self.size or settings.RECALL_WINDOW_SIZE
+
+
+class AdaptiveRecallPolicy:
+    """Recall enough players to reach the bay as it frees up.
+
+    A recalled player takes `confirm_seconds` to arrive, in which time the
+    bay finishes `lanes * confirm_seconds / play_seconds` games, and any
+    idle lanes need a player straight away. Players already confirmed are
+    waiting to play, and the rest is scaled up by the no-show rate. Overdue
+    recalls are left out of the window, so no-shows don't hold up the
+    players behind them until their recall expires.
+    """
+
+    needs_stats = True
+    max_no_show_rate = 0.9
+
+    def __init__(self, lanes=None, minimum=None, maximum=None):
+        self.lanes = lanes or settings.QUEUE_LANES
+        self.minimum = settings.RECALL_WINDOW_MIN if minimum is None else minimum
+        self.maximum = maximum or settings.RECALL_WINDOW_MAX
+
+    def window_size(self, stats):
+        finishing = self.lanes * stats.confirm_seconds / max(stats.play_seconds, 1)
+        idle = self.lanes - stats.playing
+        needed = max(finishing, idle) - stats.confirmed
+        no_show_rate = min(stats.no_show_rate, self.max_no_show_rate)
+        size = math.ceil(round(max(needed, 0) / (1 - no_show_rate), 6))
+        return max(self.minimum, min(self.maximum, size)) + stats.overdue
+
+
+def get_recall_policy():
+    """Return the recall policy configured by RECALL_POLICY."""
+    return import_string(settings.RECALL_POLICY)()
@@ -0,0 +1,338 @@
+import os
+import json
+import asyncio
+import hashlib
+import logging
+from io import BytesIO
+from functools import lru_cache
+
+from django.conf import settings
+from django.contrib.staticfiles import finders
+from django.urls import reverse
+from django.utils.module_loading import import_string
+from celery.signals import worker_process_shutdown
+from pyppeteer import launch
+from PIL import Image, ImageChops, ImageDraw, ImageFont
+import cairosvg
+
+
+logger = logging.getLogger(__name__)
+
+SOUVENIR_SIZE = (1080, 1080)
+
+
+class PooledBrowser:
+    """A headless browser and the pages it keeps open between renders."""
+
+    def __init__(self, browser, pages):
+        self.browser = browser
+        self.pages = pages
+        self.renders = 0
+        self.leased = 0
+        self.retired = False
+
+
+class BrowserPool:
+    """A pool of warm headless browsers, each with reusable pages.
+
+    Pages are leased one render at a time. A browser is recycled once it
+    has rendered `max_renders` pages, or as soon as one of its pages fails a
+    health check or a render. At most `concurrency` renders run at once.
+    """
+
+    def __init__(self, size=1, pages=1, max_renders=100, concurrency=1,
+                 health_timeout=5):
+        self.size = size
+        self.pages = pages
+        self.max_renders = max_renders
+        self.concurrency = concurrency
+        self.health_timeout = health_timeout
+        self.loop = asyncio.get_event_loop()
+        self._browsers = []
+        self._slots = None
+        self._semaphore = None
+
+    async def start(self):
+        if self._slots is not None:
+            return
+        # Bind both to the pool's loop, which render() runs every screenshot on,
+        # so the concurrency limit holds across calls.
+        self._slots = asyncio.Queue(loop=self.loop)
+        self._semaphore = asyncio.Semaphore(self.concurrency, loop=self.loop)
+        for i in range(self.size):
+            await self._launch()
+
+    async def _launch(self):
+        browser = await launch(args=['--no-sandbox'])
+        pages = []
+        for i in range(self.pages):
+            page = await browser.newPage()
+            await page.setViewport({'width': SOUVENIR_SIZE[0], 'height': SOUVENIR_SIZE[1]})
+            pages.append(page)
+        pooled = PooledBrowser(browser, pages)
+        self._browsers.append(pooled)
+        for page in pages:
+            self._slots.put_nowait((pooled, page))
+        return pooled
+
+    async def _close(self, pooled):
+        try:
+            await pooled.browser.close()
+        except Exception:
+            logger.exception('Failed to close browser')
+
+    async def _healthy(self, page):
+        try:
+            await asyncio.wait_for(page.evaluate('1'), self.health_timeout)
+        except Exception:
+            return False
+        return True
+
+    async def _retire(self, pooled):
+        if pooled.retired:
+            return
+        pooled.retired = True
+        self._browsers.remove(pooled)
+        await self._launch()
+        if not pooled.leased:
+            await self._close(pooled)
+
+    async def _acquire(self):
+        while True:
+            pooled, page = await self._slots.get()
+            if pooled.retired:
+                continue
+            pooled.leased += 1
+            if await self._healthy(page):
+                return pooled, page
+            logger.warning('Recycling unresponsive browser')
+            await self._retire(pooled)
+            await self._release(pooled, page)
+
+    async def _release(self, pooled, page):
+        pooled.leased -= 1
+        if not pooled.retired:
+            self._slots.put_nowait((pooled, page))
+        elif not pooled.leased:
+            await self._close(pooled)
+
+    async def screenshot(self, url):
+        await self.start()
+        async with self._semaphore:
+            pooled, page = await self._acquire()
+            try:
+                await page.goto(url, waitUntil=['load', 'networkidle0'])
+                data = await page.screenshot()
+            except Exception:
+                await self._retire(pooled)
+                raise
+            else:
+                pooled.renders += 1
+                if pooled.renders >= self.max_renders:
+                    await self._retire(pooled)
+            finally:
+                await self._release(pooled, page)
+        return data
+
+    def render(self, url):
+        return self.loop.run_until_complete(self.screenshot(url))
+
+    def close(self):
+        browsers, self._browsers = self._browsers, []
+        for pooled in browsers:
+            pooled.retired = True
+            self.loop.run_until_complete(self._close(pooled))
+        self._slots = None
+
+
+_browser_pool = None
+
+
+def get_browser_pool():
+    """Return this worker process's browser pool, starting it if needed."""
+    global _browser_pool
+    if _browser_pool is None:
+        _browser_pool = BrowserPool(size=settings.SOUVENIR_BROWSERS,
+                                    pages=settings.SOUVENIR_BROWSER_PAGES,
+                                    max_renders=settings.SOUVENIR_BROWSER_MAX_RENDERS,
+                                    concurrency=settings.SOUVENIR_RENDER_CONCURRENCY)
+    return _browser_pool
+
+
+@worker_process_shutdown.connect
+def close_browser_pool(**kwargs):
+    global _browser_pool
+    if _browser_pool is not None:
+        _browser_pool.close()
+        _browser_pool = None
+
+
+class BrowserRenderer:
+    """Screenshot the souvenir page through the worker's browser pool."""
+
+    def url(self, game):
+        path = reverse('game-souvenir', args=(game.pk,))
+        return "http://{}{}".format(settings.DJANGO_HOST, path)
+
+    def render(self, game):
+        return get_browser_pool().render(self.url(game))
+
+    def render_many(self, games):
+        pool = get_browser_pool()
+        screenshots = asyncio.gather(*[pool.screenshot(self.url(game)) for game in games],
+                                     loop=pool.loop, return_exceptions=True)
+        return pool.loop.run_until_complete(screenshots)
+
+
+@lru_cache()
+def _font(size):
+    return ImageFont.truetype(finders.find('souvenir/fonts/alt-gothic-bold.otf'), size)
+
+
+@lru_cache()
+def _frame():
+    return Image.open(finders.find('souvenir/images/frame.png')).convert('RGBA')
+
+
+@lru_cache()
+def _logo(team, width):
+    path = finders.find('souvenir/images/{}-logo-white.svg'.format(team))
+    if path is None:
+        return None
+    data = cairosvg.svg2png(url=path, output_width=width)
+    return Image.open(BytesIO(data)).convert('RGBA')
+
+
+class PillowRenderer:
+    """Composite the souvenir directly with Pillow, without a browser.
+
+    This draws the same layout as `souvenir.html`: the player's photo in
+    grayscale, tinted with the team colour, under the frame, with the name,
+    scorebar and team logo on top.
+    """
+
+    team_colors = {'la': (0x86, 0xd1, 0xf2),
+                   'boston': (0xc7, 0x10, 0x33)}
+    default_color = (0, 0, 0)
+    name_position = (68, 150)
+    name_font_size = 90
+    name_line_height = 100
+    scorebar_position = (60, 50)
+    scorebar_height = 60
+    scorebar_margin = 10
+    scorebar_spacing = 4
+    title_font_size = 22
+    title_line_height = 33
+    points_font_size = 60
+    points_line_height = 60
+    logo_box = (106, 170)
+    logo_position = (60, 56)
+
+    def render(self, game):
+        user = game.user
+        team = user.team.name.lower() if user.team else ''
+        image = self.background(user, team)
+        draw = ImageDraw.Draw(image)
+        self.draw_name(draw, user)
+        self.draw_scorebar(draw, game)
+        self.draw_logo(image, team)
+        f = BytesIO()
+        image.convert('RGB').save(f, 'png')
+        return f.getvalue()
+
+    def render_many(self, games):
+        results = []
+        for game in games:
+            try:
+                results.append(self.render(game))
+            except Exception as exc:
+                results.append(exc)
+        return results
+
+    def background(self, user, team):
+        width, height = SOUVENIR_SIZE
+        if user.image:
+            with user.image.storage.open(user.image.name) as f:
+                photo = Image.open(f).convert('RGB')
+                photo = photo.resize((width, width * 4 // 3), Image.BILINEAR)
+            top = (photo.height - height) // 2
+            photo = photo.crop((0, top, width, top + height))
+        else:
+            photo = Image.new('RGB', SOUVENIR_SIZE, (255, 255, 255))
+        gray = photo.convert('L', (.3, .59, .11, 50)).convert('RGB')
+        color = self.team_colors.get(team, self.default_color)
+        tinted = ImageChops.multiply(gray, Image.new('RGB', SOUVENIR_SIZE, color))
+        return Image.alpha_composite(tinted.convert('RGBA'), _frame())
+
+    def _line_offset(self, font, line_height):
+        ascent, descent = font.getmetrics()
+        return (line_height - ascent - descent) // 2
+
+    def draw_name(self, draw, user):
+        font = _font(self.name_font_size)
+        left, bottom = self.name_position
+        lines = [user.first_name.upper(), user.last_name.upper()]
+        top = SOUVENIR_SIZE[1] - bottom - self.name_line_height * len(lines)
+        offset = self._line_offset(font, self.name_line_height)
+        for i, line in enumerate(lines):
+            y = top + i * self.name_line_height + offset
+            draw.text((left, y), line, font=font, fill=(255, 255, 255))
+
+    def draw_scorebar(self, draw, game):
+        title_font = _font(self.title_font_size)
+        points_font = _font(self.points_font_size)
+        left, bottom = self.scorebar_position
+        top = SOUVENIR_SIZE[1] - bottom - self.scorebar_height
+        items = [('SCORE:', title_font, self.title_line_height),
+                 (str(game.score), points_font, self.points_line_height),
+                 ('HOME RUNS:', title_font, self.title_line_height),
+                 ('{:02d}'.format(game.homeruns), points_font, self.points_line_height),
+                 ('DISTANCE:', title_font, self.title_line_height),
+                 ('{}FT'.format(game.distance), points_font, self.points_line_height)]
+        x = left
+        for text, font, line_height in items:
+            x += self.scorebar_margin
+            y = top + self._line_offset(font, line_height)
+            draw.text((x, y), text, font=font, fill=(255, 255, 255))
+            x += font.getsize(text)[0] + self.scorebar_margin + self.scorebar_spacing
+
+    def draw_logo(self, image, team):
+        logo = _logo(team, self.logo_box[0]) if team else None
+        if logo is None:
+            return
+        right, bottom = self.logo_position
+        x = SOUVENIR_SIZE[0] - right - self.logo_box[0]
+        y = SOUVENIR_SIZE[1] - bottom - logo.height
+        image.alpha_composite(logo, (x, y))
+
+
+def get_renderer():
+    """Return the souvenir renderer configured by SOUVENIR_RENDERER."""
+    return import_string(settings.SOUVENIR_RENDERER)()
+
+
+@lru_cache()
+def asset_version():
+    """Hash the souvenir template and static assets."""
+    digest = hashlib.sha256()
+    template = os.path.join(os.path.dirname(__file__), 'templates', 'souvenir.html')
+    paths = [template]
+    for root, dirs, files in os.walk(finders.find('souvenir')):
+        dirs.sort()
+        paths.extend(os.path.join(root, name) for name in sorted(files))
+    for path in paths:
+        with open(path, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def souvenir_key(game, renderer):
+    """Return a key identifying the souvenir `renderer` would draw for `game`."""
+    user = game.user
+    inputs = ['{}.{}'.format(type(renderer).__module__, type(renderer).__name__),
+              asset_version(),
+              user.first_name, user.last_name,
+              user.team.name if user.team else None,
+              user.image.name if user.image else None,
+              game.score, game.distance, game.homeruns]
+    return hashlib.sha256(json.dumps(inputs).encode()).hexdigest()
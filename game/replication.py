@@ -0,0 +1,97 @@
+import logging
+from collections import OrderedDict
+
+from django.apps import apps
+from django.conf import settings
+from django.core.management.color import no_style
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.utils import timezone
+
+from . import metrics
+from .util import advisory_lock
+
+
+logger = logging.getLogger(__name__)
+
+
+def enabled():
+    """Whether writes go to the local database and are replicated from it."""
+    return settings.DATABASE_WRITE_MODE == 'local'
+
+
+def record(model, pks, using=DEFAULT_DB_ALIAS):
+    """Add changed rows of `model` to the outbox, in the transaction writing them."""
+    from .models import OutboxEntry
+    if not enabled() or using != DEFAULT_DB_ALIAS or model is OutboxEntry:
+        return
+    label = model._meta.label_lower
+    OutboxEntry.objects.using(using).bulk_create(
+        OutboxEntry(model=label, object_pk=str(pk)) for pk in pks)
+
+
+def replicate(batch_size=None):
+    """Copy the rows in the next batch of outbox entries to the replica.
+
+    Each row is copied as it is now, or deleted if it no longer exists, so
+    replaying entries is harmless and several entries for a row collapse
+    into one write. The batch is applied in one transaction on the replica,
+    where postgres defers foreign key checks to the commit. Returns the
+    number of entries replicated.
+    """
+    from .models import OutboxEntry
+    replica = settings.REPLICATION_DATABASE
+    batch_size = batch_size or settings.REPLICATION_BATCH_SIZE
+    with transaction.atomic():
+        advisory_lock('replication')
+        entries = list(OutboxEntry.objects.order_by('pk')[:batch_size])
+        if not entries:
+            return 0
+        changed = OrderedDict()
+        for entry in entries:
+            changed.setdefault(entry.model, OrderedDict())[entry.object_pk] = None
+        with transaction.atomic(using=replica):
+            for label, pks in changed.items():
+                model = apps.get_model(label)
+                pks = [model._meta.pk.to_python(pk) for pk in pks]
+                found = set()
+                for obj in model._base_manager.using(DEFAULT_DB_ALIAS).filter(pk__in=pks):
+                    obj.save_base(using=replica, raw=True)
+                    found.add(obj.pk)
+                missing = [pk for pk in pks if pk not in found]
+                if missing:
+                    # Skip the delete collector, which would cascade and send
+                    # signals. Cascaded rows have outbox entries of their own.
+                    query = model._base_manager.using(replica).filter(pk__in=missing)
+                    query._raw_delete(replica)
+        OutboxEntry.objects.filter(pk__lte=entries[-1].pk).delete()
+    metrics.incr('replicated_entries', len(entries))
+    return len(entries)
+
+
+def replicate_all(batch_size=None):
+    """Replicate batches until the outbox is empty."""
+    total = 0
+    while True:
+        count = replicate(batch_size)
+        if not count:
+            return total
+        total += count
+
+
+def reset_sequences():
+    """Move the replica's id sequences past the ids created locally."""
+    replica = settings.REPLICATION_DATABASE
+    connection = connections[replica]
+    models = apps.get_app_config('game').get_models()
+    with transaction.atomic(using=replica), connection.cursor() as cursor:
+        for sql in connection.ops.sequence_reset_sql(no_style(), models):
+            cursor.execute(sql)
+
+
+def lag():
+    """Return how many entries are waiting and the age of the oldest, in seconds."""
+    from .models import OutboxEntry
+    oldest = OutboxEntry.objects.order_by('pk').values_list('date_created', flat=True).first()
+    seconds = (timezone.now() - oldest).total_seconds() if oldest else 0
+    return {'replication_backlog': OutboxEntry.objects.count(),
+            'replication_lag_seconds': seconds}
@@ -1,3 +1,25 @@
+import threading
+
+from django.conf import settings
+
+
+_requests = threading.local()
+
+
+def start_request(pinned=False):
+    """Begin tracking writes for a request, reading from the nuc if `pinned`."""
+    _requests.tracking = True
+    _requests.pinned = pinned
+    _requests.wrote = False
+
+
+def end_request():
+    """Stop tracking the current request and return whether it wrote."""
+    wrote = getattr(_requests, 'wrote', False)
+    _requests.tracking = _requests.pinned = _requests.wrote = False
+    return wrote
+
+
 class GameRouter:
     """
     A router to control all database operations on models in the
@@ -6,14 +28,25 @@ class GameRouter:
 
     def db_for_read(self, model, **hints):
         """
-        Reads go to the default db, which should be local.
+        Reads go to the default db, which should be local, except for
+        requests pinned to the nuc because they or their client just wrote.
         """
+        if settings.DATABASE_WRITE_MODE == 'local':
+            return None
+        if getattr(_requests, 'pinned', False) or getattr(_requests, 'wrote', False):
+            return 'nuc'
         return None
 
     def db_for_write(self, model, **hints):
         """
-        Writes go to the nuc.
+        Writes go to the nuc, unless they are made locally and replicated.
+        Only writes in a request the middleware is tracking pin its reads,
+        so those made by workers and commands don't pin the thread.
         """
+        if settings.DATABASE_WRITE_MODE == 'local':
+            return None
+        if getattr(_requests, 'tracking', False):
+            _requests.wrote = True
         return 'nuc'
 
     def allow_relation(self, obj1, obj2, **hints):
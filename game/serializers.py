@@ -1,5 +1,7 @@
 import uuid
+from collections import OrderedDict
 
+from django.conf import settings
 from rest_framework import serializers
 from phonenumber_field.modelfields import PhoneNumberField
 
@@ -19,16 +21,30 @@ class AuthenticatedFieldsMixin:
         return data
 
 
-class TeamSerializer(serializers.HyperlinkedModelSerializer):
+class EagerLoadingMixin:
+    """Declare the relations a serializer reads, so views can load them up front."""
+
+    select_related_fields = ()
+    prefetch_related_fields = ()
+
+    @classmethod
+    def setup_eager_loading(cls, queryset):
+        return queryset.select_related(*cls.select_related_fields)\
+                       .prefetch_related(*cls.prefetch_related_fields)
+
+
+class TeamSerializer(EagerLoadingMixin, serializers.HyperlinkedModelSerializer):
 
     scores = serializers.ListField(serializers.DictField(child=serializers.DateField()))
 
+    prefetch_related_fields = ('daily_scores',)
+
     class Meta:
         model = Team
         fields = ('url', 'id', 'name', 'scores')
 
 
-class BaseUserSerializer(AuthenticatedFieldsMixin, serializers.ModelSerializer):
+class BaseUserSerializer(EagerLoadingMixin, AuthenticatedFieldsMixin, serializers.ModelSerializer):
 
     team = serializers.SlugRelatedField(required=False, allow_null=True, slug_field='name', queryset=Team.objects.all())
     team_url = serializers.HyperlinkedRelatedField(read_only=True, source='team', view_name='team-detail')
@@ -44,6 +60,9 @@ class BaseUserSerializer(AuthenticatedFieldsMixin, serializers.ModelSerializer):
                         'first_name': {'required': True}}
         auth_fields = ('mobile_number', 'email')
 
+    select_related_fields = ('team',)
+    prefetch_related_fields = ('games',)
+
     def create(self, validated_data):
         validated_data['username'] = str(uuid.uuid4())
         show = validated_data.pop('show', None)
@@ -66,7 +85,7 @@ class ShowSerializer(serializers.ModelSerializer):
         fields = ('id', 'name', 'date')
 
 
-class BaseGameSerializer(serializers.ModelSerializer):
+class BaseGameSerializer(EagerLoadingMixin, serializers.ModelSerializer):
 
     class Meta:
         model = Game
@@ -86,6 +105,9 @@ class GameSerializer(BaseGameSerializer):
     user_id = serializers.PrimaryKeyRelatedField(queryset=User.objects.all())
     show = ShowSerializer(required=False)
 
+    select_related_fields = ('user__team', 'show')
+    prefetch_related_fields = ('user__games',)
+
     def create(self, validated_data):
         active_game = validated_data['user_id'].active_game
         if active_game and active_game.state not in ('completed', 'cancelled'):
@@ -105,6 +127,8 @@ class UserSerializer(BaseUserSerializer):
     games = BaseGameSerializer(many=True, read_only=True)
     active_game = BaseGameSerializer(read_only=True)
 
+    select_related_fields = ('team', 'active_game')
+
 
 class GameScoreSerializer(serializers.Serializer):
 
@@ -113,6 +137,65 @@ class GameScoreSerializer(serializers.Serializer):
     homeruns = serializers.IntegerField()
 
 
+class BulkTransitionGameSerializer(serializers.Serializer):
+
+    id = serializers.IntegerField()
+    score = serializers.IntegerField(required=False)
+    distance = serializers.IntegerField(required=False)
+    homeruns = serializers.IntegerField(required=False)
+
+
+class BulkTransitionSerializer(serializers.Serializer):
+
+    target = serializers.ChoiceField(choices=list(Game.TRANSITIONS))
+    games = BulkTransitionGameSerializer(many=True)
+
+    def validate_games(self, value):
+        if not value:
+            raise serializers.ValidationError('No games given.')
+        ids = [game['id'] for game in value]
+        if len(set(ids)) != len(ids):
+            raise serializers.ValidationError('Games may only be given once.')
+        return value
+
+    def validate(self, data):
+        fields = Game.TRANSITION_FIELDS.get(Game.TRANSITIONS[data['target']], ())
+        for game in data['games']:
+            missing = [field for field in fields if field not in game]
+            if missing:
+                detail = 'Game {} is missing {}.'.format(game['id'], ', '.join(missing))
+                raise serializers.ValidationError(detail)
+        return data
+
+    @property
+    def transitions(self):
+        """The transition arguments of each game, by id."""
+        fields = Game.TRANSITION_FIELDS.get(Game.TRANSITIONS[self.validated_data['target']], ())
+        return OrderedDict((game['id'], {field: game[field] for field in fields})
+                           for game in self.validated_data['games'])
+
+
 class LightingSerializer(serializers.Serializer):
 
     event = serializers.ChoiceField(choices=('LA', 'Boston', 'attractor', 'in-game'))
+
+
+class LeaderboardSerializer(serializers.Serializer):
+
+    show = serializers.IntegerField(required=False)
+    day = serializers.DateField(required=False)
+    limit = serializers.IntegerField(min_value=1, max_value=settings.LEADERBOARD_MAX_SIZE,
+                                     default=settings.LEADERBOARD_SIZE)
+
+    def validate(self, data):
+        if 'show' in data and 'day' in data:
+            raise serializers.ValidationError('Only one of show or day may be given.')
+        return data
+
+    @property
+    def scope(self):
+        if 'show' in self.validated_data:
+            return 'show:{}'.format(self.validated_data['show'])
+        if 'day' in self.validated_data:
+            return 'day:{}'.format(self.validated_data['day'].isoformat())
+        return 'all'
@@ -0,0 +1,111 @@
+import string
+import secrets
+import logging
+from functools import lru_cache
+
+from django.conf import settings
+from django.db import IntegrityError, router, transaction
+from django.urls import reverse
+from django.utils.module_loading import import_string
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from . import metrics
+from .models import ShortURL
+
+
+logger = logging.getLogger(__name__)
+
+ALPHABET = string.digits + string.ascii_letters
+
+
+def encode(number):
+    code = ''
+    while True:
+        number, i = divmod(number, len(ALPHABET))
+        code = ALPHABET[i] + code
+        if not number:
+            return code
+
+
+def decode(code):
+    number = 0
+    for char in code:
+        number = number * len(ALPHABET) + ALPHABET.index(char)
+    return number
+
+
+@lru_cache()
+def get_session():
+    """Return a requests session shared by this process."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_maxsize=settings.SHORTENER_POOL_SIZE)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+class BitlyBackend:
+    """Shorten urls with bitly."""
+
+    url = 'https://api-ssl.bitly.com/v3/shorten'
+
+    def shorten(self, link):
+        payload = {'access_token': settings.BITLY_TOKEN, 'longUrl': link.long_url}
+        response = get_session().get(self.url, params=payload, timeout=settings.SHORTENER_TIMEOUT)
+        response.raise_for_status()
+        return response.json()['data']['url']
+
+
+class LocalBackend:
+    """Shorten urls to links served by this django app.
+
+    Codes are random, so links to other players' souvenirs can't be found
+    by counting. Links made before codes were stored use the encoded id,
+    which `decode` still reads.
+    """
+
+    attempts = 5
+
+    def shorten(self, link):
+        path = reverse('short-url', args=(self.assign_code(link),))
+        return 'http://{}{}'.format(settings.SHORTENER_HOST, path)
+
+    def assign_code(self, link):
+        if link.code:
+            return link.code
+        for i in range(self.attempts):
+            code = secrets.token_urlsafe(settings.SHORTENER_CODE_BYTES)
+            try:
+                with transaction.atomic(using=router.db_for_write(ShortURL)):
+                    ShortURL.objects.filter(pk=link.pk).update(code=code)
+            except IntegrityError:
+                continue
+            link.code = code
+            return code
+        raise ValueError('Failed to find an unused short url code')
+
+
+def get_backend():
+    return import_string(settings.SHORTENER_BACKEND)()
+
+
+def shorten(long_url):
+    """Return a short url for `long_url`.
+
+    Short urls are stored, so each url is only ever shortened once. If the
+    backend fails, the long url is returned instead.
+    """
+    link, created = ShortURL.objects.get_or_create(long_url=long_url)
+    if link.short_url:
+        metrics.incr('short_url_cache_hit')
+        return link.short_url
+    metrics.incr('short_url_cache_miss')
+    try:
+        link.short_url = get_backend().shorten(link)
+    except (requests.RequestException, KeyError, ValueError):
+        logger.exception('Failed to shorten %s', long_url)
+        return long_url
+    ShortURL.objects.filter(pk=link.pk).update(short_url=link.short_url)
+    return link.short_url
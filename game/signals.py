@@ -1,32 +1,79 @@
 from django.dispatch import receiver
+from django.db.models.signals import post_save, pre_delete, post_delete
 from django.utils import timezone
 from django_fsm.signals import post_transition
-from django.db import transaction
+from django.db import router, transaction
 
-from .models import Game
-from .tasks import game_state_transition_hook
+from . import events, queue_index, replication
+from .models import User, Team, Game
+from .tasks import game_state_transition_hook, schedule_recall
 
 
 @receiver(post_transition, sender=Game)
 def recall_users(sender, instance, name, source, target, **kwargs):
-    if target in ('completed', 'cancelled'):
-        for game in Game.objects.next_recalls():
-            game.recall()
-            game.save()
+    if target not in ('completed', 'cancelled'):
+        return
+    if instance._transition_batch is None:
+        transaction.on_commit(schedule_recall, using=router.db_for_write(Game, instance=instance))
+    else:
+        instance._transition_batch.recall = True
 
 
 @receiver(post_transition, sender=Game)
 def log_state_change(sender, instance, name, source, target, **kwargs):
     date_field = 'date_{}'.format(target)
-    try:
-        state_changed = getattr(instance, date_field)
-        if state_changed is None:
-            setattr(instance, date_field, timezone.now())
-            instance.save()
-    except AttributeError:
-        pass
+    if getattr(instance, date_field, False) is None:
+        setattr(instance, date_field, timezone.now())
 
 
 @receiver(post_transition, sender=Game)
 def trigger_game_hooks(sender, instance, name, source, target, **kwargs):
-    game_state_transition_hook.delay(instance.pk, target)
+    event = events.transition_event(instance, source, target)
+    if instance._transition_batch is None:
+        db = router.db_for_write(Game, instance=instance)
+        transaction.on_commit(lambda: game_state_transition_hook.delay(instance.pk, target), using=db)
+        transaction.on_commit(lambda: events.publish([event]), using=db)
+    else:
+        instance._transition_batch.hooks[target].append(instance.pk)
+        instance._transition_batch.events.append(event)
+
+
+@receiver(post_transition, sender=Game)
+def update_queue_index(sender, instance, name, source, target, **kwargs):
+    change = queue_index.change(instance, target)
+    if instance._transition_batch is None:
+        transaction.on_commit(lambda: queue_index.record([change]),
+                              using=router.db_for_write(Game, instance=instance))
+    else:
+        instance._transition_batch.queue.append(change)
+
+
+@receiver(post_delete, sender=Game)
+def remove_from_queue_index(sender, instance, using, **kwargs):
+    change = queue_index.Change(instance.pk, None, None, None)
+    transaction.on_commit(lambda: queue_index.record([change]), using=using)
+
+
+# Before the delete, while the player it scored for still exists. Both
+# happen in the delete's transaction.
+@receiver(pre_delete, sender=Game)
+def remove_game_scores(sender, instance, using, **kwargs):
+    instance.remove_scores(using=using)
+
+
+@receiver(post_delete, sender=User)
+def remove_team_member(sender, instance, using, **kwargs):
+    if instance.team_id is not None:
+        Team.objects.using(using).move_member(instance.team_id, None)
+
+
+@receiver(post_save)
+def replicate_save(sender, instance, using, **kwargs):
+    if sender._meta.app_label == 'game':
+        replication.record(sender, [instance.pk], using=using)
+
+
+@receiver(post_delete)
+def replicate_delete(sender, instance, using, **kwargs):
+    if sender._meta.app_label == 'game':
+        replication.record(sender, [instance.pk], using=using)
@@ -0,0 +1,167 @@
+import heapq
+import itertools
+from statistics import mean
+from collections import namedtuple, deque
+
+from django.conf import settings
+
+from .recall import RecallStats, OVERDUE_FACTOR
+
+
+SimulatedGame = namedtuple('SimulatedGame', ['pk', 'queued_at', 'confirm_seconds', 'play_seconds', 'no_show'])
+
+SimulationResult = namedtuple('SimulationResult', ['games', 'played', 'no_shows', 'utilization',
+                                                   'starved_seconds', 'mean_queue_wait', 'mean_bay_wait'])
+
+
+def historical_games(queryset):
+    """Return SimulatedGames for the queued games in `queryset`.
+
+    Each keeps the time it was queued, how long its player took to confirm
+    after a recall and how long they played, where these were recorded, and
+    whether the player failed to confirm within the recall window.
+    """
+    expire = settings.RECALL_WINDOW_MINUTES * 60
+    rows = queryset.filter(date_queued__isnull=False).order_by('date_queued')\
+                   .values_list('pk', 'date_queued', 'date_recalled', 'date_confirmed',
+                                'date_playing', 'date_completed')
+    games = []
+    for pk, queued, recalled, confirmed, playing, completed in rows.iterator():
+        confirm_seconds = play_seconds = None
+        if recalled and confirmed and confirmed >= recalled:
+            confirm_seconds = (confirmed - recalled).total_seconds()
+        if playing and completed:
+            play_seconds = (completed - playing).total_seconds()
+        no_show = recalled is not None and (confirm_seconds is None or confirm_seconds > expire)
+        games.append(SimulatedGame(pk, queued.timestamp(), confirm_seconds, play_seconds, no_show))
+    return games
+
+
+class RecallSimulation:
+    """Replay queued games against a recall policy.
+
+    Players join the queue when they did on the night. The policy is asked
+    for the window after every event, as recalls are triggered after each
+    transition and every `period` seconds, with stats measured from the
+    simulation so far. Recalled
+    players confirm after the delay they took on the night, or never if
+    they didn't show, and play for as long as they did. The bay is `lanes`
+    cages playing one game each.
+    """
+
+    def __init__(self, games, policy, lanes=None, expire_seconds=None, period=30):
+        self.games = sorted(games, key=lambda game: game.queued_at)
+        self.policy = policy
+        self.period = period
+        self.lanes = lanes or settings.QUEUE_LANES
+        self.expire_seconds = expire_seconds or settings.RECALL_WINDOW_MINUTES * 60
+
+    def _schedule(self, at, kind, game):
+        heapq.heappush(self.events, (at, next(self.sequence), kind, game))
+
+    def stats(self):
+        confirm_seconds = (mean(self.confirm_samples) if self.confirm_samples
+                           else settings.RECALL_DEFAULT_CONFIRM_SECONDS)
+        overdue_time = self.now - confirm_seconds * OVERDUE_FACTOR
+        return RecallStats(
+            playing=self.playing,
+            confirmed=len(self.waiting),
+            recalled=len(self.recalled_at),
+            overdue=len([at for at in self.recalled_at.values() if at < overdue_time]),
+            play_seconds=mean(self.play_samples) if self.play_samples else settings.QUEUE_DEFAULT_PLAY_SECONDS,
+            confirm_seconds=confirm_seconds,
+            no_show_rate=mean(self.no_show_samples) if self.no_show_samples else 0.0)
+
+    def run(self):
+        self.events = []
+        self.sequence = itertools.count()
+        self.queue = deque()
+        self.recalled_at = {}
+        self.waiting = deque()
+        self.playing = 0
+        self.ticking = False
+        samples = settings.RECALL_STATS_SAMPLES
+        self.play_samples = deque(maxlen=samples)
+        self.confirm_samples = deque(maxlen=samples)
+        self.no_show_samples = deque(maxlen=samples)
+        self.played = self.no_shows = 0
+        self.busy_seconds = self.starved_seconds = 0
+        self.queue_waits = []
+        self.bay_waits = []
+        if not self.games:
+            return SimulationResult(0, 0, 0, 0, 0, 0, 0)
+        for game in self.games:
+            self._schedule(game.queued_at, 'queue', game)
+        start = self.now = self.games[0].queued_at
+        while self.events:
+            at, _, kind, game = heapq.heappop(self.events)
+            # Time the bay spent with free cages while players were waiting.
+            if self.queue or self.recalled_at or self.waiting:
+                self.starved_seconds += (at - self.now) * (self.lanes - self.playing)
+            self.now = at
+            getattr(self, '_' + kind)(game)
+            self._play()
+            self._recall()
+        span = self.now - start
+        return SimulationResult(
+            games=len(self.games),
+            played=self.played,
+            no_shows=self.no_shows,
+            utilization=self.busy_seconds / (self.lanes * span) if span else 0,
+            starved_seconds=self.starved_seconds,
+            mean_queue_wait=mean(self.queue_waits) if self.queue_waits else 0,
+            mean_bay_wait=mean(self.bay_waits) if self.bay_waits else 0)
+
+    def _recall(self):
+        size = self.policy.window_size(self.stats()) - len(self.recalled_at)
+        while size > 0 and self.queue:
+            game = self.queue.popleft()
+            self.recalled_at[game.pk] = self.now
+            if game.no_show:
+                self._schedule(self.now + self.expire_seconds, 'expire', game)
+            else:
+                confirm_seconds = game.confirm_seconds
+                if confirm_seconds is None:
+                    confirm_seconds = self.stats().confirm_seconds
+                self._schedule(self.now + confirm_seconds, 'confirm', game)
+            size -= 1
+
+    def _play(self):
+        while self.playing < self.lanes and self.waiting:
+            game, confirmed_at = self.waiting.popleft()
+            self.bay_waits.append(self.now - confirmed_at)
+            self.queue_waits.append(self.now - game.queued_at)
+            play_seconds = game.play_seconds
+            if play_seconds is None:
+                play_seconds = self.stats().play_seconds
+            self.playing += 1
+            self.busy_seconds += play_seconds
+            self._schedule(self.now + play_seconds, 'finish', (game, play_seconds))
+
+    def _queue(self, game):
+        self.queue.append(game)
+        if not self.ticking:
+            self.ticking = True
+            self._schedule(self.now + self.period, 'tick', None)
+
+    def _tick(self, game):
+        # The periodic recall, which stops when there's nobody to recall.
+        self.ticking = bool(self.queue)
+        if self.ticking:
+            self._schedule(self.now + self.period, 'tick', None)
+
+    def _confirm(self, game):
+        self.confirm_samples.append(self.now - self.recalled_at.pop(game.pk))
+        self.no_show_samples.append(False)
+        self.waiting.append((game, self.now))
+
+    def _expire(self, game):
+        del self.recalled_at[game.pk]
+        self.no_show_samples.append(True)
+        self.no_shows += 1
+
+    def _finish(self, event):
+        game, play_seconds = event
+        self.play_samples.append(play_seconds)
+        self.playing -= 1
+        self.played += 1
@@ -0,0 +1,55 @@
+from functools import lru_cache
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+import boto3
+
+
+# Messages sent through the LocMemBackend, for tests.
+outbox = []
+
+
+@lru_cache()
+def get_sns_client():
+    """Return an SNS client shared by this process.
+
+    boto3 clients are thread safe, so one client and its connection pool
+    is reused for every message a worker sends.
+    """
+    return boto3.client('sns',
+                        aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
+                        aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
+                        region_name=settings.AWS_REGION_NAME)
+
+
+class SNSBackend:
+    """Send sms through AWS SNS."""
+
+    def __init__(self):
+        self.client = get_sns_client()
+
+    def send(self, recipient, message):
+        response = self.client.publish(PhoneNumber=recipient,
+                                       Message=message,
+                                       MessageAttributes={
+                                           'AWS.SNS.SMS.SenderID': {
+                                               'DataType': 'String',
+                                               'StringValue': settings.RECALL_SENDER_ID},
+                                           'AWS.SNS.SMS.SMSType': {
+                                               'DataType': 'String',
+                                               'StringValue': 'Transactional'}
+                                       })
+        return response['MessageId']
+
+
+class LocMemBackend:
+    """Store sms in `outbox` instead of sending them."""
+
+    def send(self, recipient, message):
+        outbox.append((recipient, message))
+        return str(len(outbox))
+
+
+def get_backend():
+    return import_string(settings.SMS_BACKEND)()
@@ -1,85 +1,217 @@
 import time
-import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
 
 from django.conf import settings
 from django.core.files.base import ContentFile
-from django.urls import reverse
+from django.db import router, transaction
 
-import boto3
-import requests
-from pyppeteer import launch
-from celery import shared_task
-from botocore.exceptions import EndpointConnectionError
+from celery import shared_task, group
+from botocore.exceptions import ClientError, EndpointConnectionError
+from redis import RedisError
+
+from . import metrics, sms, replication
+from .util import get_redis
+from .rendering import get_renderer, souvenir_key
+
+
+logger = logging.getLogger(__name__)
+
+RECALL_PENDING_KEY = 'mlb:recall:pending'
 
 
 @shared_task(bind=True)
 def send_sms(self, recipient, message):
-    client = boto3.client('sns',
-                          aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
-                          aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
-                          region_name=settings.AWS_REGION_NAME)
     try:
-        client.publish(PhoneNumber=recipient,
-                       Message=message,
-                       MessageAttributes={
-                           'AWS.SNS.SMS.SenderID': {
-                               'DataType': 'String',
-                               'StringValue': settings.RECALL_SENDER_ID},
-                           'AWS.SNS.SMS.SMSType': {
-                               'DataType': 'String',
-                               'StringValue': 'Transactional'}
-                       })
+        sms.get_backend().send(recipient, message)
     except EndpointConnectionError as exc:
         self.retry(exc=exc, countdown=2 ** self.request.retries)
 
 
+@shared_task()
+def send_sms_batch(messages):
+    """Send a list of (recipient, message) pairs through one backend.
+
+    Messages are sent from a thread pool. Each message is retried on its
+    own when the endpoint can't be reached, and the result of every
+    message is returned, in order, as a dict with either a `message_id` or
+    an `error`.
+    """
+    backend = sms.get_backend()
+
+    def send(recipient, message):
+        result = {'recipient': recipient}
+        for attempt in range(settings.SMS_RETRIES + 1):
+            if attempt:
+                time.sleep(settings.SMS_RETRY_DELAY * 2 ** (attempt - 1))
+            try:
+                result['message_id'] = backend.send(recipient, message)
+                return result
+            except EndpointConnectionError as exc:
+                error = exc
+            except ClientError as exc:
+                error = exc
+                break
+        logger.error('Failed to send sms to %s: %s', recipient, error)
+        result['error'] = str(error)
+        return result
+
+    with ThreadPoolExecutor(max_workers=settings.SMS_THREADS) as executor:
+        return list(executor.map(lambda m: send(*m), messages))
+
+
 @shared_task(bind=True)
 def render_souvenir(self, game_id):
     from .models import Game
-    async def screenshot(url):
-        browser = await launch(args=['--no-sandbox'])
-        page = await browser.newPage()
-        await page.emulate({'viewport': {'width': 1080, 'height': 1080}})
-        await page.goto(url, waitUntil=['load', 'networkidle0'])
-        return await page.screenshot()
-    loop = asyncio.get_event_loop()
-    path = reverse('game-souvenir', args=(game_id,))
-    url = "http://{}{}".format(settings.DJANGO_HOST, path)
-    data = loop.run_until_complete(screenshot(url))
-    game = Game.objects.get(pk=game_id)
-    try:
-        game.souvenir_image.save('souvenir.png', ContentFile(data))
-    except EndpointConnectionError as exc:
-        self.retry(exc=exc, countdown=2 ** self.request.retries)
+    game = Game.objects.select_related('user__team').get(pk=game_id)
+    renderer = get_renderer()
+    key = souvenir_key(game, renderer)
+    name = cached_souvenirs([key]).get(key)
+    if name is None:
+        metrics.incr('souvenir_cache_miss')
+        data = renderer.render(game)
+        try:
+            name = upload_souvenir(game, data, key)
+        except EndpointConnectionError as exc:
+            self.retry(exc=exc, countdown=2 ** self.request.retries)
+    else:
+        metrics.incr('souvenir_cache_hit')
+    Game.objects.filter(pk=game.pk).update(souvenir_image=name, souvenir_key=key)
     return game.pk
 
 
+def cached_souvenirs(keys):
+    """Map souvenir keys to images that have already been stored for them."""
+    from .models import Game
+    query = Game.objects.filter(souvenir_key__in=keys)\
+                        .exclude(souvenir_image='')\
+                        .exclude(souvenir_image=None)\
+                        .values_list('souvenir_key', 'souvenir_image')
+    return dict(query)
+
+
+def upload_souvenir(game, data, key):
+    field = game.souvenir_image.field
+    name = field.generate_filename(game, '{}.png'.format(key))
+    return field.storage.save(name, ContentFile(data))
+
+
+@shared_task(bind=True, ignore_result=False)
+def render_souvenirs_batch(self, game_ids):
+    """Render, upload and send souvenirs for many games at once.
+
+    Games whose souvenir is already stored are not rendered again. The rest
+    are rendered in chunks through one renderer while the previous chunk
+    uploads in a thread pool, and souvenir sms are sent as a single group
+    once every upload has finished. `render_many` returns the exception in
+    place of the image for games that fail to render. Those games, and
+    those that fail to upload, are retried in a new batch while the rest
+    are saved.
+    """
+    from .models import Game
+    games = list(Game.objects.filter(pk__in=game_ids).select_related('user__team', 'show'))
+    renderer = get_renderer()
+    keys = {game.pk: souvenir_key(game, renderer) for game in games}
+    names = cached_souvenirs(set(keys.values()))
+    pending = {}
+    for game in games:
+        if keys[game.pk] not in names:
+            pending.setdefault(keys[game.pk], game)
+    metrics.incr('souvenir_cache_hit', len(games) - len(pending))
+    metrics.incr('souvenir_cache_miss', len(pending))
+    pending = list(pending.items())
+    chunk_size = settings.SOUVENIR_BATCH_CHUNK_SIZE
+    uploads = []
+    with ThreadPoolExecutor(max_workers=settings.SOUVENIR_UPLOAD_THREADS) as executor:
+        for i in range(0, len(pending), chunk_size):
+            chunk = pending[i:i + chunk_size]
+            rendered = renderer.render_many([game for key, game in chunk])
+            for (key, game), data in zip(chunk, rendered):
+                if isinstance(data, Exception):
+                    logger.error('Failed to render souvenir for game %s', game.pk, exc_info=data)
+                    continue
+                uploads.append((key, executor.submit(upload_souvenir, game, data, key)))
+            # Tasks called directly have no id to report progress under.
+            if self.request.id:
+                meta = {'rendered': i + len(chunk), 'total': len(pending)}
+                self.update_state(state='PROGRESS', meta=meta)
+    for key, upload in uploads:
+        try:
+            names[key] = upload.result()
+        except Exception:
+            logger.exception('Failed to upload souvenir %s', key)
+    completed, failed = [], []
+    with transaction.atomic(using=router.db_for_write(Game)):
+        for game in games:
+            key = keys[game.pk]
+            if key not in names:
+                failed.append(game.pk)
+                continue
+            Game.objects.filter(pk=game.pk).update(souvenir_image=names[key], souvenir_key=key)
+            completed.append(game)
+    messages = [send_souvenir_sms.s(game.pk) for game in completed if game.user.mobile_number]
+    if messages:
+        group(messages).delay()
+    if failed:
+        self.retry(args=(failed,), countdown=2 ** self.request.retries)
+    return [game.pk for game in completed]
+
+
 @shared_task
 def periodic_recall():
     from .models import Game
-    for game in Game.objects.next_recalls():
-        game.recall()
-        game.save()
+    Game.objects.recall_next()
 
 
-@shared_task(bind=True)
-def shorten_url(self, url):
+@shared_task
+def replicate_outbox():
+    if replication.enabled():
+        replication.replicate_all()
+
+
+@shared_task
+def triggered_recall():
+    from .models import Game
     try:
-        payload = {'access_token': settings.BITLY_TOKEN, 'longUrl': url}
-        response = requests.get('https://api-ssl.bitly.com/v3/shorten', params=payload)
-    except requests.exceptions.ConnectionError as exc:
-        self.retry(exc=exc, countdown=2 ** self.request.retries)
-    response.raise_for_status()
-    return response.json()
+        get_redis().delete(RECALL_PENDING_KEY)
+    except RedisError:
+        logger.warning('Failed to clear pending recall', exc_info=True)
+    Game.objects.recall_next()
+
+
+def schedule_recall():
+    """Run a recall pass soon, unless one is already pending.
+
+    Triggers within RECALL_DEBOUNCE_SECONDS of each other share one pass.
+    If redis is unavailable every trigger gets its own pass, which is still
+    safe because `recall_next` never over-fills the window.
+    """
+    delay = settings.RECALL_DEBOUNCE_SECONDS
+    if delay:
+        try:
+            pending = not get_redis().set(RECALL_PENDING_KEY, 1, nx=True, ex=delay)
+        except RedisError:
+            logger.warning('Failed to debounce recall', exc_info=True)
+            pending = False
+        if pending:
+            metrics.incr('recall_debounced')
+            return
+    triggered_recall.apply_async(countdown=delay)
+
+
+@shared_task()
+def shorten_url(url):
+    from .shortener import shorten
+    return shorten(url)
 
 
 @shared_task()
 def send_souvenir_sms(game_id):
     from .models import Game
-    game = Game.objects.get(pk=game_id)
+    from .shortener import shorten
+    game = Game.objects.select_related('user', 'show').get(pk=game_id)
     url = 'http://{}{}'.format(settings.DJANGO_HOST, game.souvenir_image.url)
-    url = shorten_url(url)['data']['url']
-    message = game.show.souvenir_message.format(url)
+    message = game.show.souvenir_message.format(shorten(url))
     send_sms.delay(game.user.mobile_number.as_e164, message)
 
 
@@ -103,3 +235,9 @@ def game_state_transition_hook(game_id, target):
         pass
     elif target == 'completed':
         pass
+
+
+@shared_task()
+def game_state_transition_hooks(game_ids, target):
+    for game_id in game_ids:
+        game_state_transition_hook(game_id, target)
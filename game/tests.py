@@ -1,28 +1,66 @@
 from io import BytesIO
+import os
+import csv
+import gzip
+import asyncio
 import logging
+import time
+import json
+import socket
 import datetime
 from unittest import mock
 from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+from unittest import skipUnless
 
 from django.conf import settings
+from django.conf.urls import url
+from django.contrib.staticfiles import finders
+from django.contrib.staticfiles.testing import StaticLiveServerTestCase
+from django.core.management import call_command, CommandError
+from django.core.files.base import ContentFile
 from django.utils import timezone
-from django.test import override_settings
+from django.db import connection, connections, transaction
+from django.db.models import Sum
+from django.test import override_settings, RequestFactory
+from django.http import HttpResponse
+from django.test.utils import CaptureQueriesContext
+from django.views.static import serve
 from rest_framework.test import APITransactionTestCase
 from rest_framework.reverse import reverse
-from PIL import Image
+from PIL import Image, ImageChops, ImageStat
+from django_fsm import ConcurrentTransition
 import boto3
+import requests
+from botocore.exceptions import EndpointConnectionError
+
+from mlb.urls import urlpatterns as mlb_urlpatterns
 
 from .factories import AdminUserFactory, PlayerUserFactory, GameFactory, TeamFactory, ShowFactory
-from .models import User, Game, Show
-from .views import set_lighting
+from .models import User, Game, Show, Team, TeamDailyScore, OutboxEntry, ShortURL
+from .views import set_lighting, GameFilter
 from .signals import recall_users
 from .serializers import GameSerializer
-from .tasks import game_state_transition_hook
+from .tasks import (game_state_transition_hook, render_souvenir, render_souvenirs_batch,
+                    send_sms_batch, triggered_recall)
+from .util import get_redis
+from . import metrics, sms, shortener, replication, router, lighting, events, queue_index
+from .middleware import ReadPinningMiddleware
+from .lighting import DMXController
+from .rendering import BrowserPool, BrowserRenderer, PillowRenderer, close_browser_pool
+from .recall import RecallStats, FixedRecallPolicy, AdaptiveRecallPolicy, measure_stats
+from .simulation import RecallSimulation, SimulatedGame, historical_games
 
 
 logging.disable(logging.CRITICAL)
 boto3.client = mock.Mock()
 
+# Used as ROOT_URLCONF by tests that need media served by the live server.
+urlpatterns = mlb_urlpatterns + [
+    url(r'^media/(?P<path>.*)$', serve, {'document_root': settings.MEDIA_ROOT}),
+]
+
 class AuthenticatedTestMixin:
 
     def setUp(self):
@@ -121,13 +159,12 @@ class TestGame(APITransactionTestCase):
         user4 = PlayerUserFactory(team=None)
         game = GameFactory(user=user4)
         self.assertEqual(game.user.team, None)
-        game.confirm()
-        game.save()
+        game.perform('confirm')
         self.assertEqual(game.user.team, team2)
         PlayerUserFactory(team=team2)
         user = PlayerUserFactory(team=None)
         game = GameFactory(user=user)
-        game.confirm()
+        game.perform('confirm')
         self.assertEqual(game.user.team, team1)
 
     def test_confirm_existing_team(self):
@@ -138,8 +175,7 @@ class TestGame(APITransactionTestCase):
         user = PlayerUserFactory(team=team2)
         game = GameFactory(user=user)
         self.assertEqual(user.team, team2)
-        game.confirm()
-        game.save()
+        game.perform('confirm')
         game = Game.objects.get(pk=game.pk)
         self.assertEqual(user.team, team2)
 
@@ -240,17 +276,17 @@ class TestGameStateLog(AuthenticatedTestMixin, APITransactionTestCase):
         super().setUp()
         game = GameFactory()
         with self._patch_now(offset=1) as self.dt1:
-            game.queue()
+            game.perform('queue')
         with self._patch_now(offset=2) as self.dt2:
-            game.recall()
+            game.perform('recall')
         with self._patch_now(offset=3) as self.dt3:
-            game.confirm()
+            game.perform('confirm')
         with self._patch_now(offset=4) as self.dt4:
-            game.play()
+            game.perform('play')
         with self._patch_now(offset=5) as self.dt5:
-            game.complete(1, 1, 1)
+            game.perform('complete', score=1, distance=1, homeruns=1)
         with self._patch_now(offset=6) as self.dt6:
-            game.cancel()
+            game.perform('cancel')
         self.game = game
         self.states = {'date_queued': self.dt1,
                        'date_recalled': self.dt2,
@@ -291,6 +327,110 @@ class TestGameStateLog(AuthenticatedTestMixin, APITransactionTestCase):
             self.assertEqual(data[field], None)
 
 
+@override_settings(CELERY_TASK_ALWAYS_EAGER=True)
+class TestPerformTransition(AuthenticatedTestMixin, APITransactionTestCase):
+
+    def _updates(self, queries):
+        return [q['sql'] for q in queries if q['sql'].startswith('UPDATE "game_game"')]
+
+    @mock.patch('game.tasks.render_souvenir.s')
+    @mock.patch.object(game_state_transition_hook, 'delay')
+    def test_single_update(self, _hook, _render):
+        game = GameFactory(state='playing')
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(reverse('game-complete', args=(game.pk,)),
+                                        {'score': 10, 'distance': 5, 'homeruns': 1})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(self._updates(queries)), 1)
+        game = Game.objects.get(pk=game.pk)
+        self.assertEqual((game.state, game.score), ('completed', 10))
+        self.assertIsNotNone(game.date_completed)
+
+    def test_concurrent(self):
+        game = GameFactory(state='confirmed')
+        stale = Game.objects.get(pk=game.pk)
+        game.perform('cancel')
+        with self.assertRaises(ConcurrentTransition):
+            stale.perform('play')
+        self.assertEqual(stale.state, 'confirmed')
+        self.assertEqual(Game.objects.get(pk=game.pk).state, 'cancelled')
+
+    @mock.patch.object(game_state_transition_hook, 'delay')
+    def test_concurrent_hooks(self, _hook):
+        game = GameFactory(state='confirmed')
+        Game.objects.filter(pk=game.pk).update(state='cancelled')
+        with self.assertRaises(ConcurrentTransition):
+            game.perform('play')
+        _hook.assert_not_called()
+
+    def test_conflict_response(self):
+        game = GameFactory(state='confirmed')
+        with mock.patch.object(Game, 'perform', side_effect=ConcurrentTransition):
+            response = self.client.post(reverse('game-play', args=(game.pk,)))
+        self.assertEqual(response.status_code, 409)
+
+
+@override_settings(CELERY_TASK_ALWAYS_EAGER=True)
+class TestBulkTransition(AuthenticatedTestMixin, APITransactionTestCase):
+
+    def _post(self, data):
+        return self.client.post(reverse('game-bulk-transition'), data, format='json')
+
+    @mock.patch('game.models.game_state_transition_hooks.delay')
+    def test_queue(self, _hooks):
+        games = [GameFactory(state='new') for i in range(3)]
+        completed = GameFactory(state='completed')
+        ids = [game.pk for game in games] + [completed.pk, 0]
+        with CaptureQueriesContext(connection) as queries:
+            response = self._post({'target': 'queued', 'games': [{'id': pk} for pk in ids]})
+        self.assertEqual(response.status_code, 200)
+        results = response.data['results']
+        self.assertEqual([result['id'] for result in results], ids)
+        self.assertEqual([result.get('state') for result in results[:3]], ['queued'] * 3)
+        self.assertIn('error', results[3])
+        self.assertIn('error', results[4])
+        self.assertEqual(Game.objects.filter(state='queued').count(), 3)
+        self.assertEqual(Game.objects.get(pk=completed.pk).state, 'completed')
+        self.assertIsNotNone(Game.objects.get(pk=games[0].pk).date_queued)
+        updates = [q['sql'] for q in queries if q['sql'].startswith('UPDATE "game_game"')]
+        self.assertEqual(len(updates), 1)
+        _hooks.assert_called_once_with([game.pk for game in games], 'queued')
+
+    @mock.patch('game.models.schedule_recall')
+    @mock.patch('game.models.render_souvenirs_batch.delay')
+    def test_complete(self, _render, _schedule_recall):
+        games = [GameFactory(state='playing') for i in range(3)]
+        data = {'target': 'completed',
+                'games': [{'id': game.pk, 'score': i, 'distance': 10 * i, 'homeruns': i}
+                          for i, game in enumerate(games)]}
+        response = self._post(data)
+        self.assertEqual(response.status_code, 200)
+        for i, game in enumerate(games):
+            game = Game.objects.get(pk=game.pk)
+            self.assertEqual((game.state, game.score, game.distance), ('completed', i, 10 * i))
+        _render.assert_called_once_with([game.pk for game in games])
+        _schedule_recall.assert_called_once_with()
+        totals = TeamDailyScore.objects.aggregate(games=Sum('games'), score=Sum('score'))
+        self.assertEqual(totals, {'games': 3, 'score': 3})
+
+    @mock.patch('game.models.send_sms_batch.delay')
+    def test_recall(self, _send_sms_batch):
+        games = [GameFactory(state='queued') for i in range(3)]
+        response = self._post({'target': 'recalled', 'games': [{'id': game.pk} for game in games]})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(_send_sms_batch.call_args[0][0]), 3)
+
+    def test_invalid(self):
+        game = GameFactory(state='playing')
+        response = self._post({'target': 'completed', 'games': [{'id': game.pk}]})
+        self.assertEqual(response.status_code, 400)
+        response = self._post({'target': 'queued', 'games': [{'id': game.pk}, {'id': game.pk}]})
+        self.assertEqual(response.status_code, 400)
+        response = self._post({'target': 'queued', 'games': []})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(Game.objects.get(pk=game.pk).state, 'playing')
+
+
 @override_settings(CELERY_TASK_ALWAYS_EAGER=True)
 class TestIllegalGameStateChanges(AuthenticatedTestMixin, APITransactionTestCase):
 
@@ -357,7 +497,7 @@ class TestCompleteGame(AuthenticatedTestMixin, APITransactionTestCase):
         self.assertEqual(self._render.call_args[0][0], self.game.pk)
 
 
-@override_settings(CELERY_TASK_ALWAYS_EAGER=True)
+@override_settings(CELERY_TASK_ALWAYS_EAGER=True, RECALL_DEBOUNCE_SECONDS=0)
 class TestRecallUsersSignal(APITransactionTestCase):
 
     def setUp(self):
@@ -368,7 +508,7 @@ class TestRecallUsersSignal(APITransactionTestCase):
     def _recall_users(self, state):
         with mock.patch.object(User, 'send_recall_sms') as _send_recall_sms:
             recall_users(sender=mock.Mock(),
-                         instance=mock.Mock(),
+                         instance=mock.Mock(_transition_batch=None),
                          name=mock.Mock(),
                          source=mock.Mock(),
                          target=state)
@@ -400,6 +540,53 @@ class TestRecallUsersSignal(APITransactionTestCase):
 
 
 
+@override_settings(CELERY_TASK_ALWAYS_EAGER=True, SMS_BACKEND='game.sms.LocMemBackend', RECALL_WINDOW_SIZE=3,
+                   RECALL_DEBOUNCE_SECONDS=0)
+class TestRecallScheduler(APITransactionTestCase):
+
+    def setUp(self):
+        sms.outbox.clear()
+        self.games = [GameFactory(state='queued') for i in range(10)]
+
+    def test_fills_window(self):
+        self.assertEqual(Game.objects.recall_next(), self.games[:3])
+        self.assertEqual(Game.objects.recall_next(), [])
+        self.assertEqual(len(sms.outbox), 3)
+        game = Game.objects.get(pk=self.games[0].pk)
+        self.assertEqual(game.state, 'recalled')
+        self.assertIsNotNone(game.date_recalled)
+
+    def test_skips_missing_mobile_number(self):
+        User.objects.filter(pk=self.games[0].user_id).update(mobile_number='')
+        self.assertEqual(Game.objects.recall_next(), self.games[1:4])
+
+    def test_sends_after_commit(self):
+        with mock.patch('game.models.send_sms_batch.delay') as _delay, \
+                mock.patch('game.models.game_state_transition_hook.delay') as _hook:
+            with transaction.atomic():
+                Game.objects.recall_next()
+                _delay.assert_not_called()
+                _hook.assert_not_called()
+        _delay.assert_called_once()
+        self.assertEqual(_hook.call_count, 3)
+
+    @skipUnless(connection.vendor == 'postgresql', 'Requires postgres')
+    def test_concurrent_completions(self):
+        playing = [GameFactory(state='playing') for i in range(30)]
+
+        def complete(game):
+            try:
+                game.perform('complete', score=1, distance=1, homeruns=0)
+            finally:
+                connection.close()
+
+        with mock.patch('game.models.render_souvenir'):
+            with ThreadPoolExecutor(max_workers=10) as executor:
+                list(executor.map(complete, playing))
+        self.assertEqual(Game.objects.filter(state='recalled').count(), 3)
+        self.assertEqual(len(sms.outbox), 3)
+
+
 @override_settings(CELERY_TASK_ALWAYS_EAGER=True)
 class TestRecall(APITransactionTestCase):
 
@@ -522,5 +709,1318 @@ class TestSouvenirTask(APITransactionTestCase):
     def test_called_on_complete(self):
         game = GameFactory(state='playing')
         with mock.patch('game.tasks.render_souvenir.s') as _delay_partial:
-            game.complete(10, 10, 10)
+            game.perform('complete', score=10, distance=10, homeruns=10)
             _delay_partial().delay.assert_called()
+
+
+class FakePage:
+    # Pages between goto and screenshot, across all fake browsers.
+    rendering = 0
+    max_rendering = 0
+
+    def __init__(self, healthy=True):
+        self.healthy = healthy
+
+    async def setViewport(self, viewport):
+        pass
+
+    async def evaluate(self, expression):
+        if not self.healthy:
+            raise ConnectionError()
+
+    async def goto(self, url, **kwargs):
+        self.url = url
+        FakePage.rendering += 1
+        FakePage.max_rendering = max(FakePage.max_rendering, FakePage.rendering)
+        await asyncio.sleep(0.01)
+
+    async def screenshot(self):
+        FakePage.rendering -= 1
+        return self.url.encode()
+
+
+class FakeBrowser:
+
+    def __init__(self):
+        self.closed = False
+
+    async def newPage(self):
+        return FakePage()
+
+    async def close(self):
+        self.closed = True
+
+
+class TestBrowserPool(APITransactionTestCase):
+
+    def setUp(self):
+        self.browsers = []
+
+        async def _launch(**kwargs):
+            browser = FakeBrowser()
+            self.browsers.append(browser)
+            return browser
+        patcher = mock.patch('game.rendering.launch', _launch)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_reuses_browser(self):
+        pool = BrowserPool(size=1, pages=2, max_renders=10)
+        for i in range(5):
+            self.assertEqual(pool.render('http://test/{}'.format(i)), 'http://test/{}'.format(i).encode())
+        self.assertEqual(len(self.browsers), 1)
+
+    def test_recycle_after_max_renders(self):
+        pool = BrowserPool(size=1, pages=1, max_renders=2)
+        for i in range(4):
+            pool.render('http://test/')
+        self.assertEqual(len(self.browsers), 3)
+        self.assertTrue(all(browser.closed for browser in self.browsers[:2]))
+        self.assertFalse(self.browsers[2].closed)
+
+    def test_recycle_unhealthy(self):
+        pool = BrowserPool(size=1, pages=1)
+        pool.render('http://test/')
+        pool._browsers[0].pages[0].healthy = False
+        self.assertEqual(pool.render('http://test/'), b'http://test/')
+        self.assertEqual(len(self.browsers), 2)
+        self.assertTrue(self.browsers[0].closed)
+
+    def test_concurrency(self):
+        FakePage.max_rendering = 0
+        pool = BrowserPool(size=2, pages=2, concurrency=3)
+        urls = ['http://test/{}'.format(i) for i in range(10)]
+        renders = asyncio.gather(*[pool.screenshot(url) for url in urls])
+        data = pool.loop.run_until_complete(renders)
+        self.assertEqual(data, [url.encode() for url in urls])
+        self.assertEqual(len(self.browsers), 2)
+        self.assertEqual(FakePage.max_rendering, 3)
+
+    def test_concurrency_with_other_current_loop(self):
+        FakePage.max_rendering = 0
+        pool = BrowserPool(size=1, pages=4, concurrency=2)
+        other = asyncio.new_event_loop()
+        asyncio.set_event_loop(other)
+        self.addCleanup(other.close)
+        self.addCleanup(asyncio.set_event_loop, pool.loop)
+        urls = ['http://test/{}'.format(i) for i in range(6)]
+        data = [pool.render(url) for url in urls[:2]]
+        renders = asyncio.gather(*[pool.screenshot(url) for url in urls[2:]], loop=pool.loop)
+        data += pool.loop.run_until_complete(renders)
+        self.assertEqual(data, [url.encode() for url in urls])
+        self.assertEqual(FakePage.max_rendering, 2)
+
+
+class SouvenirRendererMixin:
+
+    def setUp(self):
+        super().setUp()
+        user = PlayerUserFactory(first_name='Casey', last_name='Jones', team=TeamFactory(name='LA'))
+        with open(finders.find('souvenir/images/user.jpg'), 'rb') as f:
+            user.image.save('user.jpg', ContentFile(f.read()))
+        self.game = GameFactory(user=user, state='completed', score=1234, homeruns=7, distance=2500)
+
+
+class TestPillowRenderer(SouvenirRendererMixin, APITransactionTestCase):
+
+    def test_render(self):
+        data = PillowRenderer().render(self.game)
+        image = Image.open(BytesIO(data))
+        self.assertEqual(image.size, (1080, 1080))
+        self.assertEqual(image.format, 'PNG')
+
+    def test_render_without_photo_or_team(self):
+        self.game.user.image = None
+        self.game.user.team = None
+        data = PillowRenderer().render(self.game)
+        self.assertEqual(Image.open(BytesIO(data)).size, (1080, 1080))
+
+    @override_settings(SOUVENIR_RENDERER='game.rendering.PillowRenderer')
+    def test_render_souvenir_task(self):
+        from .tasks import render_souvenir
+        render_souvenir(self.game.pk)
+        game = Game.objects.get(pk=self.game.pk)
+        self.assertEqual(Image.open(game.souvenir_image).size, (1080, 1080))
+
+
+@skipUnless(os.environ.get('SOUVENIR_BROWSER_TESTS'), 'Requires chromium')
+@override_settings(ROOT_URLCONF='game.tests')
+class TestPillowRendererMatchesBrowser(SouvenirRendererMixin, StaticLiveServerTestCase):
+
+    def tearDown(self):
+        close_browser_pool()
+        super().tearDown()
+
+    def test_pixel_diff(self):
+        host = self.live_server_url.split('://')[1]
+        with self.settings(DJANGO_HOST=host):
+            browser = Image.open(BytesIO(BrowserRenderer().render(self.game))).convert('RGB')
+        pillow = Image.open(BytesIO(PillowRenderer().render(self.game))).convert('RGB')
+        self.assertEqual(browser.size, pillow.size)
+        diff = ImageStat.Stat(ImageChops.difference(browser, pillow))
+        self.assertLess(sum(diff.mean) / len(diff.mean), 8)
+
+
+@override_settings(CELERY_TASK_ALWAYS_EAGER=True,
+                   SOUVENIR_RENDERER='game.rendering.PillowRenderer',
+                   SOUVENIR_BATCH_CHUNK_SIZE=2)
+class TestRenderSouvenirsBatch(APITransactionTestCase):
+
+    def setUp(self):
+        self.games = [GameFactory(state='completed') for i in range(5)]
+        self.games[0].user.mobile_number = ''
+        self.games[0].user.save()
+
+    @mock.patch('game.tasks.group')
+    def test_batch(self, _group):
+        game_ids = [game.pk for game in self.games]
+        render_souvenirs_batch(game_ids)
+        for game in Game.objects.filter(pk__in=game_ids):
+            self.assertTrue(game.souvenir_image)
+            self.assertEqual(Image.open(game.souvenir_image).size, (1080, 1080))
+        signatures = _group.call_args[0][0]
+        self.assertEqual([s.args[0] for s in signatures], game_ids[1:])
+        _group().delay.assert_called_once_with()
+
+    @override_settings(SOUVENIR_RENDERER='game.rendering.PillowRenderer', SOUVENIR_BATCH_CHUNK_SIZE=5)
+    @mock.patch('game.tasks.group')
+    def test_batch_partial_failure(self, _group):
+        failing = self.games[2]
+
+        def render(renderer, game):
+            if game.pk == failing.pk:
+                raise OSError('Render failed')
+            return b'png'
+        game_ids = [game.pk for game in self.games]
+        with mock.patch('game.rendering.PillowRenderer.render', autospec=True, side_effect=render), \
+                mock.patch.object(render_souvenirs_batch, 'retry') as _retry:
+            self.assertEqual(render_souvenirs_batch(game_ids), [pk for pk in game_ids if pk != failing.pk])
+        _retry.assert_called_once_with(args=([failing.pk],), countdown=1)
+        games = Game.objects.in_bulk(game_ids)
+        self.assertFalse(games[failing.pk].souvenir_image)
+        self.assertTrue(all(games[pk].souvenir_image for pk in game_ids if pk != failing.pk))
+        signatures = _group.call_args[0][0]
+        self.assertEqual([s.args[0] for s in signatures], [pk for pk in game_ids[1:] if pk != failing.pk])
+
+    @mock.patch('game.tasks.render_souvenirs_batch.delay')
+    def test_admin_action(self, _delay):
+        from .admin import GameAdmin
+        from django.contrib.admin.sites import site
+        admin = GameAdmin(Game, site)
+        with self.settings(SOUVENIR_BATCH_SIZE=2), mock.patch.object(admin, 'message_user'):
+            admin.regenerate_souvenirs(mock.Mock(), Game.objects.order_by('pk'))
+        self.assertEqual([c[0][0] for c in _delay.call_args_list],
+                         [[g.pk for g in self.games[:2]], [g.pk for g in self.games[2:4]], [self.games[4].pk]])
+
+
+class RedisTestMixin:
+
+    def setUp(self):
+        super().setUp()
+        get_redis().flushdb()
+
+
+@override_settings(CELERY_TASK_ALWAYS_EAGER=True,
+                   SOUVENIR_RENDERER='game.rendering.PillowRenderer')
+class TestSouvenirCache(RedisTestMixin, APITransactionTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.game = GameFactory(state='completed', score=10)
+
+    def test_cache(self):
+        with mock.patch('game.rendering.PillowRenderer.render', return_value=b'png') as _render:
+            render_souvenir(self.game.pk)
+            render_souvenir(self.game.pk)
+            self.assertEqual(_render.call_count, 1)
+            name = Game.objects.get(pk=self.game.pk).souvenir_image.name
+            Game.objects.filter(pk=self.game.pk).update(score=20)
+            render_souvenir(self.game.pk)
+            self.assertEqual(_render.call_count, 2)
+        self.assertNotEqual(Game.objects.get(pk=self.game.pk).souvenir_image.name, name)
+        self.assertEqual(metrics.counters(), {'souvenir_cache_hit': 1, 'souvenir_cache_miss': 2})
+
+    @mock.patch('game.tasks.group')
+    def test_batch_cache(self, _group):
+        games = [self.game] + [GameFactory(state='completed', user=self.game.user, score=10)
+                               for i in range(2)]
+        with mock.patch('game.rendering.PillowRenderer.render', return_value=b'png') as _render:
+            render_souvenirs_batch([game.pk for game in games])
+            self.assertEqual(_render.call_count, 1)
+        names = {game.souvenir_image.name for game in Game.objects.filter(pk__in=[g.pk for g in games])}
+        self.assertEqual(len(names), 1)
+        self.assertEqual(metrics.counters(), {'souvenir_cache_hit': 2, 'souvenir_cache_miss': 1})
+
+
+@override_settings(CELERY_TASK_ALWAYS_EAGER=True, SMS_RETRY_DELAY=0)
+class TestSendSmsBatch(APITransactionTestCase):
+
+    def setUp(self):
+        sms.outbox.clear()
+        self.messages = [('+44770000000{}'.format(i), 'message {}'.format(i)) for i in range(5)]
+
+    @override_settings(SMS_BACKEND='game.sms.LocMemBackend')
+    def test_batch(self):
+        results = send_sms_batch(self.messages)
+        self.assertEqual(sms.outbox, self.messages)
+        self.assertEqual([r['recipient'] for r in results], [m[0] for m in self.messages])
+        self.assertTrue(all('message_id' in r for r in results))
+
+    def test_retry(self):
+        client = sms.get_sns_client()
+        error = EndpointConnectionError(endpoint_url='https://sns')
+        client.publish.side_effect = [error, {'MessageId': '1'}, error, error, error, error]
+        with self.settings(SMS_THREADS=1, SMS_RETRIES=3):
+            results = send_sms_batch(self.messages[:2])
+        client.publish.side_effect = None
+        self.assertEqual(results[0], {'recipient': self.messages[0][0], 'message_id': '1'})
+        self.assertIn('error', results[1])
+
+    def test_client_cached(self):
+        self.assertIs(sms.get_sns_client(), sms.get_sns_client())
+
+    @override_settings(SMS_BACKEND='game.sms.LocMemBackend', RECALL_WINDOW_SIZE=3)
+    def test_recall_batch(self):
+        for i in range(5):
+            GameFactory(state='queued')
+        with mock.patch('game.models.send_sms_batch.delay') as _delay:
+            Game.objects.recall_next()
+        self.assertEqual(len(_delay.call_args[0][0]), 3)
+        self.assertEqual(Game.objects.filter(state='recalled').count(), 3)
+
+
+class TestShortener(RedisTestMixin, APITransactionTestCase):
+
+    long_url = 'http://example.com/media/souvenirs/souvenir.png'
+
+    def test_encode(self):
+        for number in (0, 1, 61, 62, 12345678):
+            self.assertEqual(shortener.decode(shortener.encode(number)), number)
+
+    @override_settings(SHORTENER_BACKEND='game.shortener.LocalBackend', SHORTENER_HOST='testserver')
+    def test_local(self):
+        short_url = shortener.shorten(self.long_url)
+        self.assertTrue(short_url.startswith('http://testserver/s/'))
+        response = self.client.get(short_url)
+        self.assertRedirects(response, self.long_url, fetch_redirect_response=False)
+        self.assertEqual(shortener.shorten(self.long_url), short_url)
+        self.assertEqual(metrics.counters(), {'short_url_cache_hit': 1, 'short_url_cache_miss': 1})
+
+    @override_settings(SHORTENER_BACKEND='game.shortener.LocalBackend', SHORTENER_HOST='testserver')
+    def test_local_codes_are_random(self):
+        short_url = shortener.shorten(self.long_url)
+        link = ShortURL.objects.get(long_url=self.long_url)
+        self.assertEqual(short_url.rstrip('/'), 'http://testserver/s/{}'.format(link.code))
+        self.assertNotEqual(link.code, shortener.encode(link.pk))
+        response = self.client.get('/s/{}/'.format(shortener.encode(link.pk)))
+        self.assertEqual(response.status_code, 404)
+
+    @override_settings(SHORTENER_BACKEND='game.shortener.LocalBackend', SHORTENER_HOST='testserver')
+    def test_local_code_collision(self):
+        ShortURL.objects.create(long_url='http://example.com/other', code='taken')
+        with mock.patch('game.shortener.secrets.token_urlsafe', side_effect=['taken', 'free']):
+            short_url = shortener.shorten(self.long_url)
+        self.assertEqual(short_url.rstrip('/'), 'http://testserver/s/free')
+
+    def test_old_links(self):
+        link = ShortURL.objects.create(long_url=self.long_url)
+        response = self.client.get('/s/{}/'.format(shortener.encode(link.pk)))
+        self.assertRedirects(response, self.long_url, fetch_redirect_response=False)
+
+    @override_settings(SHORTENER_BACKEND='game.shortener.BitlyBackend')
+    @mock.patch('game.shortener.get_session')
+    def test_bitly(self, _session):
+        response = _session().get.return_value
+        response.json.return_value = {'data': {'url': 'http://bit.ly/a'}}
+        self.assertEqual(shortener.shorten(self.long_url), 'http://bit.ly/a')
+        self.assertEqual(shortener.shorten(self.long_url), 'http://bit.ly/a')
+        self.assertEqual(_session().get.call_count, 1)
+        self.assertEqual(_session().get.call_args[1]['timeout'], settings.SHORTENER_TIMEOUT)
+
+    @override_settings(SHORTENER_BACKEND='game.shortener.BitlyBackend')
+    @mock.patch('game.shortener.get_session')
+    def test_bitly_timeout(self, _session):
+        _session().get.side_effect = requests.exceptions.Timeout()
+        self.assertEqual(shortener.shorten(self.long_url), self.long_url)
+        _session().get.side_effect = None
+        _session().get.return_value.json.return_value = {'data': {'url': 'http://bit.ly/a'}}
+        self.assertEqual(shortener.shorten(self.long_url), 'http://bit.ly/a')
+
+
+@override_settings(CELERY_TASK_ALWAYS_EAGER=True)
+class TestTeamDailyScore(AuthenticatedTestMixin, APITransactionTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.team = TeamFactory()
+        self.game = GameFactory(state='playing', user=PlayerUserFactory(team=self.team))
+
+    def _totals(self, team=None):
+        return [(row['score'], row['distance'], row['homeruns'])
+                for row in (team or self.team).scores]
+
+    @mock.patch('game.models.render_souvenir')
+    def test_complete(self, _render):
+        self.client.post(reverse('game-complete', args=(self.game.pk,)),
+                         {'score': 10, 'distance': 20, 'homeruns': 3})
+        self.assertEqual(self._totals(), [(10, 20, 3)])
+        self.client.post(reverse('game-cancel', args=(self.game.pk,)))
+        self.assertEqual(self._totals(), [])
+
+    def test_rescore(self):
+        game = GameFactory(state='completed', score=10, user=PlayerUserFactory(team=self.team))
+        self.client.patch(reverse('game-detail', args=(game.pk,)), {'score': 15})
+        self.assertEqual(self._totals(), [(15, 0, 0)])
+
+    def test_delete(self):
+        game = GameFactory(state='completed', score=10, user=PlayerUserFactory(team=self.team))
+        GameFactory(state='completed', score=5, user=PlayerUserFactory(team=self.team))
+        Game.objects.get(pk=game.pk).delete()
+        self.assertFalse(User.objects.filter(pk=game.user_id).exists())
+        self.assertEqual(self._totals(), [(5, 0, 0)])
+        row = TeamDailyScore.objects.get(team=self.team)
+        self.assertEqual(row.games, 1)
+        self.assertEqual(list(TeamDailyScore.objects.inconsistencies()), [])
+
+    def test_team_change(self):
+        game = GameFactory(state='completed', score=10, user=PlayerUserFactory(team=self.team))
+        team = TeamFactory()
+        game.user.team = team
+        game.user.save()
+        self.assertEqual(self._totals(), [])
+        self.assertEqual(self._totals(team), [(10, 0, 0)])
+
+    def test_check_command(self):
+        GameFactory(state='completed', score=10, user=PlayerUserFactory(team=self.team))
+        call_command('check_team_scores', stdout=mock.Mock())
+        TeamDailyScore.objects.all().delete()
+        with self.assertRaises(CommandError):
+            call_command('check_team_scores', stdout=mock.Mock())
+        call_command('rebuild_team_scores', stdout=mock.Mock())
+        self.assertEqual(self._totals(), [(10, 0, 0)])
+
+    def test_list_queries(self):
+        for i in range(3):
+            GameFactory(state='completed', user=PlayerUserFactory(team=TeamFactory()))
+        with CaptureQueriesContext(connection) as few:
+            self.client.get(reverse('team-list'))
+        for i in range(10):
+            GameFactory(state='completed', user=PlayerUserFactory(team=TeamFactory()))
+        with CaptureQueriesContext(connection) as many:
+            self.client.get(reverse('team-list'))
+        self.assertEqual(len(few), len(many))
+
+
+@override_settings(CELERY_TASK_ALWAYS_EAGER=True)
+class TestLeaderboard(RedisTestMixin, APITransactionTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.show = ShowFactory()
+        self.team_1 = TeamFactory()
+        self.team_2 = TeamFactory()
+        self.games = []
+        for i, team in enumerate([self.team_1, self.team_2, self.team_2]):
+            user = PlayerUserFactory(team=team)
+            self.games.append(GameFactory(user=user, show=self.show, state='completed', score=10 * (i + 1)))
+        GameFactory(state='queued', score=100)
+
+    def test_rankings(self):
+        data = self.client.get('/leaderboard/').json()
+        self.assertEqual([(p['id'], p['score']) for p in data['players']],
+                         [(g.user.pk, g.score) for g in reversed(self.games)])
+        self.assertEqual([(t['name'], t['score']) for t in data['teams']],
+                         [(self.team_2.name, 50), (self.team_1.name, 10)])
+
+    def test_scopes(self):
+        other = GameFactory(state='completed', score=1000)
+        data = self.client.get('/leaderboard/', {'show': self.show.pk, 'limit': 1}).json()
+        self.assertEqual([p['id'] for p in data['players']], [self.games[2].user.pk])
+        data = self.client.get('/leaderboard/').json()
+        self.assertEqual(data['players'][0]['id'], other.user.pk)
+        day = timezone.localtime(other.date_created).date()
+        data = self.client.get('/leaderboard/', {'day': day.isoformat()}).json()
+        self.assertEqual(data['players'][0]['id'], other.user.pk)
+        response = self.client.get('/leaderboard/', {'day': day.isoformat(), 'show': self.show.pk})
+        self.assertEqual(response.status_code, 400)
+
+    def test_cancel(self):
+        self.games[2].perform('cancel')
+        data = self.client.get('/leaderboard/').json()
+        self.assertNotIn(self.games[2].user.pk, [p['id'] for p in data['players']])
+
+    def test_zero_score(self):
+        game = GameFactory(show=self.show, state='completed', score=0)
+        GameFactory(user=game.user, show=self.show, state='completed', score=5).perform('cancel')
+        data = self.client.get('/leaderboard/').json()
+        self.assertIn((game.user.pk, 0), [(p['id'], p['score']) for p in data['players']])
+
+    def test_rebuild(self):
+        expected = self.client.get('/leaderboard/').json()
+        get_redis().flushdb()
+        call_command('rebuild_leaderboard', stdout=mock.Mock())
+        self.assertEqual(self.client.get('/leaderboard/').json(), expected)
+
+    def test_rebuild_changes_etag(self):
+        etag = self.client.get('/leaderboard/')['ETag']
+        call_command('rebuild_leaderboard', stdout=mock.Mock())
+        response = self.client.get('/leaderboard/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_etag(self):
+        response = self.client.get('/leaderboard/')
+        etag = response['ETag']
+        response = self.client.get('/leaderboard/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        response = self.client.get('/leaderboard/', {'limit': 1}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        GameFactory(state='completed', score=5)
+        response = self.client.get('/leaderboard/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+
+@override_settings(CELERY_TASK_ALWAYS_EAGER=True)
+class TestListQueryCounts(AuthenticatedTestMixin, APITransactionTestCase):
+    """List endpoints should make the same number of queries however many rows they return."""
+
+    def _create_games(self, count):
+        for i in range(count):
+            game = GameFactory(state='completed', score=i)
+            GameFactory(user=game.user, state='queued')
+
+    def _count_queries(self, url, count):
+        self._create_games(count)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def _assert_constant(self, url):
+        few = self._count_queries(url, 2)
+        many = self._count_queries(url, 20)
+        self.assertEqual(few, many)
+
+    def test_users(self):
+        self._assert_constant(reverse('user-list'))
+
+    def test_users_ordered_by_score(self):
+        self._assert_constant(reverse('user-list') + '?ordering=-score')
+
+    def test_games(self):
+        self._assert_constant(reverse('game-list'))
+
+    def test_teams(self):
+        self._assert_constant(reverse('team-list'))
+
+
+@override_settings(CELERY_TASK_ALWAYS_EAGER=True)
+class TestCursorPagination(AuthenticatedTestMixin, APITransactionTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.games = [GameFactory(state='completed', score=i % 3) for i in range(7)]
+
+    def _pages(self, url, params):
+        ids = []
+        response = self.client.get(url, params)
+        while True:
+            data = response.json()
+            self.assertLessEqual(len(data['results']), params['page_size'])
+            ids.extend(item['id'] for item in data['results'])
+            if not data['next']:
+                return ids
+            response = self.client.get(data['next'])
+
+    def test_games_by_score(self):
+        ids = self._pages(reverse('game-list'), {'ordering': '-score', 'page_size': 2})
+        expected = sorted(self.games, key=lambda game: (-game.score, -game.pk))
+        self.assertEqual(ids, [game.pk for game in expected])
+
+    def test_games_by_date(self):
+        ids = self._pages(reverse('game-list'), {'page_size': 3})
+        self.assertEqual(ids, [game.pk for game in self.games])
+
+    def test_users(self):
+        for ordering in ('-score', 'active_game__date_updated', 'active_game__date_created'):
+            ids = self._pages(reverse('user-list'), {'ordering': ordering, 'page_size': 2})
+            self.assertEqual(sorted(ids), sorted(game.user.pk for game in self.games))
+
+    def test_null_ordering(self):
+        users = [PlayerUserFactory() for i in range(3)]
+        url = reverse('user-list')
+        for ordering in ('active_game__date_updated', '-active_game__date_updated'):
+            games = sorted(self.games, key=lambda game: game.date_updated, reverse=ordering.startswith('-'))
+            expected = [game.user.pk for game in games] + [user.pk for user in users]
+            ids = self._pages(url, {'ordering': ordering, 'page_size': 2})
+            self.assertEqual(ids, expected)
+            # Page back from the last page, which starts on a null.
+            response = self.client.get(url, {'ordering': ordering, 'page_size': 2})
+            while response.json()['next']:
+                response = self.client.get(response.json()['next'])
+            previous = response.json()['previous']
+            self.assertEqual([item['id'] for item in self.client.get(previous).json()['results']],
+                             expected[-4:-2])
+
+    def test_page_size(self):
+        with self.settings(API_PAGE_SIZE=4, API_MAX_PAGE_SIZE=5):
+            self.assertEqual(len(self.client.get(reverse('game-list')).json()['results']), 4)
+            response = self.client.get(reverse('game-list'), {'page_size': 100})
+            self.assertEqual(len(response.json()['results']), 5)
+
+
+@override_settings(CELERY_TASK_ALWAYS_EAGER=True)
+class TestGameCSVExport(AuthenticatedTestMixin, APITransactionTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.games = [GameFactory(state='completed', score=i) for i in range(5)]
+        GameFactory(state='queued')
+
+    def _rows(self, response):
+        content = b''.join(response.streaming_content)
+        if response.get('Content-Encoding') == 'gzip':
+            content = gzip.decompress(content)
+        return list(csv.reader(content.decode().splitlines()))
+
+    def test_export(self):
+        response = self.client.get(reverse('game-list'), {'format': 'csv', 'state': 'completed'})
+        self.assertTrue(response.streaming)
+        rows = self._rows(response)
+        self.assertEqual(rows[0][:3], ['id', 'user_id', 'first_name'])
+        self.assertEqual([int(row[0]) for row in rows[1:]], [game.pk for game in self.games])
+
+    def test_fields(self):
+        response = self.client.get(reverse('game-list'), {'format': 'csv', 'fields': 'id,score',
+                                                          'ordering': '-score', 'state': 'completed'})
+        rows = self._rows(response)
+        self.assertEqual(rows, [['id', 'score']] + [[str(g.pk), str(g.score)] for g in reversed(self.games)])
+        response = self.client.get(reverse('game-list'), {'format': 'csv', 'fields': 'id,password'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_gzip(self):
+        response = self.client.get(reverse('game-list'), {'format': 'csv'}, HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(len(self._rows(response)), 7)
+
+
+class ExplainMixin:
+    """Assert that queries can use an index, from postgres' EXPLAIN output.
+
+    Sequential scans are disabled while explaining, because on a small test
+    table postgres would otherwise prefer them even when an index applies.
+    """
+
+    def explain(self, queryset):
+        sql, params = queryset.query.sql_with_params()
+        with connections[queryset.db].cursor() as cursor:
+            cursor.execute('SET enable_seqscan = off')
+            try:
+                cursor.execute('EXPLAIN ' + sql, params)
+                return '\n'.join(row[0] for row in cursor.fetchall())
+            finally:
+                cursor.execute('SET enable_seqscan = on')
+
+    def assertUsesIndex(self, queryset, index):
+        plan = self.explain(queryset)
+        self.assertIn(index, plan, plan)
+
+
+@skipUnless(connection.vendor == 'postgresql', 'Requires postgres')
+class TestGameIndexes(ExplainMixin, APITransactionTestCase):
+
+    def setUp(self):
+        for state in ('queued', 'recalled', 'completed'):
+            for i in range(5):
+                GameFactory(state=state)
+
+    def test_next_recalls(self):
+        self.assertUsesIndex(Game.objects.next_recalls(max_recalls=10), 'game_queued_idx')
+
+    def test_active_recalls(self):
+        self.assertUsesIndex(Game.objects.active_recalls(), 'game_recalled_idx')
+
+    def test_state(self):
+        query = Game.objects.filter(state='completed').order_by('date_created')
+        self.assertUsesIndex(query, 'game_state_created_idx')
+
+    def test_date_range(self):
+        start = timezone.now().replace(hour=0, minute=0, second=0, microsecond=0)
+        end = start + datetime.timedelta(days=1)
+        self.assertUsesIndex(Game.objects.filter(date_created__gte=start, date_created__lt=end),
+                             'game_created_idx')
+        self.assertUsesIndex(Game.objects.filter(date_updated__gte=start, date_updated__lt=end),
+                             'game_updated_idx')
+
+    def test_date_filter(self):
+        filterset = GameFilter({'date_created': timezone.localdate().isoformat()},
+                               queryset=Game.objects.all())
+        self.assertUsesIndex(filterset.qs, 'game_created_idx')
+
+
+@override_settings(TIME_ZONE='America/New_York')
+class TestDateFilters(AuthenticatedTestMixin, APITransactionTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.late = GameFactory()
+        self.early = GameFactory()
+        # 11:30pm and 1am on the 1st in New York
+        Game.objects.filter(pk=self.late.pk).update(
+            date_created=datetime.datetime(2018, 6, 2, 3, 30, tzinfo=datetime.timezone.utc))
+        Game.objects.filter(pk=self.early.pk).update(
+            date_created=datetime.datetime(2018, 6, 1, 5, 0, tzinfo=datetime.timezone.utc))
+
+    def _ids(self, params):
+        response = self.client.get(reverse('game-list'), params)
+        self.assertEqual(response.status_code, 200)
+        return {game['id'] for game in response.data['results']}
+
+    def test_day(self):
+        self.assertEqual(self._ids({'date_created': '2018-06-01'}), {self.late.pk, self.early.pk})
+        self.assertEqual(self._ids({'date_created': '2018-06-02'}), set())
+
+    def test_range(self):
+        self.assertEqual(self._ids({'date_created_after': '2018-06-01',
+                                    'date_created_before': '2018-06-01'}), {self.late.pk, self.early.pk})
+        self.assertEqual(self._ids({'date_created_after': '2018-06-02'}), set())
+        self.assertEqual(self._ids({'date_created_before': '2018-05-31'}), set())
+
+    def test_users(self):
+        for game in (self.late, self.early):
+            game.user.active_game = game
+            game.user.save()
+        response = self.client.get(reverse('user-list'), {'game_created_after': '2018-06-01',
+                                                          'game_created_before': '2018-06-01'})
+        self.assertEqual({user['id'] for user in response.data['results']},
+                         {self.late.user.pk, self.early.user.pk})
+
+
+@override_settings(RECALL_DEBOUNCE_SECONDS=5)
+class TestRecallTrigger(RedisTestMixin, APITransactionTestCase):
+
+    def _recall_users(self, target):
+        recall_users(sender=Game, instance=mock.Mock(_transition_batch=None), name='complete',
+                     source='playing', target=target)
+
+    @mock.patch('game.tasks.triggered_recall.apply_async')
+    def test_after_commit(self, _apply_async):
+        with transaction.atomic():
+            self._recall_users('completed')
+            _apply_async.assert_not_called()
+        _apply_async.assert_called_once_with(countdown=5)
+
+    @mock.patch.object(game_state_transition_hook, 'delay')
+    @mock.patch('game.tasks.triggered_recall.apply_async')
+    def test_transition(self, _apply_async, _hook):
+        game = GameFactory(state='queued')
+        with transaction.atomic():
+            game.perform('cancel')
+            _apply_async.assert_not_called()
+        _apply_async.assert_called_once_with(countdown=5)
+
+    @mock.patch('game.tasks.triggered_recall.apply_async')
+    def test_debounced(self, _apply_async):
+        for target in ('completed', 'cancelled', 'completed'):
+            self._recall_users(target)
+        self._recall_users('playing')
+        _apply_async.assert_called_once_with(countdown=5)
+        self.assertEqual(metrics.counters()['recall_debounced'], 2)
+
+    @mock.patch('game.models.GameQuerySet.recall_next')
+    def test_pass_clears_pending(self, _recall_next):
+        with mock.patch('game.tasks.triggered_recall.apply_async'):
+            self._recall_users('completed')
+        triggered_recall()
+        _recall_next.assert_called_once_with()
+        with mock.patch('game.tasks.triggered_recall.apply_async') as _apply_async:
+            self._recall_users('completed')
+        _apply_async.assert_called_once_with(countdown=5)
+
+
+@override_settings(CELERY_TASK_ALWAYS_EAGER=True)
+class TestTeamBalance(APITransactionTestCase):
+
+    def setUp(self):
+        self.teams = [TeamFactory() for i in range(3)]
+
+    def _counts(self):
+        return [Team.objects.get(pk=team.pk).member_count for team in self.teams]
+
+    def test_member_count(self):
+        user = PlayerUserFactory(team=self.teams[0])
+        PlayerUserFactory(team=self.teams[0])
+        self.assertEqual(self._counts(), [2, 0, 0])
+        user.team = self.teams[1]
+        user.save()
+        self.assertEqual(self._counts(), [1, 1, 0])
+        user.delete()
+        self.assertEqual(self._counts(), [1, 0, 0])
+
+    def test_recount(self):
+        PlayerUserFactory(team=self.teams[2])
+        Team.objects.update(member_count=5)
+        Team.objects.recount()
+        self.assertEqual(self._counts(), [0, 0, 1])
+
+    @mock.patch.object(game_state_transition_hook, 'delay')
+    def test_confirm(self, _hook):
+        PlayerUserFactory(team=self.teams[0])
+        PlayerUserFactory(team=self.teams[2])
+        game = GameFactory(user=PlayerUserFactory(team=None))
+        with CaptureQueriesContext(connection) as queries:
+            game.perform('confirm')
+        self.assertFalse(any('COUNT(' in q['sql'] for q in queries))
+        self.assertEqual(User.objects.get(pk=game.user.pk).team, self.teams[1])
+        self.assertEqual(self._counts(), [1, 1, 1])
+
+    @skipUnless(connection.vendor == 'postgresql', 'Requires postgres')
+    @mock.patch.object(game_state_transition_hook, 'delay')
+    def test_parallel_confirms(self, _hook):
+        games = [GameFactory(user=PlayerUserFactory(team=None)) for i in range(30)]
+
+        def confirm(game):
+            try:
+                game.perform('confirm')
+            finally:
+                connection.close()
+
+        with ThreadPoolExecutor(max_workers=10) as executor:
+            list(executor.map(confirm, games))
+        members = [Team.objects.get(pk=team.pk).members.count() for team in self.teams]
+        self.assertEqual(members, [10, 10, 10])
+        self.assertEqual(self._counts(), members)
+
+
+@override_settings(DATABASE_WRITE_MODE='local')
+class TestReplicationOutbox(APITransactionTestCase):
+
+    def _entries(self):
+        return list(OutboxEntry.objects.order_by('pk').values_list('model', 'object_pk'))
+
+    def test_records_writes(self):
+        team = TeamFactory()
+        pk = str(team.pk)
+        team.name = 'renamed'
+        team.save()
+        Team.objects.filter(pk=team.pk).update(member_count=2)
+        Team.objects.bulk_create([Team(name='bulk')])
+        team.delete()
+        bulk = str(Team.objects.get(name='bulk').pk)
+        self.assertEqual(self._entries(), [('game.team', pk)] * 3 + [('game.team', bulk), ('game.team', pk)])
+
+    def test_records_game_transitions(self):
+        game = GameFactory(state='new')
+        OutboxEntry.objects.all().delete()
+        with mock.patch.object(game_state_transition_hook, 'delay'):
+            game.perform('queue')
+        self.assertEqual(self._entries(), [('game.game', str(game.pk))])
+
+    @override_settings(DATABASE_WRITE_MODE='remote')
+    def test_remote(self):
+        GameFactory()
+        self.assertEqual(OutboxEntry.objects.count(), 0)
+
+    def test_lag(self):
+        self.assertEqual(replication.lag(), {'replication_backlog': 0, 'replication_lag_seconds': 0})
+        TeamFactory()
+        self.assertEqual(replication.lag()['replication_backlog'], 1)
+
+
+@skipUnless('nuc' in settings.DATABASES, 'Requires a nuc database')
+@override_settings(DATABASE_WRITE_MODE='local', CELERY_TASK_ALWAYS_EAGER=True)
+class TestReplicate(APITransactionTestCase):
+    multi_db = True
+
+    def test_replicate(self):
+        game = GameFactory(state='new')
+        with mock.patch.object(game_state_transition_hook, 'delay'):
+            game.perform('queue')
+        replicated = replication.replicate_all(batch_size=2)
+        self.assertGreater(replicated, 0)
+        self.assertEqual(OutboxEntry.objects.count(), 0)
+        self.assertEqual(Game.objects.using('nuc').get(pk=game.pk).state, 'queued')
+        self.assertEqual(User.objects.using('nuc').get(pk=game.user.pk).active_game_id, game.pk)
+        Game.objects.filter(pk=game.pk).delete()
+        replication.replicate_all()
+        self.assertFalse(Game.objects.using('nuc').filter(pk=game.pk).exists())
+
+    def test_replay(self):
+        team = TeamFactory()
+        replication.replicate_all()
+        OutboxEntry.objects.create(model='game.team', object_pk=str(team.pk))
+        self.assertEqual(replication.replicate_all(), 1)
+        self.assertEqual(Team.objects.using('nuc').get(pk=team.pk).name, team.name)
+
+
+@skipUnless('nuc' in settings.DATABASES, 'Requires a nuc database')
+@override_settings(DATABASE_WRITE_MODE='remote')
+class TestRemoteWrites(APITransactionTestCase):
+    multi_db = True
+
+    def test_perform(self):
+        game = GameFactory(state='queued')
+        with mock.patch.object(game_state_transition_hook, 'delay'), \
+                mock.patch('game.signals.schedule_recall') as schedule_recall:
+            with transaction.atomic(using='nuc'):
+                game.perform('cancel')
+                schedule_recall.assert_not_called()
+            schedule_recall.assert_called_once_with()
+        self.assertEqual(Game.objects.using('nuc').get(pk=game.pk).state, 'cancelled')
+
+    @mock.patch('game.signals.queue_index.record')
+    @mock.patch('game.signals.events.publish')
+    @mock.patch.object(game_state_transition_hook, 'delay')
+    def test_transition_side_effects(self, _hook, _publish, _record):
+        game = GameFactory(state='new')
+        with transaction.atomic(using='nuc'):
+            game.perform('queue')
+            for side_effect in (_hook, _publish, _record):
+                side_effect.assert_not_called()
+        _hook.assert_called_once_with(game.pk, 'queued')
+        _publish.assert_called_once_with([mock.ANY])
+        _record.assert_called_once_with([mock.ANY])
+        with transaction.atomic(using='nuc'):
+            game.delete()
+            _record.assert_called_once_with([mock.ANY])
+        self.assertEqual(_record.call_count, 2)
+
+    @mock.patch.object(game_state_transition_hook, 'delay')
+    def test_confirm(self, _hook):
+        teams = [TeamFactory(), TeamFactory()]
+        PlayerUserFactory(team=teams[0])
+        game = GameFactory(user=PlayerUserFactory(team=None))
+        game.perform('confirm')
+        self.assertEqual(User.objects.using('nuc').get(pk=game.user.pk).team_id, teams[1].pk)
+        Team.objects.recount()
+        counts = Team.objects.using('nuc').filter(pk__in=[team.pk for team in teams])\
+                             .order_by('pk').values_list('member_count', flat=True)
+        self.assertEqual(list(counts), [1, 1])
+
+
+@override_settings(DATABASE_WRITE_MODE='remote', READ_PIN_SECONDS=10)
+class TestReadPinning(APITransactionTestCase):
+
+    def setUp(self):
+        self.router = router.GameRouter()
+        self.reads = []
+
+    def tearDown(self):
+        router.end_request()
+
+    def _view(self, write=False):
+        def get_response(request):
+            if write:
+                self.router.db_for_write(Game)
+            self.reads.append(self.router.db_for_read(Game))
+            return HttpResponse()
+        return ReadPinningMiddleware(get_response)
+
+    def test_router(self):
+        self.assertIsNone(self.router.db_for_read(Game))
+        router.start_request(pinned=True)
+        self.assertEqual(self.router.db_for_read(Game), 'nuc')
+        self.assertFalse(router.end_request())
+        router.start_request()
+        self.assertEqual(self.router.db_for_write(Game), 'nuc')
+        self.assertEqual(self.router.db_for_read(Game), 'nuc')
+        self.assertTrue(router.end_request())
+        self.assertIsNone(self.router.db_for_read(Game))
+
+    def test_write_outside_request(self):
+        self.assertEqual(self.router.db_for_write(Game), 'nuc')
+        self.assertIsNone(self.router.db_for_read(Game))
+        self._view()(RequestFactory().get('/games/1/'))
+        self.assertEqual(self.reads, [None])
+
+    def test_pins_after_write(self):
+        response = self._view(write=True)(RequestFactory().post('/games/'))
+        self.assertIn('read_pin', response.cookies)
+        self.assertEqual(response['X-Read-Pin'], response.cookies['read_pin'].value)
+        request = RequestFactory().get('/games/1/')
+        request.COOKIES['read_pin'] = response['X-Read-Pin']
+        response = self._view()(request)
+        self.assertNotIn('read_pin', response.cookies)
+        request = RequestFactory().get('/games/1/', HTTP_X_READ_PIN=str(time.time() + 5))
+        self._view()(request)
+        self.assertEqual(self.reads, ['nuc', 'nuc', 'nuc'])
+
+    def test_expired(self):
+        request = RequestFactory().get('/games/1/', HTTP_X_READ_PIN=str(time.time() - 1))
+        self._view()(request)
+        request = RequestFactory().get('/games/1/', HTTP_X_READ_PIN='nonsense')
+        self._view()(request)
+        self.assertEqual(self.reads, [None, None])
+
+    @override_settings(READ_PIN_SECONDS=0)
+    def test_disabled(self):
+        router.start_request(pinned=True)
+        response = self._view(write=True)(RequestFactory().post('/games/'))
+        self.assertNotIn('read_pin', response.cookies)
+        self.assertEqual(self.reads, [None])
+
+    @override_settings(DATABASE_WRITE_MODE='local')
+    def test_local_writes(self):
+        response = self._view(write=True)(RequestFactory().post('/games/'))
+        self.assertNotIn('read_pin', response.cookies)
+        self.assertEqual(self.reads, [None])
+
+
+class FailingDMXConnection:
+
+    def __init__(self, path):
+        pass
+
+    def setChannel(self, channel, value, autorender=False):
+        raise IOError()
+
+    def close(self):
+        pass
+
+
+INSTANT_SCENES = {event: {'steps': [{'channels': {channel: value}}]}
+                  for event, (channel, value) in settings.DMX_EVENTS.items()}
+
+
+@override_settings(DMX_CONNECTION='game.lighting.FakeDMXConnection', DMX_FPS=40, DMX_REFRESH_SECONDS=1,
+                   DMX_SCENES=INSTANT_SCENES)
+class TestDMXController(APITransactionTestCase):
+
+    def setUp(self):
+        self.controller = DMXController()
+
+    def test_coalesces_cues(self):
+        for event in ('LA', 'Boston', 'attractor'):
+            self.controller.cue(event, now=100)
+        self.assertTrue(self.controller.render_frame(now=100))
+        frames = self.controller.connection.frames
+        self.assertEqual(len(frames), 1)
+        self.assertEqual(frames[0][1], settings.DMX_EVENTS['attractor'][1])
+        self.assertFalse(self.controller.render_frame(now=100.5))
+        self.assertTrue(self.controller.render_frame(now=101.5))
+        self.assertEqual(len(frames), 2)
+
+    def test_universe(self):
+        self.controller.apply({'channels': {'3': 300, '4': 20}})
+        self.controller.cue('LA', now=100)
+        self.controller.render_frame(now=100)
+        frame = self.controller.connection.frames[-1]
+        self.assertEqual(frame[1:5], [settings.DMX_EVENTS['LA'][1], 0, 255, 20])
+        self.assertEqual(self.controller.status()['channels'],
+                         {'1': settings.DMX_EVENTS['LA'][1], '3': 255, '4': 20})
+
+    def test_reconnects(self):
+        self.controller.connection_class = FailingDMXConnection
+        self.controller.cue('LA', now=100)
+        self.assertFalse(self.controller.render_frame(now=100))
+        self.assertEqual(self.controller.errors, 1)
+        self.assertIsNone(self.controller.connection)
+        self.controller.connection_class = lighting.FakeDMXConnection
+        self.assertTrue(self.controller.render_frame(now=100.1))
+        self.assertEqual(self.controller.connection.frames[-1][1], settings.DMX_EVENTS['LA'][1])
+
+    def test_fade(self):
+        scenes = {'fade': {'steps': [{'channels': {2: 200, 3: 100}, 'fade': 2}]}}
+        controller = DMXController(scenes=scenes)
+        controller.set(4, 50)
+        controller.cue('fade', now=100)
+        self.assertEqual(list(controller.compute(100)[2:5]), [0, 0, 50])
+        self.assertEqual(list(controller.compute(101)[2:5]), [100, 50, 50])
+        self.assertEqual(list(controller.compute(103)[2:5]), [200, 100, 50])
+        self.assertIsNone(controller.playback)
+
+    def test_cue_channels_switch(self):
+        scenes = {'LA': {'steps': [{'channels': {1: 11, 2: 200}, 'fade': 2}]}}
+        controller = DMXController(scenes=scenes, cue_channels=[1])
+        controller.cue('LA', now=100)
+        self.assertEqual(list(controller.compute(100)[1:3]), [11, 0])
+        self.assertEqual(list(controller.compute(101)[1:3]), [11, 100])
+        self.assertTrue(DMXController().scenes['LA'].snap[settings.DMX_EVENTS['LA'][0]])
+
+    def test_fade_from_current(self):
+        scenes = {'up': {'steps': [{'channels': {0: 200}, 'fade': 2}]},
+                  'down': {'steps': [{'channels': {0: 0}, 'fade': 1}]}}
+        controller = DMXController(scenes=scenes)
+        controller.cue('up', now=100)
+        controller.cue('down', now=101)
+        self.assertEqual(controller.compute(101)[0], 100)
+        self.assertEqual(controller.compute(101.5)[0], 50)
+
+    def test_chase(self):
+        scenes = {'chase': {'loop': True, 'steps': [{'channels': {0: 255, 1: 0}, 'hold': 1},
+                                                    {'channels': {0: 0, 1: 255}, 'hold': 1}]}}
+        controller = DMXController(scenes=scenes)
+        controller.cue('chase', now=100)
+        frames = [list(controller.compute(100 + t)[:2]) for t in (0.5, 1.5, 2.5, 3.5, 10.5)]
+        self.assertEqual(frames, [[255, 0], [0, 255], [255, 0], [0, 255], [255, 0]])
+        self.assertIsNotNone(controller.playback)
+
+    def test_overrides_until_scene(self):
+        scenes = {'on': {'steps': [{'channels': {0: 10}}]}}
+        controller = DMXController(scenes=scenes)
+        controller.set(0, 99)
+        controller.set(1, 99)
+        controller.cue('on', now=100)
+        self.assertEqual(list(controller.compute(100)[:2]), [10, 99])
+
+    def test_renders_changed_channels(self):
+        self.controller.render_frame(now=100)
+        connection = self.controller.connection
+        with mock.patch.object(connection, 'setChannel') as _set_channel:
+            self.controller.cue('LA', now=101)
+            self.controller.render_frame(now=101)
+        _set_channel.assert_called_once_with(2, settings.DMX_EVENTS['LA'][1])
+
+    def test_status(self):
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as server, \
+                socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as client:
+            server.bind(('127.0.0.1', 0))
+            client.bind(('127.0.0.1', 0))
+            client.settimeout(1)
+            self.controller.cue('Boston')
+            self.controller.handle(server, b'{"status": true}', client.getsockname())
+            status = json.loads(client.recv(65536).decode())
+        self.assertEqual(status['last_event'], 'Boston')
+
+
+@override_settings(LIGHTING_DISABLE=False, DMX_CONTROLLER_HOST='127.0.0.1')
+class TestLightingView(AuthenticatedTestMixin, APITransactionTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.server.bind(('127.0.0.1', 0))
+        self.server.settimeout(1)
+
+    def tearDown(self):
+        self.server.close()
+
+    def test_sends_cue(self):
+        with self.settings(DMX_CONTROLLER_PORT=self.server.getsockname()[1]):
+            response = self.client.post('/lighting/', {'event': 'LA'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(self.server.recv(65536).decode()), {'event': 'LA'})
+
+    def test_status_unavailable(self):
+        with self.settings(DMX_CONTROLLER_PORT=self.server.getsockname()[1]):
+            with mock.patch('game.lighting.get_status', return_value=None):
+                response = self.client.get('/lighting/status/')
+        self.assertEqual(response.status_code, 503)
+
+
+@override_settings(EVENTS_REPLAY_SIZE=3, EVENTS_STREAM_SECONDS=1, EVENTS_HEARTBEAT_SECONDS=60)
+class TestGameEvents(RedisTestMixin, AuthenticatedTestMixin, APITransactionTestCase):
+
+    def _events(self, last_id=0):
+        return [(e['game'], e['source'], e['state']) for e in events.since(last_id)]
+
+    @mock.patch('game.tasks.render_souvenir.s')
+    @mock.patch.object(game_state_transition_hook, 'delay')
+    def test_transition(self, _hook, _render):
+        game = GameFactory(state='playing')
+        with transaction.atomic():
+            game.perform('complete', score=10, distance=5, homeruns=1)
+            self.assertEqual(events.since(0), [])
+        self.assertEqual(events.since(0), [{'id': 1, 'type': 'transition', 'game': game.pk,
+                                            'user': game.user_id, 'source': 'playing',
+                                            'state': 'completed', 'score': 10, 'distance': 5,
+                                            'homeruns': 1}])
+
+    @mock.patch('game.models.game_state_transition_hooks.delay')
+    def test_bulk_transition(self, _hooks):
+        games = [GameFactory(state='new') for i in range(2)]
+        self.client.post(reverse('game-bulk-transition'),
+                         {'target': 'queued', 'games': [{'id': game.pk} for game in games]},
+                         format='json')
+        self.assertEqual(self._events(), [(game.pk, 'new', 'queued') for game in games])
+
+    @override_settings(RECALL_WINDOW_SIZE=2)
+    @mock.patch('game.models.send_sms_batch.delay')
+    @mock.patch.object(game_state_transition_hook, 'delay')
+    def test_recall(self, _hook, _sms):
+        games = [GameFactory(state='queued') for i in range(3)]
+        Game.objects.recall_next()
+        self.assertEqual(self._events(), [(game.pk, 'queued', 'recalled') for game in games[:2]])
+
+    def test_replay(self):
+        events.publish([{'type': 'transition', 'game': i} for i in range(5)])
+        self.assertEqual([e['id'] for e in events.since(0)], [3, 4, 5])
+        self.assertEqual([e['id'] for e in events.since(4)], [5])
+        self.assertEqual(list(events.stream(5)), ['retry: 1000\n\n'])
+        output = ''.join(events.stream(3))
+        self.assertNotIn('reset', output)
+        self.assertEqual(output.count('event: transition'), 2)
+        self.assertIn('id: 4\n', output)
+        self.assertIn('event: reset', ''.join(events.stream(1)))
+
+    def test_live(self):
+        stream = events.stream(duration=2)
+        self.assertEqual(next(stream), 'retry: 1000\n\n')
+        events.publish([{'type': 'transition', 'game': 1}])
+        self.assertTrue(next(stream).startswith('id: 1\nevent: transition\n'))
+        stream.close()
+
+    @override_settings(EVENTS_REPLAY_SIZE=100)
+    def test_concurrent_publish(self):
+        stream = events.stream(duration=2)
+        next(stream)
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            list(executor.map(events.publish, [[{'type': 'transition', 'game': i}] * 5 for i in range(4)]))
+        self.assertEqual([e['id'] for e in events.since(0)], list(range(1, 21)))
+        ids = [int(next(stream).split('\n')[0][len('id: '):]) for i in range(20)]
+        stream.close()
+        self.assertEqual(ids, list(range(1, 21)))
+
+    def test_view(self):
+        events.publish([{'type': 'transition', 'game': 1}, {'type': 'transition', 'game': 2}])
+        response = self.client.get('/events/', HTTP_LAST_EVENT_ID='1', HTTP_ACCEPT='text/event-stream')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        self.assertEqual(response['Cache-Control'], 'no-cache')
+        output = b''.join(response.streaming_content).decode()
+        self.assertIn('id: 2\n', output)
+        self.assertNotIn('id: 1\n', output)
+        response = self.client.get('/events/', {'last_event_id': 'x'})
+        self.assertEqual(response.status_code, 400)
+
+
+@override_settings(QUEUE_LANES=1, QUEUE_DEFAULT_PLAY_SECONDS=100)
+class TestQueueIndex(RedisTestMixin, AuthenticatedTestMixin, APITransactionTestCase):
+
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch.object(game_state_transition_hook, 'delay')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.games = [GameFactory() for i in range(3)]
+        for game in self.games:
+            game.perform('queue')
+
+    def _position(self, game):
+        response = self.client.get(reverse('game-position', args=(game.pk,)))
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_positions(self):
+        data = self._position(self.games[1])
+        self.assertEqual((data['position'], data['ahead'], data['estimated_wait']), (2, 1, 100))
+        self.games[0].perform('confirm')
+        data = self._position(self.games[1])
+        self.assertEqual((data['position'], data['ahead']), (1, 1))
+        self.games[0].perform('cancel')
+        data = self._position(self.games[2])
+        self.assertEqual((data['position'], data['ahead']), (2, 1))
+        data = self._position(self.games[0])
+        self.assertEqual((data['state'], data['position']), ('cancelled', None))
+
+    @mock.patch('game.tasks.render_souvenir.s')
+    def test_play_durations(self, _render):
+        game = self.games[0]
+        game.perform('confirm')
+        game.perform('play')
+        game.date_playing = timezone.now() - datetime.timedelta(seconds=60)
+        game.perform('complete', score=1, distance=1, homeruns=0)
+        data = self.client.get(reverse('game-queue-summary')).data
+        self.assertEqual((data['queued'], data['active']), (2, 0))
+        self.assertAlmostEqual(data['average_play_seconds'], 60, places=0)
+        self.assertAlmostEqual(data['estimated_wait'], 120, places=0)
+
+    @mock.patch('game.models.send_sms_batch.delay')
+    def test_recall(self, _sms):
+        Game.objects.recall_next(max_recalls=1)
+        self.assertIsNone(queue_index.position(self.games[0].pk))
+        self.assertEqual(queue_index.position(self.games[1].pk)['position'], 1)
+
+    def test_rebuild(self):
+        queued = GameFactory(state='queued')
+        self.assertIsNone(queue_index.position(queued.pk))
+        get_redis().flushdb()
+        call_command('rebuild_queue_index', stdout=mock.Mock())
+        self.assertEqual(queue_index.summary()['queued'], 4)
+        self.assertEqual(queue_index.position(queued.pk)['position'], 4)
+
+
+@override_settings(QUEUE_LANES=1, RECALL_WINDOW_MIN=1, RECALL_WINDOW_MAX=8, RECALL_WINDOW_MINUTES=20,
+                   RECALL_STATS_MINUTES=60, QUEUE_DEFAULT_PLAY_SECONDS=180,
+                   RECALL_DEFAULT_CONFIRM_SECONDS=300, RECALL_DEBOUNCE_SECONDS=0)
+class TestRecallPolicy(APITransactionTestCase):
+
+    def _stats(self, **kwargs):
+        values = dict(playing=1, confirmed=0, recalled=0, overdue=0, play_seconds=180,
+                      confirm_seconds=300, no_show_rate=0.0)
+        values.update(kwargs)
+        return RecallStats(**values)
+
+    def test_adaptive(self):
+        policy = AdaptiveRecallPolicy()
+        self.assertEqual(policy.window_size(self._stats()), 2)
+        self.assertEqual(policy.window_size(self._stats(confirmed=1)), 1)
+        self.assertEqual(policy.window_size(self._stats(confirm_seconds=60)), 1)
+        self.assertEqual(policy.window_size(self._stats(confirm_seconds=60, confirmed=2)), 1)
+        self.assertEqual(policy.window_size(self._stats(no_show_rate=0.5)), 4)
+        self.assertEqual(policy.window_size(self._stats(overdue=1)), 3)
+        self.assertEqual(policy.window_size(self._stats(confirm_seconds=3600)), 8)
+        self.assertEqual(AdaptiveRecallPolicy(lanes=2).window_size(self._stats()), 4)
+
+    def test_measure(self):
+        now = timezone.now()
+        minutes = lambda m: now - datetime.timedelta(minutes=m)
+        GameFactory(state='completed', date_recalled=minutes(40), date_confirmed=minutes(35),
+                    date_playing=minutes(9), date_completed=minutes(5))
+        GameFactory(state='recalled', date_recalled=minutes(30))
+        GameFactory(state='playing', date_recalled=minutes(6), date_confirmed=minutes(4),
+                    date_playing=minutes(3))
+        recalled = GameFactory(state='recalled', date_recalled=minutes(12))
+        Game.objects.filter(pk=recalled.pk).update(date_updated=minutes(12))
+        stats = measure_stats(Game.objects.all(), now=now)
+        self.assertEqual((stats.playing, stats.confirmed, stats.recalled), (1, 0, 2))
+        self.assertEqual(stats.overdue, 1)
+        self.assertAlmostEqual(stats.play_seconds, 240)
+        self.assertAlmostEqual(stats.confirm_seconds, 210)
+        self.assertEqual(stats.no_show_rate, 0.5)
+        with self.settings(RECALL_STATS_SAMPLES=1):
+            self.assertEqual(measure_stats(Game.objects.all(), now=now).no_show_rate, 1.0)
+
+    @mock.patch('game.models.send_sms_batch.delay')
+    @mock.patch.object(game_state_transition_hook, 'delay')
+    def test_recall_next(self, _hook, _sms):
+        games = [GameFactory(state='queued') for i in range(5)]
+        with self.settings(RECALL_POLICY='game.recall.AdaptiveRecallPolicy'):
+            self.assertEqual(Game.objects.recall_next(), games[:2])
+        with self.settings(RECALL_POLICY='game.recall.FixedRecallPolicy', RECALL_WINDOW_SIZE=3):
+            self.assertEqual(Game.objects.recall_next(), games[2:3])
+        self.assertEqual(Game.objects.recall_next(max_recalls=4), games[3:4])
+
+    def test_historical_games(self):
+        now = timezone.now()
+        seconds = lambda s: now + datetime.timedelta(seconds=s)
+        played = GameFactory(state='completed', date_queued=seconds(0), date_recalled=seconds(10),
+                             date_confirmed=seconds(70), date_playing=seconds(80), date_completed=seconds(200))
+        missed = GameFactory(state='recalled', date_queued=seconds(5), date_recalled=seconds(10))
+        GameFactory(state='new')
+        games = historical_games(Game.objects.all())
+        self.assertEqual(games, [SimulatedGame(played.pk, seconds(0).timestamp(), 60, 120, False),
+                                 SimulatedGame(missed.pk, seconds(5).timestamp(), None, None, True)])
+
+    def test_simulation(self):
+        # Players take ten minutes to arrive and play for three, so keeping
+        # two recalled leaves the bay idle.
+        games = [SimulatedGame(i, i * 150, 600, 180, False) for i in range(40)]
+        fixed = RecallSimulation(games, FixedRecallPolicy(2)).run()
+        adaptive = RecallSimulation(games, AdaptiveRecallPolicy()).run()
+        self.assertEqual((fixed.played, adaptive.played), (40, 40))
+        self.assertLess(fixed.utilization, 0.6)
+        self.assertGreater(adaptive.utilization, 0.85)
+        self.assertLess(adaptive.starved_seconds, fixed.starved_seconds)
+        self.assertLess(adaptive.mean_queue_wait, fixed.mean_queue_wait)
+
+    def test_simulation_no_shows(self):
+        games = [SimulatedGame(i, 0, 60, 180, i % 2 == 0) for i in range(6)]
+        result = RecallSimulation(games, FixedRecallPolicy(1), expire_seconds=1200).run()
+        self.assertEqual((result.played, result.no_shows), (3, 3))
+
+    def test_command(self):
+        GameFactory(state='completed', date_queued=timezone.now())
+        stdout = mock.Mock()
+        call_command('simulate_recalls', '--policy', 'game.recall.AdaptiveRecallPolicy', stdout=stdout)
+        self.assertIn('AdaptiveRecallPolicy: played 1', stdout.write.call_args[0][0])
@@ -1,6 +1,12 @@
 
 import os
+import hashlib
+from functools import lru_cache
+
 import environ
+import redis
+from django.conf import settings
+from django.db import connections
 
 
 class Env(environ.Env):
@@ -19,3 +25,26 @@ class Env(environ.Env):
         if os.path.exists(path):
             return open(path).read().rstrip()
         return super().get_value(value, **kwargs)
+
+
+@lru_cache()
+def _redis_client(url):
+    return redis.StrictRedis.from_url(url)
+
+
+def get_redis():
+    """Return a redis client shared by this process."""
+    return _redis_client(settings.REDIS_URL)
+
+
+def advisory_lock(name, using='default'):
+    """Hold a postgres advisory lock named `name` until the transaction ends.
+
+    Other databases have no advisory locks, so this does nothing there.
+    """
+    connection = connections[using]
+    if connection.vendor != 'postgresql':
+        return
+    key = int.from_bytes(hashlib.sha1(name.encode()).digest()[:8], 'big', signed=True)
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT pg_advisory_xact_lock(%s)', [key])
@@ -1,39 +1,82 @@
+import csv
+import hashlib
+import logging
+import datetime
+import itertools
+from collections import OrderedDict
+
 from django.db.models import Sum
-from django.db.models.functions import Trunc
+from django.db.models.functions import Coalesce
+from django.http import Http404, HttpResponseRedirect, JsonResponse, StreamingHttpResponse
+from django.utils.cache import patch_vary_headers
+from django.utils.text import compress_sequence
+from django.shortcuts import get_object_or_404
+from django.utils import timezone
+from django.views.decorators.http import condition, require_GET
 from django.conf import settings
 
 from rest_framework import viewsets, status, filters
 from rest_framework.settings import api_settings
-from rest_framework.decorators import api_view
+from rest_framework.decorators import api_view, permission_classes
+from rest_framework.permissions import IsAdminUser
 from rest_framework.renderers import TemplateHTMLRenderer
 from rest_framework.response import Response
-from rest_framework.decorators import detail_route
+from rest_framework.decorators import detail_route, list_route
 from rest_framework_csv.renderers import CSVRenderer
+from redis import RedisError
 from django_filters.rest_framework import DjangoFilterBackend, FilterSet, CharFilter, DateFilter
-from django_fsm import can_proceed
-from pysimpledmx.pysimpledmx import DMXConnection
+from django_fsm import can_proceed, ConcurrentTransition
 
-from .models import User, Game, Team
+from . import metrics, leaderboard, replication, lighting, events, queue_index
+from .models import User, Game, Team, ShortURL
+from .shortener import decode
+from .pagination import OrderedCursorPagination
 from .serializers import (UserSerializer, GameSerializer, GameScoreSerializer,
-                          TeamSerializer, LightingSerializer)
+                          TeamSerializer, LightingSerializer, LeaderboardSerializer,
+                          BulkTransitionSerializer)
+
+
+logger = logging.getLogger(__name__)
 
 
 class DateFilterMixin:
+    """Filter timestamps by day in the current time zone.
+
+    Days are matched as half-open ranges of timestamps rather than by
+    truncating each row, so the filters can use the date indexes.
+    """
+
+    def day_start(self, value):
+        return timezone.make_aware(datetime.datetime.combine(value, datetime.time.min))
 
     def filter_date(self, queryset, name, value):
-        annotate_name = '{}_date'.format(name)
-        return queryset.annotate(**{annotate_name: Trunc(name, 'day')})\
-                       .filter(**{annotate_name: value})
+        start = self.day_start(value)
+        end = self.day_start(value + datetime.timedelta(days=1))
+        return queryset.filter(**{'{}__gte'.format(name): start, '{}__lt'.format(name): end})
+
+    def filter_date_after(self, queryset, name, value):
+        return queryset.filter(**{'{}__gte'.format(name): self.day_start(value)})
+
+    def filter_date_before(self, queryset, name, value):
+        end = self.day_start(value + datetime.timedelta(days=1))
+        return queryset.filter(**{'{}__lt'.format(name): end})
 
 
 class TeamViewSet(viewsets.ModelViewSet):
     queryset = Team.objects.all()
     serializer_class = TeamSerializer
 
+    def get_queryset(self):
+        return self.get_serializer_class().setup_eager_loading(super().get_queryset())
+
 
 class UserFilter(FilterSet, DateFilterMixin):
     game_created = DateFilter(name='active_game__date_created', method='filter_date')
     game_updated = DateFilter(name='active_game__date_updated', method='filter_date')
+    game_created_after = DateFilter(name='active_game__date_created', method='filter_date_after')
+    game_created_before = DateFilter(name='active_game__date_created', method='filter_date_before')
+    game_updated_after = DateFilter(name='active_game__date_updated', method='filter_date_after')
+    game_updated_before = DateFilter(name='active_game__date_updated', method='filter_date_before')
     state = CharFilter(name='active_game__state')
     team = CharFilter(name='team__name')
 
@@ -43,8 +86,9 @@ class UserFilter(FilterSet, DateFilterMixin):
 
 
 class UserViewSet(viewsets.ModelViewSet):
-    queryset = User.objects.all().annotate(score=Sum('games__score'))
+    queryset = User.objects.all().annotate(score=Coalesce(Sum('games__score'), 0))
     serializer_class = UserSerializer
+    pagination_class = OrderedCursorPagination
     filter_backends = (DjangoFilterBackend, filters.OrderingFilter)
     filter_class = UserFilter
     ordering_fields = ('score', 'date_updated', 'date_created',
@@ -53,12 +97,17 @@ class UserViewSet(viewsets.ModelViewSet):
     ordering = 'active_game__date_updated'
 
     def get_queryset(self):
-        return self.queryset.filter(is_staff=False, is_superuser=False, is_active=True)
+        queryset = self.queryset.filter(is_staff=False, is_superuser=False, is_active=True)
+        return self.get_serializer_class().setup_eager_loading(queryset)
 
 
 class GameFilter(FilterSet, DateFilterMixin):
     date_created = DateFilter(method='filter_date')
     date_updated = DateFilter(method='filter_date')
+    date_created_after = DateFilter(name='date_created', method='filter_date_after')
+    date_created_before = DateFilter(name='date_created', method='filter_date_before')
+    date_updated_after = DateFilter(name='date_updated', method='filter_date_after')
+    date_updated_before = DateFilter(name='date_updated', method='filter_date_before')
     team = CharFilter(name='user__team__name')
 
     class Meta:
@@ -66,81 +115,155 @@ class GameFilter(FilterSet, DateFilterMixin):
         fields = ('state', 'date_created', 'date_updated', 'team')
 
 
+class Echo:
+    """A file-like object that returns what is written, for streaming csv."""
+
+    def write(self, value):
+        return value
+
+
 class GameViewSet(viewsets.ModelViewSet):
     queryset = Game.objects.all()
     serializer_class = GameSerializer
     filter_backends = (DjangoFilterBackend, filters.OrderingFilter)
-    ordering_fields = ('score',)
+    ordering_fields = ('score', 'date_created')
+    ordering = 'date_created'
     filter_class = GameFilter
+    pagination_class = OrderedCursorPagination
     renderer_classes = api_settings.DEFAULT_RENDERER_CLASSES + [CSVRenderer]
+    csv_columns = OrderedDict([
+        ('id', 'id'),
+        ('user_id', 'user_id'),
+        ('first_name', 'user__first_name'),
+        ('last_name', 'user__last_name'),
+        ('team', 'user__team__name'),
+        ('show_id', 'show_id'),
+        ('show', 'show__name'),
+        ('state', 'state'),
+        ('score', 'score'),
+        ('distance', 'distance'),
+        ('homeruns', 'homeruns'),
+        ('date_created', 'date_created'),
+        ('date_queued', 'date_queued'),
+        ('date_recalled', 'date_recalled'),
+        ('date_confirmed', 'date_confirmed'),
+        ('date_playing', 'date_playing'),
+        ('date_completed', 'date_completed'),
+        ('date_cancelled', 'date_cancelled'),
+    ])
 
-    @detail_route(methods=['POST'])
-    def confirm(self, request, pk=None):
+    def get_queryset(self):
+        return self.get_serializer_class().setup_eager_loading(super().get_queryset())
+
+    def list(self, request, *args, **kwargs):
+        if request.accepted_renderer.format == 'csv':
+            return self.export_csv(request)
+        return super().list(request, *args, **kwargs)
+
+    def export_csv(self, request):
+        """Stream filtered games as csv, optionally gzipped.
+
+        Rows are read through a server side cursor and written as they are
+        fetched, so memory use doesn't grow with the number of games.
+        `?fields=` selects a subset of `csv_columns`.
+        """
+        columns = list(self.csv_columns)
+        if request.query_params.get('fields'):
+            columns = request.query_params['fields'].split(',')
+            unknown = [column for column in columns if column not in self.csv_columns]
+            if unknown:
+                error = {'error': 'Unknown fields: {}'.format(', '.join(unknown))}
+                return Response(error, status=status.HTTP_400_BAD_REQUEST)
+        queryset = self.filter_queryset(Game.objects.all())
+        rows = queryset.values_list(*[self.csv_columns[column] for column in columns]).iterator()
+        writer = csv.writer(Echo())
+        lines = (writer.writerow(row) for row in rows)
+        content = (line.encode() for line in itertools.chain([writer.writerow(columns)], lines))
+        gzipped = 'gzip' in request.META.get('HTTP_ACCEPT_ENCODING', '')
+        if gzipped:
+            content = compress_sequence(content)
+        response = StreamingHttpResponse(content, content_type='text/csv')
+        response['Content-Disposition'] = 'attachment; filename="games.csv"'
+        if gzipped:
+            response['Content-Encoding'] = 'gzip'
+        patch_vary_headers(response, ('Accept-Encoding',))
+        return response
+
+    def transition(self, name, target, **kwargs):
         game = self.get_object()
-        if not can_proceed(game.confirm):
-            error = {'error': 'Illegal state change {} -> {}'.format(game.state, 'confirmed')}
+        if not can_proceed(getattr(game, name)):
+            error = {'error': 'Illegal state change {} -> {}'.format(game.state, target)}
             return Response(error, status=status.HTTP_400_BAD_REQUEST)
-        game.confirm()
-        game.save()
+        try:
+            game.perform(name, **kwargs)
+        except ConcurrentTransition:
+            error = {'error': 'Concurrent state change {} -> {}'.format(game.state, target)}
+            return Response(error, status=status.HTTP_409_CONFLICT)
         serializer = self.get_serializer(game)
         return Response(serializer.data)
 
+    @detail_route(methods=['POST'])
+    def confirm(self, request, pk=None):
+        return self.transition('confirm', 'confirmed')
+
     @detail_route(methods=['POST'])
     def queue(self, request, pk=None):
-        game = self.get_object()
-        if not can_proceed(game.queue):
-            error = {'error': 'Illegal state change {} -> {}'.format(game.state, 'queued')}
-            return Response(error, status=status.HTTP_400_BAD_REQUEST)
-        game.queue()
-        game.save()
-        serializer = self.get_serializer(game)
-        return Response(serializer.data)
+        return self.transition('queue', 'queued')
 
     @detail_route(methods=['POST'])
     def play(self, request, pk=None):
-        game = self.get_object()
-        if not can_proceed(game.play):
-            error = {'error': 'Illegal state change {} -> {}'.format(game.state, 'playing')}
-            return Response(error, status=status.HTTP_400_BAD_REQUEST)
-        game.play()
-        game.save()
-        serializer = self.get_serializer(game)
-        return Response(serializer.data)
+        return self.transition('play', 'playing')
 
     @detail_route(methods=['POST'])
     def recall(self, request, pk=None):
-        game = self.get_object()
-        if not can_proceed(game.recall):
-            error = {'error': 'Illegal state change {} -> {}'.format(game.state, 'recalled')}
-            return Response(error, status=status.HTTP_400_BAD_REQUEST)
-        game.recall()
-        game.save()
-        serializer = self.get_serializer(game)
-        return Response(serializer.data)
+        return self.transition('recall', 'recalled')
 
     @detail_route(methods=['POST'])
     def complete(self, request, pk=None):
-        game = self.get_object()
         serializer = GameScoreSerializer(data=request.data)
         if serializer.is_valid():
-            if not can_proceed(game.complete):
-                error = {'error': 'Illegal state change {} -> {}'.format(game.state, 'completed')}
-                return Response(error, status=status.HTTP_400_BAD_REQUEST)
-            game.save()
-            game.complete(**serializer.data)
-            game.save()
-            serializer = self.get_serializer(game)
-            return Response(serializer.data)
+            return self.transition('complete', 'completed', **serializer.data)
         else:
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
     @detail_route(methods=['POST'])
     def cancel(self, request, pk=None):
+        return self.transition('cancel', 'cancelled')
+
+    @list_route(methods=['POST'])
+    def bulk_transition(self, request):
+        serializer = BulkTransitionSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        results = Game.objects.bulk_perform(serializer.validated_data['target'], serializer.transitions)
+        data = []
+        for pk, result in results.items():
+            if isinstance(result, Game):
+                data.append({'id': pk, 'state': result.state})
+            else:
+                data.append({'id': pk, 'error': result})
+        return Response({'results': data})
+
+    @detail_route(methods=['GET'])
+    def position(self, request, pk=None):
         game = self.get_object()
-        game.cancel()
-        game.save()
-        serializer = self.get_serializer(game)
-        return Response(serializer.data)
+        try:
+            data = queue_index.position(game.pk) if game.state == 'queued' else None
+        except RedisError:
+            logger.exception('Failed to read the queue index')
+            return Response({'error': 'Queue positions are unavailable'},
+                            status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        data = data or {'position': None, 'ahead': None, 'estimated_wait': None}
+        return Response(dict(data, id=game.pk, state=game.state))
+
+    @list_route(methods=['GET'])
+    def queue_summary(self, request):
+        try:
+            return Response(queue_index.summary())
+        except RedisError:
+            logger.exception('Failed to read the queue index')
+            return Response({'error': 'Queue positions are unavailable'},
+                            status=status.HTTP_503_SERVICE_UNAVAILABLE)
 
     @detail_route(methods=['GET'])
     def souvenir(self, request, pk=None):
@@ -156,10 +279,104 @@ def set_lighting(request):
     if serializer.is_valid():
         event = serializer.data['event']
         if not settings.LIGHTING_DISABLE:
-            dmx = DMXConnection(settings.DMX_PATH)
-            channel, value = settings.DMX_EVENTS[event]
-            dmx.setChannel(channel+1, value)
-            dmx.render()
+            try:
+                lighting.send_cue(event)
+            except OSError:
+                logger.exception('Failed to send lighting cue')
+                return Response({'error': 'Lighting is unavailable'},
+                                status=status.HTTP_503_SERVICE_UNAVAILABLE)
         return Response({'received': event})
     else:
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+
+@api_view(['GET'])
+def get_lighting_status(request):
+    data = lighting.get_status()
+    if data is None:
+        return Response({'error': 'Lighting controller is not responding'},
+                        status=status.HTTP_503_SERVICE_UNAVAILABLE)
+    return Response(data)
+
+
+@api_view(['GET'])
+@permission_classes((IsAdminUser,))
+def get_metrics(request):
+    data = metrics.counters()
+    if replication.enabled():
+        data.update(replication.lag())
+    return Response(data)
+
+
+@require_GET
+def get_events(request):
+    """Stream game state changes as server-sent events.
+
+    This is a plain view because DRF's content negotiation would refuse the
+    `text/event-stream` accept header browsers send for EventSource.
+    """
+    last_id = request.META.get('HTTP_LAST_EVENT_ID') or request.GET.get('last_event_id')
+    try:
+        last_id = int(last_id) if last_id else None
+    except ValueError:
+        return JsonResponse({'last_event_id': ['A valid integer is required.']}, status=400)
+    try:
+        stream = events.stream(last_id)
+    except RedisError:
+        logger.exception('Failed to subscribe to game events')
+        return JsonResponse({'error': 'Events are unavailable'}, status=503)
+    response = StreamingHttpResponse(stream, content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+def follow_short_url(request, code):
+    link = ShortURL.objects.filter(code=code).first()
+    if link is None:
+        # Links made before random codes were stored encode the id.
+        try:
+            pk = decode(code)
+        except ValueError:
+            raise Http404()
+        link = get_object_or_404(ShortURL, pk=pk, code=None)
+    return HttpResponseRedirect(link.long_url)
+
+
+def leaderboard_etag(request):
+    version = leaderboard.version()
+    if version is None:
+        return None
+    query = hashlib.md5(request.get_full_path().encode()).hexdigest()
+    return '{}-{}'.format(version, query)
+
+
+def leaderboard_last_modified(request):
+    return leaderboard.last_updated()
+
+
+@condition(etag_func=leaderboard_etag, last_modified_func=leaderboard_last_modified)
+@api_view(['GET'])
+def get_leaderboard(request):
+    serializer = LeaderboardSerializer(data=request.query_params)
+    if not serializer.is_valid():
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+    scope, limit = serializer.scope, serializer.validated_data['limit']
+    players = leaderboard.top('players', scope, limit)
+    teams = leaderboard.top('teams', scope, limit)
+    users = User.objects.select_related('team').in_bulk([pk for pk, score in players])
+    team_names = dict(Team.objects.filter(pk__in=[pk for pk, score in teams])
+                                  .values_list('pk', 'name'))
+    data = {'scope': scope, 'players': [], 'teams': []}
+    for rank, (pk, score) in enumerate(players, 1):
+        if pk in users:
+            user = users[pk]
+            data['players'].append({'rank': rank, 'id': pk, 'score': score,
+                                    'first_name': user.first_name,
+                                    'last_name': user.last_name,
+                                    'team': user.team.name if user.team else None})
+    for rank, (pk, score) in enumerate(teams, 1):
+        if pk in team_names:
+            data['teams'].append({'rank': rank, 'id': pk, 'score': score,
+                                  'name': team_names[pk]})
+    return Response(data)
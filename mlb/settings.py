@@ -2,6 +2,7 @@
 import os
 import raven
 import environ
+from corsheaders.defaults import default_headers
 from game.util import Env
 root = environ.Path(__file__) - 2
 env = Env('/run/secrets', DEBUG=(bool, False),)
@@ -43,6 +44,7 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'corsheaders.middleware.CorsMiddleware',
+    'game.middleware.ReadPinningMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -129,26 +131,75 @@ REST_FRAMEWORK = {
     ),
 }
 
+API_PAGE_SIZE = env.int('API_PAGE_SIZE', default=100)
+API_MAX_PAGE_SIZE = env.int('API_MAX_PAGE_SIZE', default=1000)
+
 DJANGO_HOST = env('DJANGO_HOST', default='django:8000')
 
+REDIS_URL = env('REDIS_URL', default='redis://redis:6379/1')
+
 CELERY_BROKER_URL = env('CELERY_BROKER_URL', default='redis://redis:6379/0')
 CELERY_TASK_ALWAYS_EAGER = env.bool('CELERY_TASK_ALWAYS_EAGER', default=False)
+CELERY_RESULT_BACKEND = env('CELERY_RESULT_BACKEND', default='redis://redis:6379/0')
+CELERY_TASK_IGNORE_RESULT = True
 CELERY_BEAT_SCHEDULE = {
     'periodic-recall': {
         'task': 'game.tasks.periodic_recall',
         'schedule': 30.0
+    },
+    'replicate-outbox': {
+        'task': 'game.tasks.replicate_outbox',
+        'schedule': env.float('REPLICATION_INTERVAL', default=5.0)
     }
 }
 
 BITLY_TOKEN = env('BITLY_TOKEN', default=None)
+SHORTENER_BACKEND = env('SHORTENER_BACKEND', default='game.shortener.BitlyBackend')
+SHORTENER_HOST = env('SHORTENER_HOST', default=DJANGO_HOST)
+SHORTENER_TIMEOUT = env.float('SHORTENER_TIMEOUT', default=3)
+SHORTENER_POOL_SIZE = env.int('SHORTENER_POOL_SIZE', default=10)
+SHORTENER_CODE_BYTES = env.int('SHORTENER_CODE_BYTES', default=6)
+
+SOUVENIR_RENDERER = env('SOUVENIR_RENDERER', default='game.rendering.BrowserRenderer')
+SOUVENIR_BROWSERS = env.int('SOUVENIR_BROWSERS', default=1)
+SOUVENIR_BROWSER_PAGES = env.int('SOUVENIR_BROWSER_PAGES', default=2)
+SOUVENIR_BROWSER_MAX_RENDERS = env.int('SOUVENIR_BROWSER_MAX_RENDERS', default=100)
+SOUVENIR_RENDER_CONCURRENCY = env.int('SOUVENIR_RENDER_CONCURRENCY', default=2)
+SOUVENIR_BATCH_SIZE = env.int('SOUVENIR_BATCH_SIZE', default=200)
+SOUVENIR_BATCH_CHUNK_SIZE = env.int('SOUVENIR_BATCH_CHUNK_SIZE', default=20)
+SOUVENIR_UPLOAD_THREADS = env.int('SOUVENIR_UPLOAD_THREADS', default=8)
+
+LEADERBOARD_SIZE = env.int('LEADERBOARD_SIZE', default=10)
+LEADERBOARD_MAX_SIZE = env.int('LEADERBOARD_MAX_SIZE', default=100)
+
+EVENTS_REPLAY_SIZE = env.int('EVENTS_REPLAY_SIZE', default=1000)
+EVENTS_STREAM_SECONDS = env.int('EVENTS_STREAM_SECONDS', default=300)
+EVENTS_HEARTBEAT_SECONDS = env.int('EVENTS_HEARTBEAT_SECONDS', default=15)
+EVENTS_RETRY_MS = env.int('EVENTS_RETRY_MS', default=1000)
 
 LIGHTING_DISABLE = env.bool('LIGHTING_DISABLE', default=False)
 
 RECALL_DISABLE = env.bool('RECALL_DISABLE', default=False)
-RECALL_WINDOW_SIZE = env('RECALL_WINDOW_SIZE', default=2)
-RECALL_WINDOW_MINUTES = env('RECALL_WINDOW_MINUTES', default=20)
+RECALL_POLICY = env('RECALL_POLICY', default='game.recall.FixedRecallPolicy')
+RECALL_WINDOW_SIZE = env.int('RECALL_WINDOW_SIZE', default=2)
+RECALL_WINDOW_MINUTES = env.int('RECALL_WINDOW_MINUTES', default=20)
+RECALL_WINDOW_MIN = env.int('RECALL_WINDOW_MIN', default=1)
+RECALL_WINDOW_MAX = env.int('RECALL_WINDOW_MAX', default=8)
+RECALL_STATS_MINUTES = env.int('RECALL_STATS_MINUTES', default=60)
+RECALL_STATS_SAMPLES = env.int('RECALL_STATS_SAMPLES', default=50)
+RECALL_DEFAULT_CONFIRM_SECONDS = env.float('RECALL_DEFAULT_CONFIRM_SECONDS', default=300)
+RECALL_DEBOUNCE_SECONDS = env.int('RECALL_DEBOUNCE_SECONDS', default=1)
 RECALL_SENDER_ID = env('RECALL_SENDER_ID', default='MLB')
 
+QUEUE_LANES = env.int('QUEUE_LANES', default=1)
+QUEUE_DURATION_SAMPLES = env.int('QUEUE_DURATION_SAMPLES', default=20)
+QUEUE_DEFAULT_PLAY_SECONDS = env.float('QUEUE_DEFAULT_PLAY_SECONDS', default=180)
+
+SMS_BACKEND = env('SMS_BACKEND', default='game.sms.SNSBackend')
+SMS_THREADS = env.int('SMS_THREADS', default=10)
+SMS_RETRIES = env.int('SMS_RETRIES', default=3)
+SMS_RETRY_DELAY = env.float('SMS_RETRY_DELAY', default=1)
+
 AWS_ACCESS_KEY_ID = env('AWS_ACCESS_KEY_ID', default=None)
 AWS_SECRET_ACCESS_KEY = env('AWS_SECRET_ACCESS_KEY', default=None)
 AWS_REGION_NAME = env('AWS_REGION_NAME', default='eu-west-1')
@@ -157,6 +208,8 @@ AWS_QUERYSTRING_AUTH = False
 
 CORS_ORIGIN_ALLOW_ALL = env.bool('CORS_ORIGIN_ALLOW_ALL', default=False)
 CORS_ORIGIN_WHITELIST = env.list('CORS_ORIGIN_WHITELIST', default='localhost:8000')
+CORS_ALLOW_HEADERS = default_headers + ('x-read-pin',)
+CORS_EXPOSE_HEADERS = ['X-Read-Pin']
 
 import datetime
 JWT_AUTH = {
@@ -164,15 +217,38 @@ JWT_AUTH = {
 }
 
 DMX_PATH = env('DMX_PATH', default='/dev/ttyUSB0')
+DMX_CONNECTION = env('DMX_CONNECTION', default='pysimpledmx.pysimpledmx.DMXConnection')
+DMX_CONTROLLER_HOST = env('DMX_CONTROLLER_HOST', default='127.0.0.1')
+DMX_CONTROLLER_PORT = env.int('DMX_CONTROLLER_PORT', default=9150)
+DMX_FPS = env.float('DMX_FPS', default=10.0)
+DMX_REFRESH_SECONDS = env.float('DMX_REFRESH_SECONDS', default=1.0)
 DMX_EVENTS = {'LA': (1, 11),
               'Boston': (1, 15),
               'attractor': (1, 2),
               'in-game': (1, 8)}
+# Channels that select a cue on the lighting desk, like those in DMX_EVENTS.
+# They switch straight to a new value rather than fading through the cues
+# between, so only intensity channels fade.
+DMX_CUE_CHANNELS = sorted({channel for channel, value in DMX_EVENTS.values()})
+# Each event plays a scene of steps. A step fades channels, numbered from 0
+# as in DMX_EVENTS, to new values over `fade` seconds and holds them for
+# `hold` seconds. Scenes with `loop` repeat their steps, for chases.
+DMX_FADE_SECONDS = env.float('DMX_FADE_SECONDS', default=0)
+DMX_SCENES = {event: {'steps': [{'channels': {channel: value}, 'fade': DMX_FADE_SECONDS}]}
+              for event, (channel, value) in DMX_EVENTS.items()}
 
 if 'AWS_STORAGE_BUCKET_NAME' in os.environ:
     AWS_STORAGE_BUCKET_NAME = env('AWS_STORAGE_BUCKET_NAME', default='mlb-django')
     DEFAULT_FILE_STORAGE = 'storages.backends.s3boto3.S3Boto3Storage'
 
+# 'remote' writes straight to the nuc. 'local' writes to the default
+# database and replicates the changes to the nuc from an outbox.
+DATABASE_WRITE_MODE = env('DATABASE_WRITE_MODE', default='remote')
+REPLICATION_DATABASE = 'nuc'
+REPLICATION_BATCH_SIZE = env.int('REPLICATION_BATCH_SIZE', default=500)
+# Seconds a client reads from the database it wrote to, in remote mode.
+READ_PIN_SECONDS = env.int('READ_PIN_SECONDS', default=10)
+
 if DEBUG is False:
     DATABASES['nuc'] = env.db('NUC_DATABASE_URL')
     DATABASE_ROUTERS = ['game.router.GameRouter']
@@ -5,12 +5,18 @@ from django.contrib import admin
 from rest_framework import routers
 from rest_framework_jwt.views import obtain_jwt_token
 
-from game.views import UserViewSet, GameViewSet, TeamViewSet, set_lighting
+from game.views import (UserViewSet, GameViewSet, TeamViewSet, set_lighting, get_lighting_status,
+                        get_metrics, follow_short_url, get_leaderboard, get_events)
 
 urlpatterns = [
     url(r'^admin/', admin.site.urls),
     url(r'^token/', obtain_jwt_token),
+    url(r'^lighting/status/', get_lighting_status),
     url(r'^lighting/', set_lighting),
+    url(r'^metrics/', get_metrics),
+    url(r'^leaderboard/', get_leaderboard),
+    url(r'^events/', get_events),
+    url(r'^s/(?P<code>[0-9A-Za-z_-]+)/?$', follow_short_url, name='short-url'),
 ]
 
 if settings.DEBUG: